@@ -20,8 +20,12 @@ def main():
         raise SystemExit(0)
 
     from datetime import datetime
+    from multiprocessing import freeze_support
     from traceback import format_exc
 
+    # tools that use worker processes need this when frozen on Windows
+    freeze_support()
+
     try:
         from mozzarilla.app_window import Mozzarilla
         main_window = Mozzarilla(debug=1)
@@ -46,6 +46,8 @@
 import mozzarilla
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla.path_index import TrigramPathIndex
+from mozzarilla.tag_index import TagIndex, get_tag_references
 from mozzarilla.widgets.field_widget_picker import def_halo_widget_picker
 from mozzarilla.widgets.directory_frame import DirectoryFrame
 from mozzarilla.windows.tag_window import HaloTagWindow, HaloConfigWindow
@@ -55,7 +57,7 @@
      DependencyWindow, TagScannerWindow, DataExtractionWindow,\
      bitmap_from_dds, bitmap_from_multiple_dds, bitmap_from_bitmap_source, \
      AnimationsCompilerWindow, AnimationsCompressionWindow,\
-     SoundCompilerWindow, ModelCompilerWindow,\
+     SoundCompilerWindow, ModelCompilerWindow, QuickOpenWindow,\
      physics_from_jms, hud_message_text_from_hmt, strings_from_txt
 from mozzarilla.windows.tag_converters import ObjectConverter,\
      GbxmodelConverter, ModelConverter, ChicagoShaderConverter,\
@@ -71,7 +73,7 @@
     '<F5>': "switch_tags_dir",
     '<F6>': "set_tags_dir",
     '<F7>': "add_tags_dir",
-    #'<F8>': "???",
+    '<F8>': "show_quick_open_window",
 
     '<F9>': "bitmap_from_dds",
     '<F10>': "bitmap_from_bitmap_source",
@@ -155,6 +157,8 @@ class Mozzarilla(Binilla):
     config_window_class = HaloConfigWindow
 
     tool_windows = None
+    tag_indices = None
+    path_index = None
 
     window_panes = None
     directory_frame = None
@@ -278,6 +282,8 @@ def __init__(self, *args, **kwargs):
             label="Model_animations decompressor",
             command=self.show_animations_compression_window)
         self.tools_menu.add_separator()
+        self.tools_menu.add_command(
+            label="Quick open tag", command=self.show_quick_open_window)
         self.tools_menu.add_command(
             label="Tags directory error locator", command=self.show_tag_scanner)
         self.tools_menu.add_command(
@@ -334,6 +340,8 @@ def __init__(self, *args, **kwargs):
 
         self.select_defs(manual=False)
         self.tool_windows = {}
+        self.tag_indices = {}
+        self.path_index = TrigramPathIndex(self.get_tag_extensions())
 
         self._mozzarilla_initialized = True
 
@@ -351,6 +359,8 @@ def __init__(self, *args, **kwargs):
         except AttributeError:
             pass
 
+        self.update_path_index(tuple(self.tags_dirs))
+
         if self.config_made_anew:
             messagebox.showinfo(
                 "Select your default tags directory",
@@ -453,6 +463,41 @@ def get_handler(self, index=None, tags_dir=None, create_if_not_exists=True):
             print(format_exc())
             return None
 
+    def get_tag_index(self, handler=None):
+        '''
+        Returns the TagIndex for the handler's tags directory,
+        or for the active handler if none is given.
+        '''
+        if handler is None:
+            handler = self.handler
+
+        handler_index = self.get_handler_index(handler)
+        if handler_index is None or not hasattr(handler, "tagsdir"):
+            return None
+
+        key = (handler_index, Path(handler.tagsdir))
+        tag_index = self.tag_indices.get(key)
+        if tag_index is None or tag_index.handler is not handler:
+            tag_index = TagIndex.for_handler(
+                handler, self.handler_names[handler_index])
+            self.tag_indices[key] = tag_index
+
+        return tag_index
+
+    def find_tags(self, def_ids=None, directory=None, handler=None):
+        '''
+        Returns a sorted list of the tags directory relative paths of the
+        tags of the given def_ids within the given directory. Uses the
+        tag index, refreshing it first so it matches what is on disk.
+        '''
+        tag_index = self.get_tag_index(handler)
+        if tag_index is None:
+            return []
+
+        if tag_index.refresh() is None:
+            return []
+        return tag_index.get_tag_paths(def_ids, directory)
+
     def create_handlers(self, tags_dir, handler_indices=()):
         tags_dir = Path(tags_dir)
 
@@ -539,6 +584,13 @@ def select_defs(self, menu_index=None, manual=True):
             except AttributeError:
                 print(format_exc())
 
+            # reindex the tags directories if the new tag set
+            # doesnt use the same extensions as the last one.
+            exts = self.get_tag_extensions()
+            if self.path_index is not None and exts != self.path_index.exts:
+                self.path_index = TrigramPathIndex(exts)
+                self.update_path_index(tuple(self.tags_dirs))
+
             if manual:
                 print("    Finished")
 
@@ -570,6 +622,7 @@ def add_tags_dir(self, e=None, tags_dir=None, manual=True):
 
         self.tags_dirs.append(tags_dir)
         self.switch_tags_dir(index=len(self.tags_dirs) - 1, manual=False)
+        self.update_path_index((tags_dir, ))
 
         if self.directory_frame is not None:
             self.directory_frame.add_root_dir(tags_dir)
@@ -595,6 +648,7 @@ def remove_tags_dir(self, e=None, index=None, manual=True):
 
         tags_dir = self.tags_dirs[index]
         del self.tags_dirs[index]
+        self.update_path_index(removed_dirs=(tags_dir, ))
         if self.directory_frame is not None:
             self.directory_frame.del_root_dir(tags_dir)
 
@@ -622,6 +676,7 @@ def set_tags_dir(self, e=None, tags_dir=None, manual=True):
             self.directory_frame.set_root_dir(tags_dir)
             self.directory_frame.highlight_tags_dir(self.tags_dir)
 
+        self.update_path_index((tags_dir, ), (self.tags_dir, ))
         self.tags_dir = tags_dir
         self.set_active_handler()
 
@@ -918,7 +973,9 @@ def save_tag(self, tag=None):
             else:
                 tag.filepath = Path(tag.tags_dir, tag.rel_filepath)
 
-        return Binilla.save_tag(self, tag)
+        tag = Binilla.save_tag(self, tag)
+        self.update_tag_index(tag)
+        return tag
 
     def save_tag_as(self, tag=None, filepath=None):
         if tag is None:
@@ -978,8 +1035,66 @@ def save_tag_as(self, tag=None, filepath=None):
             tag.filepath = filepath
 
         self.update_tag_window_title(w)
+        self.update_tag_index(tag)
         return tag
 
+    def get_tag_extensions(self):
+        '''
+        Returns a frozenset of the lowercased extensions of
+        the tags in the current tag set, or None if there isnt one.
+        '''
+        id_ext_map = getattr(self.handler, "id_ext_map", None)
+        if id_ext_map is None:
+            return None
+        return frozenset(ext.lower() for ext in id_ext_map.values())
+
+    def update_path_index(self, tags_dirs=(), removed_dirs=()):
+        '''
+        Removes the removed tags directories from the path index and
+        adds/rescans the given tags directories on a separate thread.
+        '''
+        if self.path_index is None:
+            # not initialized yet. all tags directories are indexed once it is
+            return
+
+        def update(path_index=self.path_index):
+            try:
+                for tags_dir in removed_dirs:
+                    path_index.remove_directory(tags_dir)
+                for tags_dir in tags_dirs:
+                    path_index.update_directory(tags_dir)
+            except Exception:
+                print(format_exc())
+                print("Could not update quick open path index.")
+
+        index_thread = Thread(target=update, daemon=True)
+        index_thread.start()
+
+    def update_tag_index(self, tag):
+        '''
+        Updates the saved tag's entry in the indices of its tags directory,
+        if they are in use, so it doesnt have to be reloaded later.
+        '''
+        tags_dir = getattr(tag, "tags_dir", None)
+        if (self.path_index is not None and tags_dir and
+                is_in_dir(tag.filepath, tags_dir)):
+            self.path_index.add_path(
+                tags_dir, Path(tag.filepath).relative_to(tags_dir))
+
+        handler = getattr(tag, "handler", None)
+        tag_index = self.tag_indices.get(
+            (self.get_handler_index(handler), Path(getattr(handler, "tagsdir", ""))))
+        if (tag_index is None or tag_index.handler is not handler or
+                not is_in_dir(tag.filepath, handler.tagsdir)):
+            return
+
+        try:
+            tag_index.update_tag(
+                tag.filepath, get_tag_references(handler, tag))
+        except Exception:
+            print(format_exc())
+            print("Could not update tag index for '%s'" % tag.filepath)
+
     def save_all(self, e=None):
         '''
         Saves all currently loaded tags to their files.
@@ -1220,6 +1335,8 @@ def show_dependency_viewer(self, e=None):
         self.show_tool_window("dependency_window", DependencyWindow, True)
     def show_tag_scanner(self, e=None):
         self.show_tool_window("tag_scanner_window", TagScannerWindow, True)
+    def show_quick_open_window(self, e=None):
+        self.show_tool_window("quick_open_window", QuickOpenWindow)
 
     def show_bitmap_converter_window(self, e=None):
         self.show_tool_window("bitmap_converter_window", BitmapConverterWindow)
@@ -68,7 +68,8 @@
     {GUI_NAME:"open model animations compiler", NAME:"show_animations_compiler_window"},
     {GUI_NAME:"open model animations compression", NAME:"show_animations_compression_window"},
     {GUI_NAME:"open sound compiler", NAME:"show_sound_compiler_window"},
-    # space for (64 - 17) more enums here
+    {GUI_NAME:"open quick open", NAME:"show_quick_open_window"},
+    # space for (64 - 18) more enums here
 
     {GUI_NAME:"", NAME:"mozz_divider4", VALUE:1024 + 64*2},
     {GUI_NAME:"open model converter", NAME:"show_model_converter"},
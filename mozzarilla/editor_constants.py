@@ -55,6 +55,8 @@
 else:
     SETTINGS_DIR = Path(Path.home(), ".local", "share", "mek")
 
+CACHE_DIR = Path(SETTINGS_DIR, "cache")
+
 MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "mozzarilla.ico")
 if not MOZZ_ICON_PATH.is_file():
     MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "icons", "mozzarilla.ico")
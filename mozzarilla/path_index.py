@@ -0,0 +1,252 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import heapq
+import os
+
+from array import array
+from collections import Counter
+from itertools import chain
+from threading import RLock
+
+from mozzarilla.tag_index import iter_files
+
+# number of paths added to the index each time the lock is acquired
+PATH_INDEX_BATCH_SIZE = 1000
+
+# number of the rarest trigrams of a query used for fuzzy matching
+FUZZY_TRIGRAM_COUNT = 8
+
+
+def get_path_key(rel_path):
+    '''
+    Returns the lowercased, backslash separated form
+    of the path that searches are matched against.
+    '''
+    return str(rel_path).replace("/", "\\").lower()
+
+
+def get_trigrams(string):
+    return set(string[i: i + 3] for i in range(len(string) - 2))
+
+
+class TrigramPathIndex:
+    '''
+    An in memory index of the files in a set of directories, for finding
+    the ones whose paths fuzzily match a search string. Each path is listed
+    under every 3 character sequence in its lowercased relative path, so
+    only paths sharing the query's rarest sequence need to be compared.
+    Paths can be added and removed while searches happen on other threads.
+    If exts is given, only files with those extensions are indexed.
+    '''
+    def __init__(self, exts=None):
+        self.lock = RLock()
+        self.exts = None if exts is None else frozenset(
+            ext.lower() for ext in exts)
+        # these are indexed by path id. removed paths have a key of None
+        self.root_dirs = []
+        self.rel_paths = []
+        self.keys = []
+        # where the filename starts in each key
+        self.name_starts = array("I")
+
+        # maps (root_dir, path key) to path id
+        self.path_ids = {}
+        # maps each trigram to an array of the ids of paths containing it
+        self.trigrams = {}
+        # maps the first 1 and 2 characters of filenames to an array
+        # of the ids of paths whose filenames start with them.
+        self.name_prefixes = {}
+        self.removed_count = 0
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def is_indexable(self, rel_path):
+        return (self.exts is None or
+                os.path.splitext(str(rel_path))[-1].lower() in self.exts)
+
+    def add_path(self, root_dir, rel_path):
+        if not self.is_indexable(rel_path):
+            return
+
+        root_dir = str(root_dir)
+        key = get_path_key(rel_path)
+        with self.lock:
+            if (root_dir, key) in self.path_ids:
+                return
+
+            path_id = len(self.keys)
+            name_start = key.rfind("\\") + 1
+            self.root_dirs.append(root_dir)
+            self.rel_paths.append(str(rel_path))
+            self.keys.append(key)
+            self.name_starts.append(name_start)
+            self.path_ids[(root_dir, key)] = path_id
+
+            name_prefixes = set((key[name_start: name_start + 1],
+                                 key[name_start: name_start + 2]))
+            for index, grams in ((self.trigrams, get_trigrams(key)),
+                                 (self.name_prefixes, name_prefixes)):
+                for gram in grams:
+                    ids = index.get(gram)
+                    if ids is None:
+                        ids = index[gram] = array("I")
+                    ids.append(path_id)
+
+    def remove_path(self, root_dir, rel_path):
+        with self.lock:
+            path_id = self.path_ids.pop(
+                (str(root_dir), get_path_key(rel_path)), None)
+            if path_id is None:
+                return
+
+            # leave the id in the trigram arrays, and
+            # rebuild them once enough paths are removed.
+            self.keys[path_id] = None
+            self.removed_count += 1
+            if self.removed_count > len(self.path_ids):
+                self.compact()
+
+    def compact(self):
+        '''
+        Rebuilds the index without the paths that have been removed.
+        '''
+        with self.lock:
+            # build the new index separately and swap its contents in,
+            # as other threads may be waiting on this index's lock.
+            new_index = TrigramPathIndex(self.exts)
+            for i in sorted(self.path_ids.values()):
+                new_index.add_path(self.root_dirs[i], self.rel_paths[i])
+
+            for name in ("root_dirs", "rel_paths", "keys", "name_starts",
+                         "path_ids", "trigrams", "name_prefixes",
+                         "removed_count"):
+                setattr(self, name, getattr(new_index, name))
+
+    def update_directory(self, root_dir):
+        '''
+        Adds every file in the directory to the index, and removes
+        any indexed paths in the directory that no longer exist.
+        '''
+        root_dir = str(root_dir)
+        seen_keys = set()
+        rel_paths = []
+        for entry in iter_files(root_dir):
+            rel_path = os.path.relpath(entry.path, root_dir)
+            if not self.is_indexable(rel_path):
+                continue
+
+            seen_keys.add(get_path_key(rel_path))
+            rel_paths.append(rel_path)
+            if len(rel_paths) >= PATH_INDEX_BATCH_SIZE:
+                self.add_paths(root_dir, rel_paths)
+                rel_paths = []
+
+        self.add_paths(root_dir, rel_paths)
+        with self.lock:
+            for other_dir, key in tuple(self.path_ids):
+                if other_dir == root_dir and key not in seen_keys:
+                    self.remove_path(root_dir, key)
+
+    def add_paths(self, root_dir, rel_paths):
+        with self.lock:
+            for rel_path in rel_paths:
+                self.add_path(root_dir, rel_path)
+
+    def remove_directory(self, root_dir):
+        root_dir = str(root_dir)
+        with self.lock:
+            for other_dir, key in tuple(self.path_ids):
+                if other_dir == root_dir:
+                    self.remove_path(root_dir, key)
+
+    def search(self, query, limit=50):
+        '''
+        Returns a list of up to limit (root_dir, rel_path) tuples of the
+        paths that best match the query. Paths containing every whitespace
+        separated word in the query are returned first, preferring matches
+        in the filename and shorter paths. If no paths contain every word,
+        the paths sharing the most 3 character sequences are returned.
+        Queries with only 1 or 2 characters only match filename starts.
+        '''
+        terms = get_path_key(query).split()
+        if not terms:
+            return []
+
+        with self.lock:
+            matches = self.find_substring_matches(terms)
+            if not matches:
+                matches = self.find_fuzzy_matches(terms)
+
+            best = heapq.nsmallest(limit, matches)
+            return [(self.root_dirs[path_id], self.rel_paths[path_id])
+                    for _, path_id in best]
+
+    def find_substring_matches(self, terms):
+        '''
+        Returns a list of (score, path_id) tuples of the
+        paths that contain every term. Lower scores are better.
+        '''
+        keys = self.keys
+        name_starts = self.name_starts
+        candidates = None
+        for term in terms:
+            for trigram in get_trigrams(term):
+                ids = self.trigrams.get(trigram, ())
+                if candidates is None or len(ids) < len(candidates):
+                    candidates = ids
+
+        if candidates is None:
+            # no terms are long enough to have trigrams
+            candidates = self.name_prefixes.get(terms[0][:2], ())
+
+        matches = []
+        for path_id in candidates:
+            key = keys[path_id]
+            if key is None:
+                continue
+
+            # prefer matches at the start of the filename, then matches
+            # anywhere in the filename, and then shorter paths.
+            score = len(key)
+            name_start = name_starts[path_id]
+            for term in terms:
+                if key.startswith(term, name_start):
+                    score -= 2000
+                elif key.find(term, name_start) >= 0:
+                    score -= 1000
+                elif term not in key:
+                    break
+            else:
+                matches.append((score, path_id))
+
+        return matches
+
+    def find_fuzzy_matches(self, terms):
+        '''
+        Returns a list of (score, path_id) tuples of the paths sharing
+        at least half of the rarest trigrams in the terms.
+        '''
+        trigrams = set()
+        for term in terms:
+            trigrams.update(get_trigrams(term))
+
+        id_arrays = sorted(
+            (self.trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        id_arrays = id_arrays[: FUZZY_TRIGRAM_COUNT]
+
+        counts = Counter(chain.from_iterable(id_arrays))
+
+        # prefer paths sharing more trigrams, and then shorter paths
+        keys = self.keys
+        min_count = (len(id_arrays) + 1) // 2
+        return [((len(id_arrays) - count)*1000 + len(keys[path_id]), path_id)
+                for path_id, count in counts.items()
+                if count >= min_count and keys[path_id] is not None]
@@ -0,0 +1,194 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import os
+
+from collections import OrderedDict
+from pathlib import Path
+from threading import RLock
+from traceback import format_exc
+
+from mozzarilla import editor_constants as e_c
+
+# max number of bytes of previews kept in memory and on disk
+PREVIEW_CACHE_MEMORY_BUDGET = 64 * 1024**2
+PREVIEW_CACHE_DISK_BUDGET = 512 * 1024**2
+
+_preview_cache = None
+
+
+def get_preview_cache():
+    '''
+    Returns the PreviewCache shared by every bitmap preview.
+    '''
+    global _preview_cache
+    if _preview_cache is None:
+        _preview_cache = PreviewCache(Path(e_c.CACHE_DIR, "bitmap_previews"))
+    return _preview_cache
+
+
+class PreviewCache:
+    '''
+    A least recently used cache of the images made to preview bitmaps.
+
+    Images are stored as bytes under a key made from the tag path, its
+    mtime, and the bitmap, mipmap and face they are of, along with anything
+    else that changes how they look. The most recently used ones are kept in
+    memory, and every one is also written to the cache directory so they
+    survive restarting. Each tier drops its least recently used images once
+    they take up more than its budget.
+    '''
+    def __init__(self, cache_dir, memory_budget=PREVIEW_CACHE_MEMORY_BUDGET,
+                 disk_budget=PREVIEW_CACHE_DISK_BUDGET, ext=".png"):
+        self.lock = RLock()
+        self.cache_dir = Path(cache_dir)
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.ext = ext
+
+        self.memory_entries = OrderedDict()
+        self.memory_size = 0
+        # calculated the first time something is written to disk
+        self.disk_size = None
+
+    @staticmethod
+    def make_key(tag_path, mtime, bitmap_index, mipmap, face, *extra):
+        '''
+        Returns the key an image is cached under. Any extra arguments must
+        have a repr that is the same for equal values between sessions.
+        '''
+        key = repr((str(tag_path), mtime, bitmap_index, mipmap, face) + extra)
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    def get_filepath(self, key):
+        return Path(self.cache_dir, key + self.ext)
+
+    def get(self, key):
+        '''
+        Returns the image cached under the key, or None if it isnt cached.
+        '''
+        with self.lock:
+            data = self.memory_entries.get(key)
+            if data is not None:
+                self.memory_entries.move_to_end(key)
+                return data
+
+        filepath = self.get_filepath(key)
+        try:
+            with filepath.open("rb") as f:
+                data = f.read()
+            # the mtime of the files is used to tell which were used last
+            os.utime(str(filepath))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            print(format_exc())
+            return None
+
+        self._put_in_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        '''
+        Caches the image bytes under the key in memory and on disk.
+        '''
+        data = bytes(data)
+        self._put_in_memory(key, data)
+
+        filepath = self.get_filepath(key)
+        temp_path = filepath.with_suffix(".tmp")
+        try:
+            # the size of the file being replaced, if the key is cached
+            old_size = filepath.stat().st_size
+        except OSError:
+            old_size = 0
+
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with temp_path.open("wb") as f:
+                f.write(data)
+
+            os.replace(str(temp_path), str(filepath))
+        except Exception:
+            print(format_exc())
+            print("Could not write preview cache: %s" % filepath)
+            return
+
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = self._get_disk_entries()[1]
+            else:
+                self.disk_size += len(data) - old_size
+
+            if self.disk_size > self.disk_budget:
+                self.trim_disk()
+
+    def _put_in_memory(self, key, data):
+        with self.lock:
+            old_data = self.memory_entries.pop(key, None)
+            if old_data is not None:
+                self.memory_size -= len(old_data)
+
+            if len(data) > self.memory_budget:
+                return
+
+            self.memory_entries[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_budget:
+                _, old_data = self.memory_entries.popitem(last=False)
+                self.memory_size -= len(old_data)
+
+    def _get_disk_entries(self):
+        '''
+        Returns a list of the (mtime, size, filepath) of each image in
+        the cache directory, and the total size of them.
+        '''
+        entries = []
+        try:
+            for entry in os.scandir(str(self.cache_dir)):
+                if entry.is_file() and entry.name.endswith(self.ext):
+                    stat_result = entry.stat()
+                    entries.append((stat_result.st_mtime, stat_result.st_size,
+                                    entry.path))
+        except FileNotFoundError:
+            pass
+
+        return entries, sum(entry[1] for entry in entries)
+
+    def trim_disk(self):
+        '''
+        Deletes the least recently used images on disk until they take up
+        less than three quarters of the disk budget, so the directory
+        doesnt need to be scanned again after every new image.
+        '''
+        with self.lock:
+            entries, self.disk_size = self._get_disk_entries()
+            entries.sort()
+            target_size = self.disk_budget * 3 // 4
+            for _, size, filepath in entries:
+                if self.disk_size <= target_size:
+                    break
+
+                try:
+                    os.remove(filepath)
+                    self.disk_size -= size
+                except Exception:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            self.memory_entries.clear()
+            self.memory_size = 0
+            for _, _, filepath in self._get_disk_entries()[0]:
+                try:
+                    os.remove(filepath)
+                except Exception:
+                    pass
+            self.disk_size = 0
@@ -0,0 +1,107 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from traceback import format_exc
+
+from mozzarilla import editor_constants as e_c
+
+
+class ScanCache:
+    '''
+    A persistent cache of per-file scan results.
+
+    Each result is stored under a key along with the mtime and size of
+    the file it was made from, and is only handed back while the file
+    still has that same mtime and size. Results must be json serializable.
+    A single cache file can hold several namespaces(such as one per
+    handler) so that results made by one don't get reused by another.
+    '''
+    version = 2
+
+    def __init__(self, filepath, namespace=""):
+        self.filepath = Path(filepath)
+        self.namespace = namespace
+        self.entries = {}
+        self.edited = False
+
+    @classmethod
+    def for_directory(cls, cache_name, dirpath, namespace=""):
+        '''
+        Returns a ScanCache that is unique to the given directory.
+        '''
+        dir_hash = hashlib.md5(str(dirpath).encode("utf-8")).hexdigest()
+        return cls(Path(e_c.CACHE_DIR, "%s_%s.json" % (cache_name, dir_hash)),
+                   namespace)
+
+    def _read_namespaces(self):
+        try:
+            with self.filepath.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            if data.get("version") == self.version:
+                return data.get("namespaces", {})
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(format_exc())
+            print("Could not read scan cache: %s" % self.filepath)
+
+        return {}
+
+    def load(self):
+        self.entries = self._read_namespaces().get(self.namespace, {})
+        self.edited = False
+
+    def save(self):
+        if not self.edited:
+            return
+
+        namespaces = self._read_namespaces()
+        namespaces[self.namespace] = self.entries
+
+        temp_path = self.filepath.with_suffix(".tmp")
+        try:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            with temp_path.open("w", encoding="utf-8") as f:
+                json.dump(dict(version=self.version, namespaces=namespaces),
+                          f, separators=(",", ":"))
+
+            os.replace(str(temp_path), str(self.filepath))
+            self.edited = False
+        except Exception:
+            print(format_exc())
+            print("Could not write scan cache: %s" % self.filepath)
+
+    def get(self, key, stat_result):
+        '''
+        Returns the result cached under the key if the file it was made
+        from is unchanged. Otherwise returns None.
+        '''
+        entry = self.entries.get(key)
+        if (entry is not None and entry[0] == stat_result.st_mtime_ns and
+                entry[1] == stat_result.st_size):
+            return entry[2]
+        return None
+
+    def set(self, key, stat_result, result):
+        self.entries[key] = [
+            stat_result.st_mtime_ns, stat_result.st_size, result]
+        self.edited = True
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.edited = True
+
+    def keys(self):
+        return self.entries.keys()
@@ -0,0 +1,749 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import os
+import sqlite3
+import struct
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+from pathlib import Path, PureWindowsPath
+from threading import RLock
+from time import time
+from traceback import format_exc
+
+from supyr_struct.defs.constants import INVALID
+
+from mozzarilla import editor_constants as e_c
+
+# number of tags each worker process is handed at a time
+INDEX_CHUNK_SIZE = 32
+
+# number of seconds between printing how far indexing has gotten
+PROGRESS_INTERVAL = 5
+
+# the handler each worker process uses to load tags
+_worker_handler = None
+
+# size of the header at the start of every tag file
+TAG_HEADER_SIZE = 64
+
+# maps (handler_class, def_id) to the reference layout for that tag type.
+# the value is None if the tag type cant be read without building it.
+_reference_layouts = {}
+
+_int32 = struct.Struct(">i")
+_uint32 = struct.Struct(">I")
+
+
+def get_block_path(block):
+    '''
+    Returns a string path to the block from the root of its tag,
+    such as "events[0].event.parts[1].part.type"
+    '''
+    block_path = block.NAME
+    last_block = block
+    parent = last_block.parent
+    while parent is not None and hasattr(parent, 'NAME'):
+        name = parent.NAME
+        if parent.TYPE.is_array:
+            # compare by identity, as equal blocks arent the same block
+            index = next(i for i, sub_block in enumerate(parent)
+                         if sub_block is last_block)
+            block_path = '[%s].%s' % (index, block_path)
+        elif name not in ('tagdata', 'data'):
+            if not last_block.TYPE.is_array:
+                name += '.'
+            block_path = name + block_path
+        last_block = parent
+        parent = last_block.parent
+
+    # slice off the name of the tag's root block
+    return block_path.split('.', 1)[-1]
+
+
+def get_block_name(block_path):
+    '''
+    Returns the NAME of the block a block path leads to, such
+    as "type" for "events[0].event.parts[1].part.type"
+    '''
+    return block_path.rsplit('.', 1)[-1].split('[', 1)[0]
+
+
+def get_tag_references(handler, tag):
+    '''
+    Returns a list of (block_path, filepath, extension) tuples
+    for each non-empty tag reference in the tag.
+    '''
+    tag_ref_paths = handler.tag_ref_cache.get(tag.def_id)
+    if tag_ref_paths is None:
+        # no dependencies for this tag
+        return []
+
+    references = []
+    for block in handler.get_nodes_by_paths(tag_ref_paths, tag.data):
+        # if the node's filepath is empty, it cant be invalid
+        if not block.filepath:
+            continue
+
+        try:
+            ext = '.' + block.tag_class.enum_name
+        except Exception:
+            ext = ''
+        references.append((get_block_path(block), block.filepath, ext))
+
+    return references
+
+
+def get_loaded_tag(handler, tag_path):
+    '''
+    Returns the tag at the given path if the handler already has it
+    loaded(such as if it is open in a tag window), otherwise None.
+    '''
+    try:
+        return handler.get_tag(tag_path)
+    except (KeyError, LookupError):
+        return None
+
+
+def get_tag_references_by_path(handler, tag_path):
+    '''
+    Returns the references in the tag at the given path, as returned by
+    get_tag_references. If the tag is loaded its references are taken
+    from it so that unsaved edits are included. Otherwise they are read
+    from the file with read_tag_references.
+    '''
+    tag_path = Path(tag_path)
+    if tag_path.is_absolute():
+        try:
+            tag_path = tag_path.relative_to(handler.tagsdir)
+        except ValueError:
+            pass
+
+    tag = get_loaded_tag(handler, tag_path)
+    if tag is not None:
+        return get_tag_references(handler, tag)
+
+    return read_tag_references(handler, Path(handler.tagsdir, tag_path))
+
+
+def read_tag_references(handler, filepath):
+    '''
+    Returns the references in the tag file, as returned by
+    get_tag_references, without building the tag. Only the blocks that
+    lead to tag references, and the sizes needed to skip past the rest,
+    are read. Rawdata and blocks that cant contain tag references are
+    seeked over. If the tag cant be read this way it is built instead.
+    Raises an exception if the tag cant be loaded.
+    '''
+    def_id = handler.get_def_id(filepath)
+    tag_ref_paths = handler.tag_ref_cache.get(def_id)
+    if tag_ref_paths is None:
+        # no dependencies for this tag
+        return []
+
+    layout = get_reference_layout(handler, def_id)
+    if layout is not None:
+        try:
+            with open(filepath, 'rb') as f:
+                references = []
+                _read_array_references(
+                    f, os.fstat(f.fileno()).st_size, layout, 1,
+                    TAG_HEADER_SIZE, "", None, False, references)
+                return references
+        except Exception:
+            # fall back to building the whole tag
+            pass
+
+    tag = handler.build_tag(filepath=filepath)
+    if tag is None:
+        raise ValueError("Could not load tag '%s'" % filepath)
+    return get_tag_references(handler, tag)
+
+
+def get_reference_layout(handler, def_id):
+    '''
+    Returns the reference layout of the tagdata of the given tag type,
+    or None if the tag type cant be read without building it.
+    '''
+    key = (type(handler), def_id)
+    if key not in _reference_layouts:
+        try:
+            desc = handler.defs[def_id].descriptor
+            ref_node = handler.tag_ref_cache.get(def_id)
+            layout = _get_struct_layout(
+                desc[1], None if ref_node is None else ref_node.get(1))
+        except Exception:
+            layout = None
+        _reference_layouts[key] = layout
+
+    return _reference_layouts[key]
+
+
+def _has_steptree(desc):
+    if 'STEPTREE' in desc:
+        return True
+
+    sub_descs = [desc.get(i) for i in range(desc.get('ENTRIES', 0))]
+    sub_descs.append(desc.get('SUB_STRUCT'))
+    sub_descs.extend((desc.get('CASES') or {}).values())
+    for sub_desc in sub_descs:
+        # enums and booleans store their options as entries
+        f_type = sub_desc.get('TYPE') if isinstance(sub_desc, dict) else None
+        if (f_type is not None and f_type.is_block and not f_type.is_data
+                and _has_steptree(sub_desc)):
+            return True
+
+    return False
+
+
+def _get_struct_layout(desc, ref_node):
+    '''
+    Returns a (size, children, has_refs, later_refs) tuple, where children
+    is a list of (kind, offset, block_path, has_refs, extra) tuples
+    describing each tag reference, reflexive and rawdata in structs of
+    this descriptor in the order their steptrees are stored in a tag file.
+    later_refs says whether any children after each child lead to tag
+    references. ref_node is the handler's tag_ref_cache node for the
+    struct, and is used to tell which children lead to tag references.
+    '''
+    children = []
+    if 'ATTR_OFFS' in desc:
+        _add_struct_children(desc, ref_node, 0, "", children)
+    elif _has_steptree(desc):
+        raise ValueError("Cannot locate steptrees in '%s'" % desc['NAME'])
+
+    later_refs = [any(child[3] for child in children[j + 1:])
+                  for j in range(len(children))]
+    return (desc['SIZE'], children,
+            any(child[3] for child in children), later_refs)
+
+
+def _get_tagref_child(desc, offset, block_path, has_refs):
+    # tag references store their tag_class at offset 0
+    # and the length of their filepath at offset 8
+    enum_desc = desc[0]
+    tag_classes = {enum_desc[j]['VALUE']: enum_desc[j]['NAME']
+                   for j in range(enum_desc['ENTRIES'])}
+    return ("tagref", offset, block_path, has_refs, tag_classes)
+
+
+def _add_struct_children(desc, ref_node, base_offset, block_path, children):
+    for i, offset in enumerate(desc['ATTR_OFFS']):
+        f_desc = desc[i]
+        f_type = f_desc['TYPE']
+        f_node = None if ref_node is None else ref_node.get(i)
+        f_path = block_path + f_desc['NAME']
+        offset += base_offset
+
+        if f_type.name == "TagRef":
+            children.append(
+                _get_tagref_child(f_desc, offset, f_path, f_node is not None))
+        elif f_type.name == "Reflexive":
+            # reflexives store their entry count at offset 0
+            sub_desc = f_desc['STEPTREE']['SUB_STRUCT']
+            sub_node = None
+            if f_node is not None:
+                sub_node = f_node.get('STEPTREE', {}).get('SUB_STRUCT')
+
+            if sub_desc['TYPE'].name == "TagRef":
+                # arrays of tag references(like shader extra_layers)
+                # are read as structs whose only child is the reference.
+                has_refs = sub_node is not None
+                sub_layout = (sub_desc['SIZE'],
+                              [_get_tagref_child(sub_desc, 0, "", has_refs)],
+                              has_refs, [False])
+            else:
+                sub_layout = _get_struct_layout(sub_desc, sub_node)
+            children.append(("reflexive", offset, f_path, sub_layout[2],
+                             (sub_layout, sub_desc['NAME'])))
+        elif f_type.name == "RawdataRef":
+            # rawdata references store their byte size at offset 0
+            children.append(("rawdata", offset, f_path, False, None))
+        elif 'STEPTREE' in f_desc:
+            raise ValueError("Unknown steptree field type '%s'" % f_type.name)
+        elif f_type.is_struct and 'ATTR_OFFS' in f_desc:
+            _add_struct_children(f_desc, f_node, offset, f_path + '.', children)
+        elif f_type.is_block and not f_type.is_data and _has_steptree(f_desc):
+            raise ValueError("Cannot locate steptrees in '%s'" % f_type.name)
+
+
+def _read_array_references(f, file_size, layout, count, offset, block_path,
+                           struct_name, need_end, references):
+    '''
+    Reads the references out of an array of structs, and the steptrees
+    of those structs, starting at offset. Returns the offset after all
+    of it, or None if need_end is False and reading was stopped once
+    there were no more references in the array to be read.
+    '''
+    size, children, has_refs, later_refs = layout
+    array_size = size*count
+    if not children or (not has_refs and not need_end):
+        if offset + array_size > file_size:
+            raise ValueError("Array extends past the end of the tag.")
+        return offset + array_size
+
+    f.seek(offset)
+    array_data = f.read(array_size)
+    if len(array_data) != array_size:
+        raise ValueError("Array extends past the end of the tag.")
+
+    offset += array_size
+    for i in range(count):
+        prefix = block_path
+        if struct_name is not None:
+            prefix = "%s[%s].%s." % (block_path, i, struct_name)
+
+        more_structs = has_refs and i + 1 < count
+        for j, (kind, child_off, child_path, child_has_refs,
+                extra) in enumerate(children):
+            child_need_end = need_end or more_structs or later_refs[j]
+            if not (child_has_refs or child_need_end):
+                return None
+
+            child_off += i*size
+            if kind == "tagref":
+                path_length = _int32.unpack_from(array_data, child_off + 8)[0]
+                if path_length < 0 or path_length > 254:
+                    raise ValueError("Invalid tag reference path length.")
+                elif not path_length:
+                    continue
+
+                f.seek(offset)
+                filepath = f.read(path_length + 1)
+                offset += path_length + 1
+                if len(filepath) != path_length + 1 or filepath[-1]:
+                    raise ValueError("Invalid tag reference path.")
+
+                filepath = filepath.decode('latin-1').split('\x00')[0]
+                if not (child_has_refs and filepath):
+                    continue
+
+                # the child path of a struct that is itself a
+                # tag reference is empty, so strip the trailing "."
+                tag_class = extra.get(
+                    _uint32.unpack_from(array_data, child_off)[0], INVALID)
+                references.append(((prefix + child_path).rstrip('.'),
+                                   filepath, '.' + tag_class))
+            elif kind == "reflexive":
+                sub_count = _int32.unpack_from(array_data, child_off)[0]
+                if sub_count < 0:
+                    raise ValueError("Invalid reflexive count.")
+
+                offset = _read_array_references(
+                    f, file_size, extra[0], sub_count, offset,
+                    prefix + child_path, extra[1], child_need_end, references)
+                if offset is None:
+                    return None
+            else:
+                rawdata_size = _int32.unpack_from(array_data, child_off)[0]
+                if rawdata_size < 0 or offset + rawdata_size > file_size:
+                    raise ValueError("Invalid rawdata size.")
+                offset += rawdata_size
+
+    return offset
+
+
+def init_index_worker(handler_class, tagsdir, case_sensitive):
+    '''
+    Initializer for the tag index's worker processes. Each worker
+    owns its own handler instance for the tag set being indexed.
+    '''
+    global _worker_handler
+    _worker_handler = handler_class(debug=0, case_sensitive=case_sensitive)
+    _worker_handler.tagsdir = Path(tagsdir)
+
+
+def read_references_in_worker(tag_paths):
+    '''
+    Returns a list containing the references in each of the given tags
+    directory relative tag paths, as returned by get_tag_references.
+    The references of tags that could not be loaded are None.
+    '''
+    handler = _worker_handler
+    results = []
+    for tag_path in tag_paths:
+        try:
+            results.append(read_tag_references(
+                handler, handler.tagsdir.joinpath(tag_path)))
+        except Exception:
+            results.append(None)
+
+    return results
+
+
+def get_tag_key(tag_path):
+    '''
+    Returns the tags directory relative path in the form it is looked up
+    by in the index. Tag paths and tag references are both normalized to
+    lowercase backslash separated paths so that they can be compared to
+    each other, as tag references are case insensitive. The path as it
+    is on disk is stored separately for displaying.
+    '''
+    return str(PureWindowsPath(tag_path)).lower()
+
+
+def iter_files(dirpath):
+    '''
+    Yields an os.DirEntry for every file in the directory and its
+    subdirectories. Unreadable directories are skipped.
+    '''
+    try:
+        entries = list(os.scandir(dirpath))
+    except OSError:
+        return
+
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                yield from iter_files(entry.path)
+            elif entry.is_file():
+                yield entry
+        except OSError:
+            pass
+
+
+class TagIndex:
+    '''
+    A persistent index of every file in a tags directory.
+
+    For each file the index stores its tags directory relative path,
+    the def_id sniffed from its header, its size and mtime, and the tag
+    references it contains. refresh() only re-sniffs the files whose
+    size or mtime changed since they were last indexed, and references
+    are only extracted(with read_tag_references, which reads them from
+    the file without building the tag where it can) the first time they
+    are asked for after the tag changes.
+    '''
+    version = 2
+
+    def __init__(self, handler, filepath):
+        self.handler = handler
+        self.filepath = Path(filepath)
+        self.case_sensitive = getattr(handler, "case_sensitive", False)
+        self.stop_indexing = False
+        self._lock = RLock()
+        self._initialized = False
+
+    @classmethod
+    def for_handler(cls, handler, namespace=""):
+        '''
+        Returns a TagIndex for the handler's tags directory. The namespace
+        should name the handler, as different handlers can sniff the same
+        file as different def_ids.
+        '''
+        key = "%s|%s" % (handler.tagsdir, namespace)
+        dir_hash = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return cls(handler, Path(e_c.CACHE_DIR, "tag_index_%s.sqlite3" % dir_hash))
+
+    @property
+    def tagsdir(self):
+        return Path(self.handler.tagsdir)
+
+    def get_key(self, tag_path):
+        return get_tag_key(tag_path)
+
+    def connect(self):
+        if not self._initialized:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = sqlite3.connect(str(self.filepath), timeout=30)
+        if not self._initialized:
+            self._create_tables(conn)
+            self._initialized = True
+        return conn
+
+    def _create_tables(self, conn):
+        with conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != self.version:
+                conn.execute("DROP TABLE IF EXISTS tags")
+                conn.execute("DROP TABLE IF EXISTS refs")
+                conn.execute("PRAGMA user_version = %d" % self.version)
+
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tags ("
+                "key TEXT PRIMARY KEY, path TEXT, def_id TEXT, "
+                "size INTEGER, mtime_ns INTEGER, refs_indexed INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refs ("
+                "tag_key TEXT, block_path TEXT, ref_path TEXT, "
+                "ref_ext TEXT, ref_key TEXT)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS refs_by_tag ON refs (tag_key)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS refs_by_target ON refs (ref_key)")
+
+    def refresh(self):
+        '''
+        Brings the index up to date with the files in the tags directory.
+        Returns the number of files that were added or changed, and the
+        number of files that were removed, or None if refreshing was
+        stopped with stop_indexing. Nothing is stored if it was stopped.
+        '''
+        self.stop_indexing = False
+        c_time = time()
+        with closing(self.connect()) as conn:
+            tagsdir = str(self.tagsdir)
+            on_disk = {}
+            for entry in iter_files(tagsdir):
+                if self.stop_indexing:
+                    return None
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+
+                path = os.path.relpath(entry.path, tagsdir)
+                on_disk[self.get_key(path)] = (path, stat)
+                if time() - c_time > PROGRESS_INTERVAL:
+                    c_time = time()
+                    print("    Found %s files" % len(on_disk))
+
+            indexed = {
+                key: (mtime_ns, size) for key, mtime_ns, size in
+                conn.execute("SELECT key, mtime_ns, size FROM tags")}
+
+            removed = [(key, ) for key in indexed if key not in on_disk]
+            changed = []
+            for key, (path, stat) in on_disk.items():
+                if indexed.get(key) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                elif self.stop_indexing:
+                    return None
+                elif time() - c_time > PROGRESS_INTERVAL:
+                    c_time = time()
+                    print("    Indexed %s changed files" % len(changed))
+
+                try:
+                    def_id = self.handler.get_def_id(os.path.join(tagsdir, path))
+                except Exception:
+                    def_id = None
+
+                changed.append(
+                    (key, path, def_id, stat.st_size, stat.st_mtime_ns, 0))
+
+            with self._lock, conn:
+                conn.executemany("DELETE FROM tags WHERE key = ?", removed)
+                conn.executemany("DELETE FROM refs WHERE tag_key = ?",
+                                 removed + [row[:1] for row in changed])
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)",
+                    changed)
+
+        return len(changed), len(removed)
+
+    def get_tag_paths(self, def_ids=None, directory=None):
+        '''
+        Returns a sorted list of the tags directory relative paths of
+        every indexed tag. If def_ids is given, only tags of those def_ids
+        are returned. If directory is given, only tags within it are.
+        '''
+        query = "SELECT path FROM tags WHERE def_id IS NOT NULL"
+        args = []
+        if def_ids is not None:
+            def_ids = list(def_ids)
+            query += " AND def_id IN (%s)" % ", ".join("?" * len(def_ids))
+            args.extend(def_ids)
+
+        if directory is not None:
+            directory = Path(directory)
+            if directory.is_absolute():
+                directory = os.path.relpath(directory, self.tagsdir)
+
+            dir_key = self.get_key(directory)
+            if dir_key != ".":
+                dir_key += "\\"
+                query += " AND substr(key, 1, ?) = ?"
+                args.extend((len(dir_key), dir_key))
+
+        with closing(self.connect()) as conn:
+            paths = [Path(path) for path, in conn.execute(query, args)]
+
+        paths.sort()
+        return paths
+
+    def get_def_id(self, tag_path):
+        '''
+        Returns the def_id the tag was indexed as, or None if the
+        file isnt indexed or isnt a tag.
+        '''
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT def_id FROM tags WHERE key = ?",
+                               (self.get_key(tag_path), )).fetchone()
+        return None if row is None else row[0]
+
+    def index_references(self, tag_paths=None, parallel=False):
+        '''
+        Extracts and stores the references of every tag whose references
+        are out of date. If tag_paths is given, only those tags are checked.
+        If parallel is True, the tags are shared out to a pool of worker
+        processes. Returns False if indexing was stopped with stop_indexing.
+        '''
+        tag_ref_cache = getattr(self.handler, "tag_ref_cache", None) or {}
+        self.stop_indexing = False
+        # the lock is only held while storing each batch of references,
+        # so saving a tag on the main thread isnt blocked while indexing.
+        with closing(self.connect()) as conn:
+            query = ("SELECT key, path, def_id FROM tags "
+                     "WHERE refs_indexed = 0 AND def_id IS NOT NULL")
+            if tag_paths is None:
+                rows = conn.execute(query).fetchall()
+            else:
+                rows = []
+                for tag_path in tag_paths:
+                    rows.extend(conn.execute(query + " AND key = ?",
+                                             (self.get_key(tag_path), )))
+
+            # tags that cant contain references dont need to be loaded
+            self._store_references(conn, [
+                (key, ()) for key, _, def_id in rows
+                if def_id not in tag_ref_cache])
+
+            rows = [(key, path) for key, path, def_id in rows
+                    if def_id in tag_ref_cache]
+            if parallel and len(rows) > INDEX_CHUNK_SIZE:
+                return self._index_references_parallel(conn, rows)
+
+            for key, path in rows:
+                if self.stop_indexing:
+                    return False
+                self._store_references(
+                    conn, [(key, self._read_references(path))])
+
+        return True
+
+    def _index_references_parallel(self, conn, rows):
+        print("Indexing tag references in %s tags..." % len(rows))
+        chunks = [rows[i: i + INDEX_CHUNK_SIZE]
+                  for i in range(0, len(rows), INDEX_CHUNK_SIZE)]
+        indexed_count = 0
+        c_time = time()
+
+        executor = ProcessPoolExecutor(
+            initializer=init_index_worker, initargs=(
+                type(self.handler), str(self.tagsdir), self.case_sensitive))
+        futures = {}
+        try:
+            for chunk in chunks:
+                futures[executor.submit(
+                    read_references_in_worker, [path for _, path in chunk]
+                    )] = chunk
+
+            for future in as_completed(tuple(futures)):
+                chunk = futures.pop(future)
+                all_references = future.result()
+                for (_, path), references in zip(chunk, all_references):
+                    if references is None:
+                        print("    Could not index references in '%s'" % path)
+
+                self._store_references(conn, [
+                    (key, references or ()) for (key, _), references
+                    in zip(chunk, all_references)])
+
+                indexed_count += len(chunk)
+                if time() - c_time > PROGRESS_INTERVAL:
+                    c_time = time()
+                    print("    Indexed %s of %s tags" %
+                          (indexed_count, len(rows)))
+
+                if self.stop_indexing:
+                    return False
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        return True
+
+    def _read_references(self, tag_path):
+        try:
+            return read_tag_references(
+                self.handler, self.tagsdir.joinpath(tag_path))
+        except Exception:
+            print(format_exc())
+            print("    Could not index references in '%s'" % tag_path)
+        return ()
+
+    def _store_references(self, conn, all_references):
+        '''
+        Replaces the stored references of each tag with the given ones and
+        marks them as indexed. all_references is an iterable of
+        (tag_key, references) tuples, and is stored in one transaction.
+        '''
+        with self._lock, conn:
+            for tag_key, references in all_references:
+                conn.execute("DELETE FROM refs WHERE tag_key = ?", (tag_key, ))
+                conn.executemany(
+                    "INSERT INTO refs VALUES (?, ?, ?, ?, ?)",
+                    [(tag_key, block_path, ref_path, ext,
+                      self.get_key(ref_path + ext))
+                     for block_path, ref_path, ext in references])
+                conn.execute("UPDATE tags SET refs_indexed = 1 WHERE key = ?",
+                             (tag_key, ))
+
+    def update_tag(self, tag_path, references):
+        '''
+        Updates the index entry of a single tag, such as after it has been
+        saved, using the given list of references rather than reloading it.
+        '''
+        tag_path = os.path.relpath(self.tagsdir.joinpath(tag_path), self.tagsdir)
+        filepath = self.tagsdir.joinpath(tag_path)
+        tag_key = self.get_key(tag_path)
+        try:
+            stat = filepath.stat()
+            def_id = self.handler.get_def_id(filepath)
+        except Exception:
+            print(format_exc())
+            return
+
+        with self._lock, closing(self.connect()) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, 0)",
+                    (tag_key, tag_path, def_id,
+                     stat.st_size, stat.st_mtime_ns))
+            self._store_references(conn, [(tag_key, references)])
+
+    def get_referencing_tags(self, tag_path):
+        '''
+        Returns a sorted list of (tag_path, block_path) tuples for each tag
+        reference in the index that points to the given tag. The index
+        should be refreshed and its references indexed before calling this.
+        '''
+        tag_path = Path(tag_path)
+        ref_keys = [self.get_key(tag_path)]
+        if (getattr(self.handler, "treat_mode_as_mod2", False) and
+                tag_path.suffix.lower() == ".gbxmodel" and
+                not self.tagsdir.joinpath(tag_path.with_suffix(".model")).is_file()):
+            # model references are treated as gbxmodel references
+            # when the model doesnt exist, so include those as well.
+            ref_keys.append(self.get_key(tag_path.with_suffix(".model")))
+
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT tags.path, refs.block_path FROM refs "
+                "JOIN tags ON tags.key = refs.tag_key "
+                "WHERE refs.ref_key IN (%s) ORDER BY refs.rowid" %
+                ", ".join("?" * len(ref_keys)), ref_keys).fetchall()
+
+        return sorted((Path(path), block_path) for path, block_path in rows)
+
+    def get_references(self, tag_path):
+        '''
+        Returns a list of (block_path, filepath, extension) tuples for each
+        non-empty tag reference in the tag, in the order they occur in it.
+        '''
+        tag_key = self.get_key(tag_path)
+        self.index_references((tag_path, ))
+        with closing(self.connect()) as conn:
+            return [tuple(row) for row in conn.execute(
+                "SELECT block_path, ref_path, ref_ext FROM refs "
+                "WHERE tag_key = ? ORDER BY rowid", (tag_key, ))]
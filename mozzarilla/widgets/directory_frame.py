@@ -11,14 +11,72 @@
 import tkinter as tk
 
 from pathlib import Path, PureWindowsPath
+from queue import Queue, Empty
 from sys import platform
+from threading import Thread
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
 
+from mozzarilla.tag_index import get_tag_references_by_path
+
 # inject this default color
 BinillaWidget.active_tags_directory_color = '#%02x%02x%02x' % (40, 170, 80)
 
+# number of items inserted into the tree between each ui update
+TREE_INSERT_BATCH_SIZE = 200
+
+# milliseconds between checking for finished directory listings
+LISTING_POLL_INTERVAL = 50
+
+# number of items in each page of a folder in the directory frame
+TREE_PAGE_SIZE = 500
+
+# max number of pages of a folder that are in the tree at once
+TREE_MAX_PAGES = 2
+
+
+def format_filesize(filesize):
+    if filesize < 1024:
+        return "%d Bytes" % (filesize)
+    elif filesize < 1024**2:
+        return "%.2f KiB" % (filesize/1024)
+    return "%.2f MiB" % (filesize/1024**2)
+
+
+def get_directory_listing(directory):
+    '''
+    Returns a list of (name, path, info, is_dir) tuples for the folders
+    and then the files in the directory, each sorted case insensitively.
+    The directory is scanned once, using the stat results os.scandir
+    returns, and each folder in it is scanned to count its items.
+    '''
+    subdirs = []
+    files = []
+    for entry in os.scandir(directory):
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            try:
+                info = "%s items" % sum(1 for _ in os.scandir(entry.path))
+            except OSError:
+                info = 'ERROR'
+            subdirs.append((entry.name, entry.path, info, True))
+            continue
+
+        try:
+            info = format_filesize(entry.stat().st_size)
+        except Exception:
+            info = 'ERROR'
+        files.append((entry.name, entry.path, info, False))
+
+    subdirs.sort(key=lambda row: row[0].casefold())
+    files.sort(key=lambda row: row[0].casefold())
+    return subdirs + files
+
 
 class DirectoryFrame(BinillaWidget, tk.Frame):
     app_root = None
@@ -31,7 +89,8 @@ def __init__(self, master, *args, **kwargs):
         BinillaWidget.__init__(self)
         tk.Frame.__init__(self, master, *args, **kwargs)
 
-        self.hierarchy_frame = HierarchyFrame(self, app_root=self.app_root)
+        self.hierarchy_frame = HierarchyFrame(
+            self, app_root=self.app_root, page_size=TREE_PAGE_SIZE)
 
         self.hierarchy_frame.pack(fill='both', expand=True)
         self.apply_style()
@@ -58,7 +117,32 @@ class HierarchyFrame(BinillaWidget, tk.Frame):
     tags_dir_items = ()
     active_tags_dir = ""
 
+    # maps directories to the mtime and listing they had when scanned
+    directory_cache = None
+    # directory listings finished by worker threads
+    listing_queue = None
+    # maps directories being listed to the token of the latest listing
+    _listing_tokens = None
+    _polling_listings = False
+
+    # if non-zero, only this many items of a folder are inserted at a time,
+    # with items at the start and end of the folder to load more of it.
+    page_size = 0
+    # maps directories to the [rows, start, end] of the rows in the tree
+    _page_windows = None
+    # maps the "load more" items to the directory and whether they are
+    # for loading the next page, or the previous page.
+    _page_sentinels = None
+    _checking_sentinels = False
+
     def __init__(self, master, *args, **kwargs):
+        self.directory_cache = {}
+        self.listing_queue = Queue()
+        self._listing_tokens = {}
+        self._page_windows = {}
+        self._page_sentinels = {}
+        self.page_size = kwargs.pop('page_size', self.page_size)
+
         kwargs.update(bg=self.default_bg_color, bd=self.listbox_depth,
             relief='sunken', highlightthickness=0)
         kwargs.setdefault('app_root', master)
@@ -76,7 +160,7 @@ def __init__(self, master, *args, **kwargs):
         self.scrollbar_y = tk.Scrollbar(
             self.tags_tree_frame, orient='vertical',
             command=self.tags_tree.yview)
-        self.tags_tree.config(yscrollcommand=self.scrollbar_y.set)
+        self.tags_tree.config(yscrollcommand=self.tree_scrolled)
 
         self.tags_tree.bind('<<TreeviewOpen>>', self.open_selected)
         self.tags_tree.bind('<<TreeviewClose>>', self.close_selected)
@@ -158,49 +242,207 @@ def destroy_subitems(self, directory):
         '''
         dir_tree = self.tags_tree
 
+        # stop any listing of this directory that is still in progress
+        self.forget_listings(directory)
         for child in dir_tree.get_children(directory):
             dir_tree.delete(child)
 
         # add an empty node to make an "expand" button appear
         dir_tree.insert(directory, 'end')
 
+    def forget_listings(self, directory):
+        '''
+        Forgets any listing in progress and the pages loaded of the
+        directory and every directory in it, as their items are removed.
+        '''
+        directory = str(directory)
+        prefix = os.path.join(directory, "")
+        for listings in (self._listing_tokens, self._page_windows):
+            for key in tuple(listings):
+                if key == directory or key.startswith(prefix):
+                    del listings[key]
+
+        for sentinel, (key, _) in tuple(self._page_sentinels.items()):
+            if key == directory or key.startswith(prefix):
+                del self._page_sentinels[sentinel]
+
     def generate_subitems(self, directory):
+        '''
+        Lists the directory on a worker thread, and inserts its
+        contents into the tree in batches once the listing is done.
+        '''
+        directory = str(directory)
+        token = self._listing_tokens[directory] = object()
+        self.tags_tree.insert(directory, 'end', text="Loading...")
+
+        listing_thread = Thread(target=self.list_directory,
+                                args=(directory, token))
+        listing_thread.daemon = True
+        listing_thread.start()
+
+        if not self._polling_listings:
+            self._polling_listings = True
+            self.after(LISTING_POLL_INTERVAL, self.poll_listings)
+
+    def list_directory(self, directory, token):
+        '''
+        Gets the listing of the directory, only scanning it if it has
+        changed since it was last scanned, and queues it to be inserted.
+        '''
+        rows = ()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            cached = self.directory_cache.get(directory)
+            if cached is None or cached[0] != mtime:
+                cached = self.directory_cache[directory] = (
+                    mtime, get_directory_listing(directory))
+            rows = cached[1]
+        except Exception:
+            print(format_exc())
+
+        self.listing_queue.put((directory, token, rows))
+
+    def poll_listings(self):
+        while True:
+            try:
+                directory, token, rows = self.listing_queue.get_nowait()
+            except Empty:
+                break
+
+            self.insert_listing(directory, token, rows)
+
+        if self._listing_tokens:
+            self.after(LISTING_POLL_INTERVAL, self.poll_listings)
+        else:
+            self._polling_listings = False
+
+    def insert_listing(self, directory, token, rows, start=0):
+        '''
+        Inserts a batch of the rows of a directory listing into the
+        tree, and schedules inserting the next batch after the ui updates.
+        '''
         dir_tree = self.tags_tree
+        if self._listing_tokens.get(directory) is not token:
+            # the directory was collapsed or relisted since
+            return
+        elif not dir_tree.exists(directory):
+            # the directory was removed from the tree
+            del self._listing_tokens[directory]
+            return
 
-        directory = str(directory)
-        for root, subdirs, files in os.walk(directory):
-            for subdir in sorted(subdirs, key=str.casefold):
-                folderpath = os.path.join(root, subdir)
-
-                dir_info_str = "%s items" % len(list(os.scandir(folderpath)))
-
-                dir_tree.insert(
-                    directory, 'end', text=subdir,
-                    iid=folderpath, tags=('item',),
-                    values=(dir_info_str, ))
-
-                # loop over each of the new items, give them
-                # at least one item so they can be expanded.
-                self.destroy_subitems(folderpath)
-
-            for file in sorted(files, key=str.casefold):
-                fullpath = os.path.join(root, file)
-                try:
-                    filesize = os.stat(fullpath).st_size
-                    if filesize < 1024:
-                        filesize = "%d Bytes" % (filesize)
-                    elif filesize < 1024**2:
-                        filesize = "%.2f KiB" % (filesize/1024)
-                    else:
-                        filesize = "%.2f MiB" % (filesize/1024**2)
-                except Exception:
-                    filesize = 'ERROR'
-                dir_tree.insert(directory, 'end', text=file,
-                                iid=fullpath, tags=('item',),
-                                values=(filesize, ))
-
-            # just do the toplevel of the hierarchy
-            break
+        if start == 0:
+            for child in dir_tree.get_children(directory):
+                dir_tree.delete(child)
+
+        stop = len(rows)
+        if self.page_size:
+            stop = min(stop, self.page_size)
+
+        end = min(start + TREE_INSERT_BATCH_SIZE, stop)
+        self.insert_rows(directory, rows[start: end])
+
+        if end < stop:
+            self.after(1, self.insert_listing, directory, token, rows, end)
+            return
+
+        del self._listing_tokens[directory]
+        if stop < len(rows):
+            self._page_windows[directory] = [rows, 0, stop]
+            self.insert_page_sentinels(directory)
+
+    def insert_rows(self, directory, rows, index='end'):
+        dir_tree = self.tags_tree
+        for name, path, info, is_dir in rows:
+            dir_tree.insert(directory, index, text=name, iid=path,
+                            tags=('item',), values=(info, ))
+            if index != 'end':
+                index += 1
+
+            if is_dir:
+                # give folders an item so they can be expanded.
+                self.destroy_subitems(path)
+
+    def insert_page_sentinels(self, directory):
+        '''
+        Inserts items at the start and end of the directory for loading
+        the rows before and after the ones currently in the tree.
+        '''
+        dir_tree = self.tags_tree
+        rows, start, end = self._page_windows[directory]
+        if start > 0:
+            iid = dir_tree.insert(
+                directory, 0, text="Load previous %s items..." % start,
+                tags=('item',))
+            self._page_sentinels[iid] = (directory, False)
+
+        if end < len(rows):
+            iid = dir_tree.insert(
+                directory, 'end', tags=('item',),
+                text="Load more (%s items remaining)..." % (len(rows) - end))
+            self._page_sentinels[iid] = (directory, True)
+
+    def load_page(self, sentinel):
+        '''
+        Loads the page of rows the sentinel item is for, removing rows
+        from the other end of the directory so that no more than
+        TREE_MAX_PAGES pages of it are in the tree at once.
+        '''
+        dir_tree = self.tags_tree
+        directory, forward = self._page_sentinels.pop(sentinel)
+        window = self._page_windows.get(directory)
+        if window is None or not dir_tree.exists(directory):
+            return
+
+        for iid in dir_tree.get_children(directory):
+            if iid == sentinel or self._page_sentinels.pop(iid, None):
+                dir_tree.delete(iid)
+
+        rows, start, end = window
+        if forward:
+            new_end = min(len(rows), end + self.page_size)
+            new_start = max(start, new_end - self.page_size*TREE_MAX_PAGES)
+        else:
+            new_start = max(0, start - self.page_size)
+            new_end = min(end, new_start + self.page_size*TREE_MAX_PAGES)
+
+        for _, path, _, is_dir in rows[start: new_start] + rows[new_end: end]:
+            if is_dir:
+                self.forget_listings(path)
+            dir_tree.delete(path)
+
+        self.insert_rows(directory, rows[new_start: start], 0)
+        self.insert_rows(directory, rows[max(end, new_start): new_end])
+        window[1:] = new_start, new_end
+        self.insert_page_sentinels(directory)
+
+        # keep the first of the loaded rows in view
+        if forward and end < new_end:
+            dir_tree.see(rows[end][1])
+        elif not forward and new_start < start:
+            dir_tree.see(rows[new_start][1])
+
+    def tree_scrolled(self, first, last):
+        self.scrollbar_y.set(first, last)
+        if self._page_sentinels and not self._checking_sentinels:
+            self._checking_sentinels = True
+            self.after_idle(self.check_page_sentinels)
+
+    def check_page_sentinels(self):
+        '''
+        Loads the pages of any "load more" items scrolled into view.
+        '''
+        self._checking_sentinels = False
+        dir_tree = self.tags_tree
+        for sentinel in tuple(self._page_sentinels):
+            if sentinel not in self._page_sentinels:
+                continue
+            elif not dir_tree.exists(sentinel):
+                # the directory was collapsed or removed from the tree
+                directory, _ = self._page_sentinels.pop(sentinel)
+                if not dir_tree.exists(directory):
+                    self.forget_listings(directory)
+            elif dir_tree.bbox(sentinel):
+                self.load_page(sentinel)
 
     def get_item_tags_dir(self, iid):
         '''Returns the tags directory of the given item'''
@@ -221,6 +463,7 @@ def open_selected(self, e=None):
             dir_tree.delete(child)
 
         if tag_path:
+            self.forget_listings(tag_path)
             self.generate_subitems(tag_path)
 
     def close_selected(self, e=None):
@@ -257,6 +500,9 @@ def activate_item(self, e=None):
         tag_path = dir_tree.focus()
         if tag_path is None:
             return
+        elif tag_path in self._page_sentinels:
+            self.load_page(tag_path)
+            return
 
         try:
             app = self.app_root
@@ -289,7 +535,12 @@ class DependencyFrame(HierarchyFrame):
     _initialized = False
     handler = None
 
+    # maps each handler to a dict mapping tag filepaths
+    # to the mtime and dependencies they had when read
+    dependency_caches = None
+
     def __init__(self, master, *args, **kwargs):
+        self.dependency_caches = {}
         HierarchyFrame.__init__(self, master, *args, **kwargs)
         self.handler = self.app_root.handler
         self._initialized = True
@@ -334,27 +585,49 @@ def reload(self):
         self.destroy_subitems(iid)
 
     def get_dependencies(self, tag_path):
-        tag = self.master.get_tag(tag_path)
-        if tag is None:
+        try:
+            return get_tag_references_by_path(self.handler, tag_path)
+        except Exception:
             print(("Unable to load '%s'.\n" % tag_path) +
                   "    You may need to change the tag set to load this tag.")
             return ()
 
-        handler = self.handler
-        d_id = tag.def_id
-        dependency_cache = handler.tag_ref_cache.get(d_id)
-
-        if not dependency_cache:
+    def get_cached_dependencies(self, tag_path):
+        '''
+        Returns the dependencies of the tag, only reading them
+        if the tag has changed since they were last read.
+        '''
+        try:
+            mtime = Path(tag_path).stat().st_mtime_ns
+        except OSError:
             return ()
 
-        dependencies = []
+        cache = self.dependency_caches.setdefault(self.handler, {})
+        cached = cache.get(str(tag_path))
+        if cached is None or cached[0] != mtime:
+            cached = cache[str(tag_path)] = (
+                mtime, self.get_dependencies(tag_path))
 
-        for block in handler.get_nodes_by_paths(dependency_cache, tag.data):
-            # if the node's filepath is empty, just skip it
-            if not block.filepath:
-                continue
-            dependencies.append(block)
-        return dependencies
+        return cached[1]
+
+    def may_have_dependencies(self, tag_path):
+        '''
+        Returns whether the tag might have dependencies without reading
+        it. Tags that havent been read yet are assumed to have some,
+        unless their tag type cant contain any tag references.
+        '''
+        try:
+            mtime = Path(tag_path).stat().st_mtime_ns
+        except OSError:
+            return False
+
+        cache = self.dependency_caches.get(self.handler, {})
+        cached = cache.get(str(tag_path))
+        if cached is not None and cached[0] == mtime:
+            return bool(cached[1])
+
+        def_id = self.handler.get_def_id(str(tag_path))
+        return self.handler.tag_ref_cache.get(def_id) is not None
 
     def destroy_subitems(self, iid):
         '''
@@ -366,11 +639,12 @@ def destroy_subitems(self, iid):
         for child in dir_tree.get_children(iid):
             dir_tree.delete(child)
 
-        # add an empty node to make an "expand" button appear
+        # add an empty node to make an "expand" button appear. the
+        # dependencies arent read until the item is actually expanded.
         tag_path = Path(dir_tree.item(iid)['values'][-1])
         if not tag_path.is_file():
             dir_tree.item(iid, tags=('badref', 'item'))
-        elif self.get_dependencies(tag_path):
+        elif self.may_have_dependencies(tag_path):
             dir_tree.insert(iid, 'end')
 
     def close_selected(self, e=None):
@@ -387,39 +661,17 @@ def generate_subitems(self, parent_iid):
         if not parent_tag_path.is_file():
             return
 
-        for tag_ref_block in self.get_dependencies(parent_tag_path):
-            filepath = Path(PureWindowsPath(tag_ref_block.filepath))
-            try:
-                ext = '.' + tag_ref_block.tag_class.enum_name
-                if (self.handler.treat_mode_as_mod2 and ext == '.model' and
-                not Path(tags_dir, str(filepath) + ".model").is_file()):
-                    ext = '.gbxmodel'
-            except Exception:
-                ext = ''
+        for block_path, filepath, ext in self.get_cached_dependencies(
+                parent_tag_path):
+            filepath = Path(PureWindowsPath(filepath))
+            if (self.handler.treat_mode_as_mod2 and ext == '.model' and
+            not Path(tags_dir, str(filepath) + ".model").is_file()):
+                ext = '.gbxmodel'
             tag_path = str(filepath) + ext
 
-            dependency_name = tag_ref_block.NAME
-            last_block = tag_ref_block
-            parent = last_block.parent
-            while parent is not None and hasattr(parent, 'NAME'):
-                name = parent.NAME
-                f_type = parent.TYPE
-                if f_type.is_array:
-                    index = parent.index(last_block)
-                    dependency_name = '[%s].%s' % (index, dependency_name)
-                elif name not in ('tagdata', 'data'):
-                    if not last_block.TYPE.is_array:
-                        name += '.'
-                    dependency_name = name + dependency_name
-                last_block = parent
-                parent = last_block.parent
-
-            # slice off the extension and the period
-            dependency_name = dependency_name.split('.', 1)[-1]
-
             iid = dir_tree.insert(
                 parent_iid, 'end', text=tag_path, tags=('item',),
-                values=(dependency_name, Path(tags_dir, tag_path)))
+                values=(block_path, Path(tags_dir, tag_path)))
 
             self.destroy_subitems(iid)
 
@@ -444,3 +696,46 @@ def activate_item(self, e=None):
             app.load_tags(filepaths=tag_path)
         except Exception:
             print(format_exc())
+
+
+class ReverseDependencyFrame(DependencyFrame):
+    '''
+    A DependencyFrame that lists the tags that reference each tag, rather
+    than the tags each tag references. The references are looked up in
+    the tag index, which must be up to date before this is reloaded.
+    '''
+    tag_index = None
+
+    def reload(self):
+        DependencyFrame.reload(self)
+        self.tags_tree.heading("dependency", text='Referencing block path')
+
+    def get_dependencies(self, tag_path):
+        if self.tag_index is None:
+            return ()
+
+        try:
+            tag_path = Path(tag_path).relative_to(self.tags_dir)
+        except ValueError:
+            return ()
+
+        return self.tag_index.get_referencing_tags(tag_path)
+
+    def may_have_dependencies(self, tag_path):
+        # looking up the referencing tags in the index is cheap enough
+        return bool(self.get_dependencies(tag_path))
+
+    def generate_subitems(self, parent_iid):
+        tags_dir = self.handler.tagsdir
+        dir_tree = self.tags_tree
+        parent_tag_path = Path(dir_tree.item(parent_iid)['values'][-1])
+
+        if not parent_tag_path.is_file():
+            return
+
+        for tag_path, block_path in self.get_dependencies(parent_tag_path):
+            iid = dir_tree.insert(
+                parent_iid, 'end', text=str(tag_path), tags=('item',),
+                values=(block_path, Path(tags_dir, tag_path)))
+
+            self.destroy_subitems(iid)
@@ -7,18 +7,25 @@
 # See LICENSE for more information.
 #
 
+import base64
+import os
 import tkinter as tk
 import weakref
+import zlib
 
 from array import array
+from pathlib import Path
+from traceback import format_exc
 
 from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.widgets.field_widgets import ContainerFrame
 from binilla.widgets.bitmap_display_frame import BitmapDisplayFrame,\
-     BitmapDisplayButton
+     BitmapDisplayButton, PhotoImageHandler, import_arbytmap
 
 from reclaimer.constants import CUBEMAP_PADDING, TYPE_NAME_MAP, FORMAT_NAME_MAP
 
+from mozzarilla.preview_cache import get_preview_cache
+
 try:
     import arbytmap
 except ImportError:
@@ -32,6 +39,265 @@
 SPRITE_RECTANGLE_TAG = "SPRITE_RECTANGLE"
 SPRITE_CENTER_TAG = "SPRITE_CENTER"
 
+# zlib level the cached preview PNGs are compressed with
+PREVIEW_PNG_COMPRESSION = 1
+
+
+def slice_pixel_data(pixel_data, offset, tex_block, fmt,
+                     width, height, depth=1, bitmap_size=None):
+    '''
+    Like arbytmap.bitmap_io.bitmap_bytes_to_array, but appends a memoryview
+    of the pixels in pixel_data rather than a copy of them, cast to the
+    typecode arbytmap unpacks the format with. The pixels are only copied
+    if arbytmap needs them padded, like 24 bit pixels or pixel data that
+    is cut short. Returns the offset of the end of the pixels.
+    '''
+    if bitmap_size is None:
+        bitmap_size = arbytmap.bitmap_io.get_pixel_bytes_size(
+            fmt, width, height, depth)
+
+    typecode = arbytmap.PACKED_TYPECODES[fmt]
+    pixels = memoryview(pixel_data)[offset: offset + bitmap_size]
+    if (len(pixels) < bitmap_size or
+            arbytmap.BITS_PER_PIXEL[fmt] in (24, 48) or
+            bitmap_size % arbytmap.PIXEL_ENCODING_SIZES[typecode]):
+        pixels.release()
+        return arbytmap.bitmap_io.bitmap_bytes_to_array(
+            pixel_data, offset, tex_block, fmt,
+            width, height, depth, bitmap_size)
+
+    tex_block.append(pixels.cast(typecode))
+    return offset + bitmap_size
+
+
+def get_pixel_arrays(tex_block):
+    '''
+    Returns a copy of the tex_block with any memoryviews in it
+    copied to arrays, so arbytmap can modify and replace them.
+    '''
+    pixel_arrays = []
+    for pixels in tex_block:
+        if isinstance(pixels, memoryview):
+            pixel_array = array(pixels.format)
+            pixel_array.frombytes(pixels.cast("B"))
+            pixels = pixel_array
+
+        pixel_arrays.append(pixels)
+
+    return pixel_arrays
+
+
+class LazyTexture:
+    '''
+    The (tex_block, tex_info) pair of a bitmap in a tag, whose pixels
+    arent extracted from the tag until they're needed. Indexing it like
+    a tuple copies every mipmap and face out of the tag, whereas
+    get_pixels and get_mipmap return memoryviews of them where they can.
+    The extracted pixels arent kept, so holding one of these for every
+    bitmap in a tag takes next to nothing.
+    '''
+    def __init__(self, display_base, tag, bitmap_index, tex_info):
+        self.display_base = display_base
+        self.tag = tag
+        self.bitmap_index = bitmap_index
+        self.tex_info = tex_info
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        if index in (0, -2):
+            return get_pixel_arrays(self.get_pixels())
+        elif index in (1, -1):
+            return self.tex_info
+        raise IndexError("LazyTexture index out of range")
+
+    def __iter__(self):
+        yield get_pixel_arrays(self.get_pixels())
+        yield self.tex_info
+
+    def get_pixels(self, mip_levels=None):
+        '''
+        Returns the tex_block of the given mip levels, or all of them if
+        mip_levels is None. Each mip level has the pixels of each face,
+        as memoryviews of the tag's pixel data where they can be.
+        '''
+        return self.display_base.get_texture_pixels(
+            self.bitmap_index, self.tag, mip_levels)
+
+    def get_mipmap(self, mip_level):
+        '''
+        Returns a (tex_block, tex_info) pair of a texture
+        made from only the faces of the given mip level.
+        '''
+        tex_info = self.tex_info
+        face_count = tex_info.get("sub_bitmap_count", 1)
+        tex_count = (tex_info.get("mipmap_count", 0) + 1)*face_count
+        start = mip_level*face_count
+
+        mip_info = self.display_base.get_mipmap_tex_info(tex_info, mip_level)
+        for key, value in tex_info.items():
+            # palettes and such are listed for each mipmap and face
+            if isinstance(value, list) and len(value) == tex_count:
+                mip_info[key] = value[start: start + face_count]
+
+        return self.get_pixels((mip_level, )), mip_info
+
+
+class CachedPhotoImageHandler(PhotoImageHandler):
+    '''
+    A PhotoImageHandler for a LazyTexture, which only extracts and decodes
+    the mipmaps whose images are asked for. The PNGs the images are made
+    from are kept in the preview cache, and are made from the cache when
+    they're in it rather than deswizzling and decoding the mipmap again.
+    The whole texture is only loaded into arbytmap if arby is used.
+    '''
+    texture = None
+    # the tag path, mtime, bitmap index, and a tuple of anything else the
+    # images are cached under, or None if the images shouldnt be cached.
+    cache_key = None
+    _arby = None
+
+    def __init__(self, texture, temp_path="", cache_key=None):
+        if not import_arbytmap():
+            raise ValueError(
+                "Arbytmap is not loaded. Cannot generate PhotoImages.")
+        self.texture = texture
+        self.cache_key = cache_key
+        self._images = {}
+        self.channels = dict(A=False, L=True, R=True, G=True, B=True)
+        self.temp_path = temp_path
+
+    @property
+    def arby(self):
+        # only extract every mipmap if something needs the whole texture
+        if self._arby is None:
+            self._arby = arbytmap.Arbytmap()
+            self._arby.load_new_texture(
+                texture_block=self.texture[0],
+                texture_info=self.texture.tex_info)
+        return self._arby
+
+    def load_images(self, mip_levels="all", sub_bitmap_indexes="all"):
+        if not self.temp_path:
+            raise ValueError("Cannot create PhotoImages without a specified "
+                             "temporary filepath to save their PNG's to.")
+
+        if not sub_bitmap_indexes and not mip_levels:
+            return {}
+
+        if sub_bitmap_indexes == "all":
+            sub_bitmap_indexes = range(self.max_sub_bitmap + 1)
+        elif isinstance(sub_bitmap_indexes, int):
+            sub_bitmap_indexes = (sub_bitmap_indexes, )
+
+        if mip_levels == "all":
+            mip_levels = range(self.max_mipmap + 1)
+        elif isinstance(mip_levels, int):
+            mip_levels = (mip_levels, )
+
+        c = frozenset((k, v) for k, v in self.channels.items())
+        new_images = {}
+        for m in mip_levels:
+            pngs = self.get_mipmap_pngs(m, sub_bitmap_indexes)
+            if pngs is None:
+                return {}
+
+            for b, png in zip(sub_bitmap_indexes, pngs):
+                image = tk.PhotoImage(data=base64.b64encode(png))
+                self._images[(b, m, c)] = new_images[(b, m, c)] = image
+
+        return new_images
+
+    def get_mipmap_pngs(self, mip_level, sub_bitmap_indexes):
+        '''
+        Returns a list of the PNGs of the faces of the mip level, or None
+        if they couldnt be made. Only that mip level is extracted, and
+        its PNGs are only made if they arent in the preview cache.
+        '''
+        # the pixels are only copied out of the tag if they're decoded
+        tex_block, tex_info = self.texture.get_mipmap(mip_level)
+
+        cache = get_preview_cache()
+        keys = ()
+        if self.cache_key is not None:
+            checksum = 0
+            for pixels in tex_block:
+                checksum = zlib.crc32(pixels, checksum)
+
+            channels = tuple(sorted(self.channels.items()))
+            tag_path, mtime, bitmap_index, extra = self.cache_key
+            keys = [cache.make_key(tag_path, mtime, bitmap_index, mip_level,
+                                   b, extra + (checksum, ), channels,
+                                   self.channel_mapping)
+                    for b in sub_bitmap_indexes]
+            pngs = [cache.get(key) for key in keys]
+            if None not in pngs:
+                return pngs
+
+        try:
+            arby = arbytmap.Arbytmap()
+            arby.load_new_texture(texture_block=get_pixel_arrays(tex_block),
+                                  texture_info=tex_info)
+            filepaths = arby.save_to_file(
+                output_path=self.temp_path, ext="png",
+                png_compress_level=PREVIEW_PNG_COMPRESSION,
+                bitmap_indexes=sub_bitmap_indexes,
+                keep_alpha=self.channels.get("A"), mip_levels="all",
+                channel_mapping=self.channel_mapping,
+                intensity_to_rgb=True, swizzle_mode=False,
+                tile_mode=False)
+        except TypeError:
+            print(format_exc())
+            print("Could not load texture.")
+            # no texture loaded(probably)
+            return None
+        except Exception:
+            print(format_exc())
+            return None
+
+        pngs = []
+        for filepath in filepaths:
+            with open(filepath, "rb") as f:
+                pngs.append(f.read())
+
+            try:
+                os.remove(filepath)
+            except Exception:
+                pass
+
+        for key, png in zip(keys, pngs):
+            cache.put(key, png)
+
+        return pngs
+
+    @property
+    def tex_info(self): return self.texture.tex_info
+    @property
+    def tex_type(self): return self.tex_info["texture_type"]
+    @property
+    def tex_format(self): return self.tex_info["format"]
+    @property
+    def max_sub_bitmap(self):
+        return self.tex_info.get("sub_bitmap_count", 1) - 1
+    @property
+    def max_mipmap(self): return self.tex_info.get("mipmap_count", 0)
+    @property
+    def channel_count(self):
+        fmt = self.tex_format
+        if fmt in arbytmap.THREE_CHANNEL_FORMATS:
+            return 3
+        return arbytmap.CHANNEL_COUNTS[fmt]
+
+    def mip_width(self, mip_level):
+        return max(self.tex_info["width"] // (1<<mip_level), 1)
+
+    def mip_height(self, mip_level):
+        return max(self.tex_info["height"] // (1<<mip_level), 1)
+
+    def mip_depth(self, mip_level):
+        return max(self.tex_info.get("depth", 1) // (1<<mip_level), 1)
+
 
 class HaloBitmapDisplayBase:
     cubemap_padding = CUBEMAP_PADDING
@@ -68,7 +334,7 @@ def is_xbox_bitmap(self, bitmap):
         except AttributeError:
             return False
 
-    def get_bitmap_pixels(self, bitmap_index, tag):
+    def get_bitmap_pixels(self, bitmap_index, tag, mip_levels=None):
         bitmap = tag.data.tagdata.bitmaps.STEPTREE[bitmap_index]
         is_xbox = self.is_xbox_bitmap(bitmap)
         is_meta_tag = not hasattr(tag, "tags_dir")
@@ -95,11 +361,20 @@ def get_bitmap_pixels(self, bitmap_index, tag):
             for j in range(j_max):
                 if is_xbox: mw, mh, md = arbytmap.get_mipmap_dimensions(w, h, d, j)
 
-                if fmt == arbytmap.FORMAT_P8_BUMP:
-                    tex_block.append(array('B', pixel_data[off: off + mw*mh]))
+                mip = j if is_xbox else i
+                if mip_levels is not None and mip not in mip_levels:
+                    # skip over the mip levels that werent asked for
+                    if fmt == arbytmap.FORMAT_P8_BUMP:
+                        off += mw*mh
+                    else:
+                        off += arbytmap.bitmap_io.get_pixel_bytes_size(
+                            fmt, mw, mh, md)
+                elif fmt == arbytmap.FORMAT_P8_BUMP:
+                    tex_block.append(
+                        memoryview(pixel_data)[off: off + mw*mh])
                     off += len(tex_block[-1])
                 else:
-                    off = arbytmap.bitmap_io.bitmap_bytes_to_array(
+                    off = slice_pixel_data(
                         pixel_data, off, tex_block, fmt, mw, mh, md)
 
             # skip the xbox alignment padding to get to the next texture
@@ -109,6 +384,35 @@ def get_bitmap_pixels(self, bitmap_index, tag):
 
         return tex_block
 
+    def get_texture_pixels(self, bitmap_index, tag, mip_levels=None):
+        '''
+        Returns the pixels of the given mip levels of the bitmap, or all of
+        them if mip_levels is None, ordered mip level first like arbytmap
+        expects them. Mip levels that arent asked for arent extracted.
+        '''
+        tex_block = self.get_bitmap_pixels(bitmap_index, tag, mip_levels)
+        bitmap = tag.data.tagdata.bitmaps.STEPTREE[bitmap_index]
+        if self.is_xbox_bitmap(bitmap) and bitmap.type.enum_name == "cubemap":
+            template = tuple(tex_block)
+            i = 0
+            for f in (0, 2, 1, 3, 4, 5):
+                for m in range(0, len(template), 6):
+                    tex_block[m + f] = template[i]
+                    i += 1
+
+        return tex_block
+
+    def get_mipmap_tex_info(self, tex_info, mip_level):
+        '''
+        Returns a copy of the tex_info for a texture
+        made from only one mip level of the bitmap.
+        '''
+        width, height, depth = arbytmap.get_mipmap_dimensions(
+            tex_info["width"], tex_info["height"], tex_info.get("depth", 1),
+            mip_level)
+        return dict(tex_info, width=width, height=height, depth=depth,
+                    mipmap_count=0)
+
     def get_textures(self, tag):
         if tag is None: return ()
 
@@ -138,16 +442,8 @@ def get_textures(self, tag):
                     palette=[p8_palette.p8_palette_32bit_packed]*mipmap_count,
                     palette_packed=True, indexing_size=8)
 
-            tex_block = self.get_bitmap_pixels(i, tag)
-            if self.is_xbox_bitmap(b) and typ == "CUBE":
-                template = tuple(tex_block)
-                i = 0
-                for f in (0, 2, 1, 3, 4, 5):
-                    for m in range(0, (b.mipmaps + 1)*6, 6):
-                        tex_block[m + f] = template[i]
-                        i += 1
-
-            textures.append((tex_block, tex_info))
+            # the pixels are only extracted once they're previewed
+            textures.append(LazyTexture(self, tag, i, tex_info))
 
         return textures
 
@@ -160,6 +456,40 @@ class HaloBitmapDisplayFrame(BitmapDisplayFrame):
         (-1,  3),
         )
 
+    @property
+    def active_image_handler(self):
+        b = self.bitmap_index.get()
+        if b not in range(len(self.textures)) or not import_arbytmap():
+            return None
+        elif b not in self._image_handlers:
+            # make a new PhotoImageHandler if one doesnt exist already.
+            # only the displayed bitmap's images are kept, as the others
+            # can be quickly remade from the preview cache if needed.
+            self._image_handlers.clear()
+            self._image_handlers[b] = CachedPhotoImageHandler(
+                self.textures[b], self.temp_dir,
+                self.get_preview_cache_key(b))
+
+        return self._image_handlers[b]
+
+    def get_preview_cache_key(self, bitmap_index):
+        '''
+        Returns the start of the key the previews of the bitmap are cached
+        under, or None if the tag isnt saved anywhere. A checksum of each
+        mipmap's pixels is added to this, so unsaved changes arent hidden.
+        '''
+        try:
+            filepath = Path(self.bitmap_tag.filepath)
+            mtime = filepath.stat().st_mtime_ns
+        except Exception:
+            return None
+
+        tex_info = self.textures[bitmap_index][1]
+        return filepath, mtime, bitmap_index, tuple(
+            tex_info.get(name) for name in (
+                "width", "height", "depth", "format", "texture_type",
+                "sub_bitmap_count", "swizzled", "mipmap_count", "tiled"))
+
     def __init__(self, master, bitmap_tag=None, *args, **kwargs):
         self.bitmap_tag = bitmap_tag
         textures = kwargs.get('textures', ())
@@ -7,9 +7,13 @@
 # See LICENSE for more information.
 #
 
+from functools import partial
+from math import ceil, log
+
 from binilla.widgets.bitmap_display_frame import BitmapDisplayFrame
 from mozzarilla.widgets.field_widgets.halo_1_bitmap_display import \
-     HaloBitmapDisplayFrame, HaloBitmapDisplayButton, HaloBitmapTagFrame
+     HaloBitmapDisplayFrame, HaloBitmapDisplayButton, HaloBitmapTagFrame,\
+     slice_pixel_data
 from reclaimer.constants import TYPE_NAME_MAP, FORMAT_NAME_MAP
 from reclaimer.h3.util import get_virtual_dimension, get_h3_pixel_bytes_size
 
@@ -19,6 +23,20 @@
     arbytmap = None
 
 
+def get_mipmap_virtual_dimension(bitm_fmt, dim, mip_level=0, tiled=False,
+                                 first_mip_level=0):
+    '''
+    get_virtual_dimension for a texture made from the mip levels of a
+    bitmap starting at first_mip_level, since only the first mip level
+    of a tiled bitmap isnt padded to a power of 2.
+    '''
+    dim = get_virtual_dimension(bitm_fmt, dim, mip_level, tiled)
+    if tiled and mip_level + first_mip_level != 0:
+        dim = 2**int(ceil(log(dim, 2.0)))
+
+    return dim
+
+
 class Halo3BitmapDisplayFrame(HaloBitmapDisplayFrame):
     cubemap_cross_mapping = BitmapDisplayFrame.cubemap_cross_mapping
 
@@ -43,7 +61,7 @@ class Halo3BitmapDisplayButton(HaloBitmapDisplayButton):
     def get_base_address(self, tag):
         return 0
 
-    def get_bitmap_pixels(self, bitmap_index, tag):
+    def get_bitmap_pixels(self, bitmap_index, tag, mip_levels=None):
         bitmap = tag.data.tagdata.bitmaps.STEPTREE[bitmap_index]
         is_meta_tag = not hasattr(tag, "tags_dir")
 
@@ -71,13 +89,30 @@ def get_bitmap_pixels(self, bitmap_index, tag):
 
         for i in range(mipmap_count):
             pixel_data_size = get_h3_pixel_bytes_size(fmt, w, h, d, i, tiled)
+            if mip_levels is not None and i not in mip_levels:
+                # skip over the mip levels that werent asked for
+                off += pixel_data_size*bitmap_count
+                continue
+
             for j in range(bitmap_count):
-                off = arbytmap.bitmap_io.bitmap_bytes_to_array(
+                off = slice_pixel_data(
                     pixel_data, off, tex_block, fmt,
                     1, 1, 1, pixel_data_size)
 
         return tex_block
 
+    def get_mipmap_tex_info(self, tex_info, mip_level):
+        tex_info = HaloBitmapDisplayButton.get_mipmap_tex_info(
+            self, tex_info, mip_level)
+        virtual_dimension_calc = partial(get_mipmap_virtual_dimension,
+                                         first_mip_level=mip_level)
+        tex_info.update(
+            packed_width_calc=virtual_dimension_calc,
+            packed_height_calc=virtual_dimension_calc,
+            target_packed_width_calc=virtual_dimension_calc,
+            target_packed_height_calc=virtual_dimension_calc)
+        return tex_info
+
     def get_textures(self, tag):
         textures = HaloBitmapDisplayButton.get_textures(self, tag)
 
@@ -15,7 +15,7 @@
     "ModelCompilerWindow", "physics_from_jms",
     "hud_message_text_from_hmt", "strings_from_txt",
     "AnimationsCompilerWindow", "AnimationsCompressionWindow",
-    "SoundCompilerWindow",)
+    "SoundCompilerWindow", "QuickOpenWindow",)
 
 from mozzarilla.windows.tools.sauce_removal_window import SauceRemovalWindow
 from mozzarilla.windows.tools.dependency_window import DependencyWindow
@@ -24,6 +24,7 @@
 from mozzarilla.windows.tools.bitmap_source_extractor_window import BitmapSourceExtractorWindow
 from mozzarilla.windows.tools.bitmap_converter_window import BitmapConverterWindow
 from mozzarilla.windows.tools.tag_scanner_window import TagScannerWindow
+from mozzarilla.windows.tools.quick_open_window import QuickOpenWindow
 
 from mozzarilla.windows.tools.animations_compression_window import AnimationsCompressionWindow
 from mozzarilla.windows.tools.animations_compiler_window import AnimationsCompilerWindow
@@ -9,12 +9,21 @@
 
 import ctypes
 import gc
+import io
+import mmap
 import os
+import struct
 import sys
 import tkinter as tk
 import weakref
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
 from copy import deepcopy
+from math import log
 from pathlib import Path
 from threading import Thread
 from time import time
@@ -26,7 +35,8 @@
 from reclaimer.hek.defs.bitm import bitm_def
 from reclaimer.constants import TYPE_NAME_MAP,\
     MCC_FORMAT_NAME_MAP as FORMAT_NAME_MAP,\
-    I_MCC_FORMAT_NAME_MAP as I_FORMAT_NAME_MAP
+    I_MCC_FORMAT_NAME_MAP as I_FORMAT_NAME_MAP,\
+    BITMAP_PADDING, CUBEMAP_PADDING
 
 from binilla.util import do_subprocess, ProcController
 from binilla.widgets.binilla_widget import BinillaWidget
@@ -35,6 +45,12 @@
 from mozzarilla.widgets.field_widgets import HaloBitmapDisplayFrame,\
      HaloBitmapDisplayBase
 from mozzarilla import editor_constants as e_c
+from mozzarilla.scan_cache import ScanCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 window_base_class = tk.Toplevel
 if __name__ == "__main__":
@@ -66,6 +82,47 @@
 HALO_1_TYPE_COUNT   = 4
 HALO_1_FORMAT_COUNT = 18
 
+# layout of the parts of bitmap tags read when scanning them
+BITM_BODY_OFFSET = 64
+BITM_BODY_SIZE = 108
+BITM_SEQUENCE_SIZE = 64
+BITM_SPRITE_SIZE = 32
+BITM_BITMAP_SIZE = 48
+BITM_SWIZZLED_FLAG = 1 << 3
+XBOX_BITMAP_BASE_ADDRESS = 1073751810
+
+_int32 = struct.Struct(">i")
+
+# maps each P8Palette to its palette_map as a numpy array
+_numpy_palette_maps = {}
+
+# rough number of cpu seconds converting takes, used to estimate how long
+# a conversion will take. these were measured with arbytmap's C extensions.
+# seconds per tag, and per megabyte of pixel data, to load and save it
+EST_SECONDS_PER_TAG = 0.015
+EST_SECONDS_PER_MEGABYTE = 0.006
+# seconds of overhead to convert each bitmap in a tag
+EST_SECONDS_PER_BITMAP = 0.0015
+# seconds per million pixels(including mipmaps and cubemap faces) to
+# repack them, decode them from DXT, encode them to DXT, palettize them,
+# and to downsample them or generate mipmaps from them.
+EST_REPACK_SECONDS = 0.01
+EST_DXT_DECODE_SECONDS = 0.01
+EST_DXT_ENCODE_SECONDS = 0.05
+EST_P8_SECONDS = 0.03 if numpy is not None else 0.3
+EST_MIPMAP_SECONDS = 0.02
+
+# least number of pixels worth sending to a worker process at once
+# when converting the bitmaps in a tag in parallel
+SUB_BITMAP_CHUNK_PIXELS = 1 << 16
+# number of bytes of pixel data a conversion can have waiting to be
+# converted at once, and that can be freed before garbage is collected.
+CONVERSION_MEMORY_BUDGET = 256 * 1024**2
+# number of bytes of tags freed since garbage was last collected
+_uncollected_size = 0
+# width, height, depth, type, format, flags, mipmaps, base_address
+_bitmap_block = struct.Struct(">4x3H2hH4xH22xI")
+
 
 platform = sys.platform.lower()
 if "linux" in platform:
@@ -144,6 +201,34 @@ def __init__(self, bitm_tag=None):
 
         self.platform = bitm_tag.is_xbox_bitmap
 
+    @classmethod
+    def from_cache_data(cls, data):
+        '''
+        Returns a BitmapTagInfo made from the list returned by get_cache_data.
+        '''
+        tag_info = cls()
+        (tag_info.platform, tag_info.pixel_data_size,
+         tag_info.tiff_data_size, bitmap_infos) = data
+        for bitmap_data in bitmap_infos:
+            info = BitmapInfo()
+            (info.type, info.format, info.swizzled, info.width,
+             info.height, info.depth, info.mipmaps) = bitmap_data
+            tag_info.bitmap_infos.append(info)
+
+        return tag_info
+
+    def get_cache_data(self):
+        '''
+        Returns this info as a json serializable list for storing in a
+        ScanCache. The list can be turned back into a BitmapTagInfo
+        with BitmapTagInfo.from_cache_data.
+        '''
+        return [bool(self.platform), self.pixel_data_size,
+                self.tiff_data_size,
+                [[info.type, info.format, bool(info.swizzled), info.width,
+                  info.height, info.depth, info.mipmaps]
+                 for info in self.bitmap_infos]]
+
     @property
     def type(self):
         return 0 if not self.bitmap_infos else self.bitmap_infos[0].type
@@ -155,6 +240,187 @@ def swizzled(self):
         return 0 if not self.bitmap_infos else self.bitmap_infos[0].swizzled
 
 
+def read_bitmap_tag_info(filepath):
+    '''
+    Returns a BitmapTagInfo for the bitmap tag at the filepath without
+    building the tag. The file is memory mapped and only the tag header,
+    the tagdata struct, and the sequence and bitmap blocks are read, so
+    the pixel data and color plate data are never loaded.
+    Raises ValueError if the file isnt a valid bitmap tag.
+    '''
+    with open(filepath, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        file_size = len(data)
+        if (file_size < BITM_BODY_OFFSET + BITM_BODY_SIZE or
+                data[36: 40] != b'bitm' or data[60: 64] != b'blam'):
+            raise ValueError("Not a bitmap tag: %s" % filepath)
+
+        tiff_data_size, = _int32.unpack_from(data, BITM_BODY_OFFSET + 28)
+        pixel_data_size, = _int32.unpack_from(data, BITM_BODY_OFFSET + 48)
+        sequence_count, = _int32.unpack_from(data, BITM_BODY_OFFSET + 84)
+        bitmap_count, = _int32.unpack_from(data, BITM_BODY_OFFSET + 96)
+        if min(tiff_data_size, pixel_data_size,
+               sequence_count, bitmap_count) < 0:
+            raise ValueError("Invalid bitmap tag sizes: %s" % filepath)
+
+        # the rawdata and reflexive arrays follow the tagdata struct in the
+        # order they're in it, and each sequence's sprites follow the last
+        # sequence. the bitmaps are after all of them.
+        offset = (BITM_BODY_OFFSET + BITM_BODY_SIZE +
+                  tiff_data_size + pixel_data_size)
+        sprite_count = 0
+        for i in range(sequence_count):
+            if offset + BITM_SEQUENCE_SIZE > file_size:
+                raise ValueError("Bitmap tag is truncated: %s" % filepath)
+
+            count, = _int32.unpack_from(data, offset + 52)
+            sprite_count += max(count, 0)
+            offset += BITM_SEQUENCE_SIZE
+
+        offset += sprite_count * BITM_SPRITE_SIZE
+        if offset + bitmap_count * BITM_BITMAP_SIZE > file_size:
+            raise ValueError("Bitmap tag is truncated: %s" % filepath)
+
+        tag_info = BitmapTagInfo()
+        tag_info.tiff_data_size = tiff_data_size
+        tag_info.pixel_data_size = pixel_data_size
+        for i in range(bitmap_count):
+            (width, height, depth, typ, fmt, flags,
+             mipmaps, base_address) = _bitmap_block.unpack_from(data, offset)
+            offset += BITM_BITMAP_SIZE
+
+            info = BitmapInfo()
+            info.type = typ
+            info.format = fmt
+            info.swizzled = bool(flags & BITM_SWIZZLED_FLAG)
+            info.width = width
+            info.height = height
+            info.depth = depth
+            info.mipmaps = mipmaps
+            tag_info.bitmap_infos.append(info)
+
+            if i == 0:
+                # xbox bitmaps are told apart by the first base address
+                tag_info.platform = base_address == XBOX_BITMAP_BASE_ADDRESS
+
+    return tag_info
+
+
+class ConversionEstimate:
+    '''
+    The projected result of converting a bitmap tag with a set of
+    conversion flags, as made by estimate_bitmap_conversion.
+    '''
+    converted = False
+    # size of the pixel data after converting, including padding
+    pixel_data_size = 0
+    cpu_time = 0.0
+    # (type, format, size) of the texture memory each bitmap will take up.
+    # the type and format are the tag's enum values for them.
+    texture_sizes = ()
+
+
+def get_texture_size(fmt, width, height, depth, mipmaps):
+    '''
+    Returns the number of bytes of pixel data one face
+    of a bitmap and its mipmaps take up in the given format.
+    '''
+    size = 0
+    for mip in range(mipmaps + 1):
+        w, h, d = ab.get_mipmap_dimensions(width, height, depth, mip)
+        if fmt == ab.FORMAT_P8_BUMP:
+            size += w*h*d
+        else:
+            size += ab.bitmap_io.get_pixel_bytes_size(fmt, w, h, d)
+    return size
+
+
+def get_pixel_count(width, height, depth, mipmaps):
+    return sum(w*h*d for w, h, d in (
+        ab.get_mipmap_dimensions(width, height, depth, mip)
+        for mip in range(mipmaps + 1)))
+
+
+def estimate_bitmap_conversion(conv_flags, tag_info):
+    '''
+    Returns a ConversionEstimate of the pixel data size, texture memory
+    and cpu time converting a bitmap tag with the conversion flags would
+    result in. Only the tag info is used, so no pixel data is read.
+    '''
+    estimate = ConversionEstimate()
+    estimate.texture_sizes = []
+    converting = get_will_be_converted(conv_flags, tag_info)
+    save_as_xbox = conv_flags.platform if converting else tag_info.platform
+    new_format = BITMAP_FORMATS[PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]]
+
+    for info in tag_info.bitmap_infos:
+        typ = BITMAP_TYPES[info.type]
+        fmt_s = fmt_t = BITMAP_FORMATS[info.format]
+        width, height, depth = info.width, info.height, info.depth
+        mipmaps = info.mipmaps
+        faces = 6 if typ == ab.TYPE_CUBEMAP else 1
+
+        if converting:
+            # these are the same restrictions convert_bitmap_tag uses
+            if conv_flags.new_format > 0:
+                fmt_t = new_format
+            if fmt_t == ab.FORMAT_P8_BUMP and typ in (ab.TYPE_CUBEMAP,
+                                                      ab.TYPE_3D):
+                fmt_t = fmt_s
+            elif fmt_t in ab.DDS_FORMATS and typ == ab.TYPE_3D:
+                fmt_t = fmt_s
+
+            if (fmt_s in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8) and
+                fmt_t in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8)):
+                fmt_s = fmt_t
+
+            src_pixels = faces * get_pixel_count(width, height, depth, mipmaps)
+            if conv_flags.downres:
+                width, height, depth = ab.get_mipmap_dimensions(
+                    width, height, depth, conv_flags.downres)
+                mipmaps = max(0, mipmaps - conv_flags.downres)
+
+            if conv_flags.mip_gen:
+                mipmaps = int(log(max(width, height, depth), 2))
+
+            dst_pixels = faces * get_pixel_count(width, height, depth, mipmaps)
+            cpu_time = EST_REPACK_SECONDS * src_pixels
+            if fmt_s in ab.DDS_FORMATS:
+                cpu_time += EST_DXT_DECODE_SECONDS * src_pixels
+            if fmt_t in ab.DDS_FORMATS:
+                cpu_time += EST_DXT_ENCODE_SECONDS * dst_pixels
+            if fmt_t == ab.FORMAT_P8_BUMP and fmt_s != fmt_t:
+                cpu_time += EST_P8_SECONDS * dst_pixels
+            if conv_flags.downres or conv_flags.mip_gen:
+                cpu_time += EST_MIPMAP_SECONDS * src_pixels
+
+            estimate.cpu_time += EST_SECONDS_PER_BITMAP + cpu_time / 1000000
+
+        size = get_texture_size(fmt_t, width, height, depth, mipmaps)
+        texture_size = size * faces
+        estimate.texture_sizes.append(
+            (info.type, I_FORMAT_NAME_MAP[fmt_t], texture_size))
+
+        # xbox and p8 bitmaps are padded the same way reclaimer pads them
+        if save_as_xbox or fmt_t == ab.FORMAT_P8_BUMP:
+            if faces > 1:
+                size += (CUBEMAP_PADDING - size % CUBEMAP_PADDING) % CUBEMAP_PADDING
+            texture_size = size * faces
+            texture_size += (BITMAP_PADDING - texture_size % BITMAP_PADDING) % BITMAP_PADDING
+
+        estimate.pixel_data_size += texture_size
+
+    if converting:
+        estimate.converted = True
+        estimate.cpu_time += (EST_SECONDS_PER_TAG + EST_SECONDS_PER_MEGABYTE *
+                              tag_info.pixel_data_size / 1048576)
+    else:
+        # unconverted tags keep their pixel data as is
+        estimate.pixel_data_size = tag_info.pixel_data_size
+
+    return estimate
+
+
 def get_will_be_converted(flags, tag_info):
     if flags.platform != tag_info.platform:
         return True
@@ -253,7 +519,236 @@ def get_channel_mappings(conv_flags, bitmap_info):
     return chan_map, chan_merge_map
 
 
-def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
+def get_palette_picker(p8_palette, keep_alpha=False):
+    '''
+    Returns a function that picks the closest p8 palette index for each
+    pixel of an unpacked ARGB array, for arbytmap to use as its palette
+    picker. If keep_alpha is True, fully transparent pixels are given
+    the transparent index. If numpy is available the whole array is
+    looked up at once rather than pixel by pixel.
+    '''
+    if keep_alpha:
+        picker = p8_palette.argb_array_to_p8_array_best_fit_alpha
+    else:
+        picker = p8_palette.argb_array_to_p8_array_best_fit
+
+    if numpy is None:
+        return picker
+
+    def numpy_picker(unpacked_pix):
+        if getattr(unpacked_pix, "itemsize", 1) != 1:
+            # deep color pixels. let the palette handle it
+            return picker(unpacked_pix)
+
+        if not p8_palette.palette_map_loaded:
+            p8_palette.load_palette_map()
+
+        palette_map = _numpy_palette_maps.get(p8_palette)
+        if palette_map is None:
+            palette_map = _numpy_palette_maps[p8_palette] = numpy.array(
+                p8_palette.palette_map, dtype=numpy.uint8)
+
+        pixels = numpy.frombuffer(unpacked_pix, dtype=numpy.uint8)
+        pixels = pixels.reshape(-1, 4)
+        indexing = palette_map[
+            (pixels[:, 1].astype(numpy.uint16) << 8) | pixels[:, 2]]
+        if keep_alpha:
+            indexing[pixels[:, 0] == 0] = 255
+
+        return p8_palette.p8_palette_32bit, array("B", indexing.tobytes())
+
+    return numpy_picker
+
+
+def swap_argb_channels(pixels, chan_map):
+    '''
+    Returns a copy of an array of packed 32bit ARGB pixels with its
+    channels swapped around as the channel map says to, using numpy.
+    Each channel of the result is taken from the channel of the source
+    at that index in chan_map, with channels ordered A, R, G, B.
+    '''
+    src = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(-1, 4)
+    dst = numpy.empty_like(src)
+    for dst_byte in range(4):
+        # the bytes of each pixel are in BGRA order on little endian
+        # machines, and ARGB order on big endian ones.
+        dst_chan = 3 - dst_byte if sys.byteorder == "little" else dst_byte
+        src_chan = chan_map[dst_chan]
+        src_byte = 3 - src_chan if sys.byteorder == "little" else src_chan
+        dst[:, dst_byte] = src[:, src_byte]
+
+    swapped = array(pixels.typecode)
+    swapped.frombytes(dst.tobytes())
+    return swapped
+
+
+def convert_texture(tex_block, tex_info, conv_settings, picker_args=None,
+                    extract_path="", extract_ext="", convert=True):
+    '''
+    Loads the texture into arbytmap with the conversion settings, extracts
+    it if given an extract path and extension, and converts it if convert
+    is True. If a palette picker is needed to convert, picker_args is a
+    tuple of whether to use the Stubbs p8 palette, and whether to keep
+    transparent pixels transparent when palettizing.
+    Returns a tuple of whether or not the conversion succeeded, and the
+    converted texture block, texture info, swizzled state and format.
+    '''
+    arb = ab.Arbytmap()
+    if picker_args is not None:
+        use_stubbs_p8, keep_alpha = picker_args
+        p8_palette = STUBBS_P8_PALETTE if use_stubbs_p8 else HALO_P8_PALETTE
+        conv_settings = dict(conv_settings, palette_picker=get_palette_picker(
+            p8_palette, keep_alpha))
+
+    arb.load_new_texture(texture_block=tex_block, texture_info=tex_info)
+    arb.load_new_conversion_settings(**conv_settings)
+
+    if extract_ext and extract_path:
+        arb.save_to_file(output_path=extract_path, ext=extract_ext)
+
+    success = convert and arb.convert_texture()
+    return success, arb.texture_block, arb.texture_info, arb.swizzled, arb.format
+
+
+def convert_textures_in_worker(jobs):
+    '''
+    Calls convert_texture with each tuple of arguments in jobs in a worker
+    process. Returns a list of what it returns for each job, and anything
+    printed while converting them.
+    '''
+    output = io.StringIO()
+    with redirect_stdout(output):
+        results = [convert_texture(*args) for args in jobs]
+
+    return results, output.getvalue()
+
+
+def get_texture_job_size(job):
+    '''
+    Returns the number of bytes of pixel data in a texture job.
+    '''
+    return sum(len(pixels) * getattr(pixels, "itemsize", 1)
+               for pixels in job[2][0])
+
+
+def iter_converted_textures(chunks, executor=None,
+                            memory_budget=CONVERSION_MEMORY_BUDGET):
+    '''
+    Converts the chunks of (bitmap index, face index, args) texture jobs in
+    order, and yields the bitmap index, face index, and convert_texture
+    result of each. Jobs are removed from their chunk as they're converted
+    so their source pixels can be freed as soon as the caller is done with
+    them. If given an executor, chunks are sent to its workers until the
+    pixel data waiting to be converted would exceed the memory budget.
+    '''
+    chunks.reverse()
+    if executor is None or len(chunks) < 2:
+        while chunks:
+            chunk = chunks.pop()
+            chunk.reverse()
+            while chunk:
+                i, face, args = chunk.pop()
+                result = convert_texture(*args)
+                del args
+                yield i, face, result
+        return
+
+    pending = deque()
+    pending_size = 0
+    while chunks or pending:
+        while chunks:
+            chunk_size = sum(get_texture_job_size(job) for job in chunks[-1])
+            if pending and pending_size + chunk_size > memory_budget:
+                break
+
+            chunk = chunks.pop()
+            future = executor.submit(convert_textures_in_worker,
+                                     [args for _, _, args in chunk])
+            pending.append(([job[:2] for job in chunk], chunk_size, future))
+            pending_size += chunk_size
+            del chunk
+
+        job_keys, chunk_size, future = pending.popleft()
+        pending_size -= chunk_size
+        chunk_results, output = future.result()
+        if output:
+            print(output.rstrip("\n"))
+
+        for (i, face), result in zip(job_keys, chunk_results):
+            yield i, face, result
+
+
+def collect_garbage(freed_size, memory_budget=CONVERSION_MEMORY_BUDGET):
+    '''
+    Counts the freed size towards the memory budget, and collects garbage
+    once the budget is used up. Tags reference themselves through their
+    blocks' parents, so their data isnt freed until garbage is collected,
+    but collecting after every small tag is slower than converting it.
+    Returns whether or not garbage was collected.
+    '''
+    global _uncollected_size
+    _uncollected_size += freed_size
+    if _uncollected_size < memory_budget:
+        return False
+
+    gc.collect()
+    _uncollected_size = 0
+    return True
+
+
+def split_cubemap_faces(tex_block, tex_info):
+    '''
+    Splits a cubemap into a list of (tex_block, tex_info) tuples of each
+    face and its mipmaps, so the faces can be converted separately.
+    '''
+    face_count = tex_info["sub_bitmap_count"]
+    faces = []
+    for face in range(face_count):
+        face_info = dict(tex_info, sub_bitmap_count=1,
+                         texture_type=ab.TYPE_2D)
+        # things like palettes are stored per face and mipmap, like pixels
+        for key, value in tex_info.items():
+            if isinstance(value, list) and len(value) == len(tex_block):
+                face_info[key] = value[face::face_count]
+
+        faces.append((tex_block[face::face_count], face_info))
+
+    return faces
+
+
+def join_cubemap_faces(face_results, tex_info):
+    '''
+    Joins the results of converting the faces made by split_cubemap_faces
+    back into a single result for the cubemap they were split from.
+    '''
+    success = all(result[0] for result in face_results)
+    _, face_block, face_info, swizzled, fmt = face_results[0]
+    face_count = len(face_results)
+
+    new_info = dict(face_info, sub_bitmap_count=face_count,
+                    texture_type=tex_info["texture_type"])
+    new_block = [None] * (len(face_block) * face_count)
+    for face, result in enumerate(face_results):
+        new_block[face::face_count] = result[1]
+        for key, value in result[2].items():
+            if isinstance(value, list) and len(value) == len(face_block):
+                if face == 0:
+                    new_info[key] = [None] * len(new_block)
+                new_info[key][face::face_count] = value
+
+    return success, new_block, new_info, swizzled, fmt
+
+
+def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False,
+                       executor=None, memory_budget=CONVERSION_MEMORY_BUDGET):
+    '''
+    Converts and/or extracts the bitmaps in the tag as the conversion flags
+    say to. If given a concurrent.futures executor, the bitmaps in the tag
+    and the faces of its cubemaps are split between its workers, and
+    the results are put back in the tag in order. Each bitmap is put back
+    as soon as it's converted, and no more than memory_budget bytes of
+    pixel data are sent to the workers at once.
+    '''
     for i in range(tag.bitmap_count()):
         if not tag.is_power_of_2_bitmap(i):
             return False
@@ -268,7 +763,6 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
     if not do_conversion and not extract_ext:
         return True
 
-    arb = ab.Arbytmap()
     if tag.sanitize_mipmap_counts():
         print("ERROR: Bad mipmap counts in:\n%s\t\n" % tag.filepath)
         return False
@@ -276,6 +770,9 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
     tag.parse_bitmap_blocks()
     pixel_data = tag.data.tagdata.processed_pixel_data.data
 
+    # the bitmap index, the cubemap face index(or None) and
+    # the arguments to call convert_texture with for each texture
+    jobs = []
     for i in range(tag.bitmap_count()):
         typ   = BITMAP_TYPES[tag.bitmap_type(i)]
         fmt_s = BITMAP_FORMATS[tag.bitmap_format(i)]
@@ -297,7 +794,22 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
             tex_info["format"] = fmt_s = fmt_t
 
         chan_map, chan_merge_map = get_channel_mappings(conv_flags, bitmap_info)
-        palette_picker = None
+
+        # swapping the channels of A8R8G8B8 bitmaps without changing
+        # anything else can be done directly on the pixel arrays.
+        if (numpy is not None and do_conversion and not extract_ext and
+                fmt_s == fmt_t == ab.FORMAT_A8R8G8B8 and
+                chan_map is not None and chan_merge_map is None and
+                all(0 <= chan < 4 for chan in chan_map) and
+                not conv_flags.downres and not conv_flags.mip_gen and
+                bool(tex_info["swizzled"]) == bool(conv_flags.swizzled)):
+            pixel_data[i].parse(
+                initdata=[swap_argb_channels(pixels, chan_map)
+                          for pixels in tex_block],
+                clear=False, init_attrs=False)
+            continue
+
+        picker_args = None
         palettize = (fmt_t == ab.FORMAT_P8_BUMP)
 
         p8_palette = STUBBS_P8_PALETTE if use_stubbs_p8 else HALO_P8_PALETTE
@@ -314,54 +826,151 @@ def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
                 ck_trans = True
 
         if ab.CHANNEL_COUNTS[fmt_s] == 4:
-            if not ck_trans or fmt_s in (ab.FORMAT_X8R8G8B8, ab.FORMAT_R5G6B5):
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit
-            else:
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit_alpha
-
-        arb.load_new_texture(texture_block=tex_block, texture_info=tex_info)
+            picker_args = (use_stubbs_p8, ck_trans and fmt_s not in (
+                ab.FORMAT_X8R8G8B8, ab.FORMAT_R5G6B5))
 
         # build the initial conversion settings list from the above settings
         conv_settings = dict(
             swizzle_mode=conv_flags.swizzled, palettize=palettize,
-            one_bit_bias=conv_flags.alpha_bias, palette_picker=palette_picker,
+            one_bit_bias=conv_flags.alpha_bias,
             downres_amount=conv_flags.downres, target_format=fmt_t,
             color_key_transparency=ck_trans, mipmap_gen=conv_flags.mip_gen,
             channel_mapping=chan_map, channel_merge_mapping=chan_merge_map)
 
-        arb.load_new_conversion_settings(**conv_settings)
-
+        extract_path = ""
         if extract_ext and conv_flags.extract_path:
-            path = conv_flags.extract_path
+            extract_path = conv_flags.extract_path
             if tag.bitmap_count() > 1:
-                path = os.path.join(path, str(i))
-            arb.save_to_file(output_path=path, ext=extract_ext)
+                extract_path = os.path.join(extract_path, str(i))
+
+        if (executor is not None and typ == ab.TYPE_CUBEMAP and
+                not extract_path and do_conversion):
+            # cubemap faces are converted independently of each other
+            for face, (face_block, face_info) in enumerate(
+                    split_cubemap_faces(tex_block, tex_info)):
+                jobs.append((i, face, (face_block, face_info, conv_settings,
+                                       picker_args)))
+        else:
+            jobs.append((i, None, (tex_block, tex_info, conv_settings,
+                                   picker_args, extract_path, extract_ext,
+                                   do_conversion)))
+
+    # group the jobs into chunks big enough to be worth sending to workers
+    chunks = [[]]
+    chunk_pixels = 0
+    for job in jobs:
+        if chunk_pixels >= SUB_BITMAP_CHUNK_PIXELS:
+            chunks.append([])
+            chunk_pixels = 0
+
+        chunks[-1].append(job)
+        chunk_pixels += sum(len(pixels) for pixels in job[2][0])
+
+    face_counts = {}
+    for i, face, _ in jobs:
+        face_counts[i] = face_counts.get(i, 0) + 1
+
+    # only the chunks should reference the jobs, so each job's source
+    # pixels can be freed once it's converted and put back in the tag
+    jobs = job = tex_block = None
+
+    # put each bitmap back in the tag as soon as all of it is converted,
+    # so the tag stops holding its source pixels while the rest convert.
+    face_results = {}
+    for i, face, result in iter_converted_textures(chunks, executor,
+                                                   memory_budget):
+        if not do_conversion:
+            continue
+        elif face is not None:
+            face_results.setdefault(i, []).append(result)
+            if len(face_results[i]) < face_counts[i]:
+                continue
+            result = join_cubemap_faces(face_results.pop(i), tag.tex_infos[i])
 
-        if do_conversion:
-            success = arb.convert_texture()
-            tag.tex_infos[i] = arb.texture_info  # tex_info may have changed
+        success, tex_block, tex_info, swizzled, fmt = result
+        del result
+        tag.tex_infos[i] = tex_info  # tex_info may have changed
 
-            if success:
-                tex_root = pixel_data[i]
-                tex_root.parse(initdata=arb.texture_block,
-                               clear=False, init_attrs=False)
-                tag.swizzled(i, arb.swizzled)
+        if success:
+            tex_root = pixel_data[i]
+            tex_root.parse(initdata=tex_block,
+                           clear=False, init_attrs=False)
+            tag.swizzled(i, swizzled)
 
-                #change the bitmap format to the new format
-                tag.bitmap_format(i, I_FORMAT_NAME_MAP[arb.format])
-            else:
-                print("Error occurred while converting:\n\t%s\n" % tag.filepath)
-                return False
+            #change the bitmap format to the new format
+            tag.bitmap_format(i, I_FORMAT_NAME_MAP[fmt])
+        else:
+            print("Error occurred while converting:\n\t%s\n" % tag.filepath)
+            return False
+
+        del tex_block
+
+    if not do_conversion:
+        return True
+
+    tag.sanitize_bitmaps()
+    tag.set_platform(conv_flags.platform)
+    tag.add_bitmap_padding(conv_flags.platform)
+    tag.fix_top_format()
+
+    return True
+
+
+def process_bitmap_tag(filepath, conv_flags, bitmap_info, use_stubbs_p8=False,
+                       backup=True, tag_def=bitm_def, executor=None,
+                       memory_budget=CONVERSION_MEMORY_BUDGET):
+    '''
+    Prunes, converts, and/or extracts the bitmap tag at the filepath as its
+    conversion flags say to, and saves it if it was changed. If given an
+    executor, the bitmaps in the tag are converted in parallel with it.
+    Garbage is collected whenever the tags processed since it was last
+    collected add up to more than memory_budget bytes.
+    Returns whether or not the tag needed to be processed.
+    '''
+    pruning = conv_flags.prune_tiff
+    extracting = conv_flags.extract_to != 0
+    converting = get_will_be_converted(conv_flags, bitmap_info)
+    if not(pruning or converting or extracting):
+        return False
+
+    tag = tag_def.build(filepath=filepath)
+    if pruning:
+        tag.data.tagdata.compressed_color_plate_data.data = bytearray()
 
-    if do_conversion:
-        tag.sanitize_bitmaps()
-        tag.set_platform(conv_flags.platform)
-        tag.add_bitmap_padding(conv_flags.platform)
-        tag.fix_top_format()
+    if converting or extracting:
+        convert_bitmap_tag(tag, conv_flags, bitmap_info,
+                           use_stubbs_p8=use_stubbs_p8, executor=executor,
+                           memory_budget=memory_budget)
 
+    if converting or pruning:
+        tag.serialize(temp=False, backup=backup, calc_pointers=False)
+
+    del tag
+    collect_garbage(bitmap_info.pixel_data_size + bitmap_info.tiff_data_size,
+                    memory_budget)
     return True
 
 
+def process_bitmap_tag_in_worker(filepath, conv_flags, bitmap_info,
+                                 use_stubbs_p8=False, backup=True,
+                                 memory_budget=CONVERSION_MEMORY_BUDGET):
+    '''
+    Calls process_bitmap_tag in a worker process. Returns what it returns,
+    or None if it failed, and anything printed while processing the tag.
+    '''
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            processed = process_bitmap_tag(
+                filepath, conv_flags, bitmap_info, use_stubbs_p8, backup,
+                memory_budget=memory_budget)
+        except Exception:
+            print(format_exc())
+            processed = None
+
+    return processed, output.getvalue()
+
+
 class BitmapConverterWindow(window_base_class, BinillaWidget):
     app_root = None
     tag_list_frame = None
@@ -372,6 +981,14 @@ class BitmapConverterWindow(window_base_class, BinillaWidget):
     read_only = None
     backup_tags = None
     open_log = None
+    convert_in_parallel = None
+    convert_sub_bitmaps_in_parallel = None
+    use_scan_cache = None
+
+    # number of worker processes to convert with. None uses all cpus
+    worker_count = None
+    # bytes of pixel data each conversion can hold before collecting garbage
+    memory_budget = CONVERSION_MEMORY_BUDGET
 
     conversion_flags = ()
     bitmap_tag_infos = ()
@@ -421,6 +1038,9 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags = tk.BooleanVar(self, True)
         self.open_log = tk.BooleanVar(self, True)
         self.use_stubbs_p8 = tk.BooleanVar(self)
+        self.convert_in_parallel = tk.BooleanVar(self)
+        self.convert_sub_bitmaps_in_parallel = tk.BooleanVar(self)
+        self.use_scan_cache = tk.BooleanVar(self, True)
 
         self.scan_dir_path = tk.StringVar(self)
         self.data_dir_path = tk.StringVar(self)
@@ -517,6 +1137,15 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton = tk.Checkbutton(
             self.global_params_frame, text="Use Stubbs p8 palette �",
             variable=self.use_stubbs_p8)
+        self.convert_in_parallel_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Convert in parallel �",
+            variable=self.convert_in_parallel)
+        self.use_scan_cache_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Use scan cache �",
+            variable=self.use_scan_cache)
+        self.convert_sub_bitmaps_in_parallel_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Split bitmaps between processes �",
+            variable=self.convert_sub_bitmaps_in_parallel)
 
 
         self.read_only_cbutton.tooltip_string = (
@@ -530,6 +1159,18 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton.tooltip_string = (
             "Use Stubbs the Zombie's p8-bump palette\n"
             "instead of Halo's for P8-bump textures.")
+        self.convert_in_parallel_cbutton.tooltip_string = (
+            "Convert several bitmaps at once using worker\n"
+            "processes. Uses more memory, but is much faster\n"
+            "when converting many bitmaps on a multicore cpu.")
+        self.use_scan_cache_cbutton.tooltip_string = (
+            "Remember the scanned info of each bitmap and only\n"
+            "rescan bitmaps that changed since the last scan.")
+        self.convert_sub_bitmaps_in_parallel_cbutton.tooltip_string = (
+            "Convert the bitmaps in each tag, and the faces\n"
+            "of cubemaps, using several worker processes.\n"
+            "Speeds up converting a few tags with many bitmaps\n"
+            "or big cubemaps. Not used when converting in parallel.")
 
 
         self.platform_menu = ScrollMenu(
@@ -628,6 +1269,8 @@ def __init__(self, app_root, *args, **kwargs):
                                      command=self.scan_pressed)
         self.convert_button = tk.Button(self.buttons_frame, text="Convert",
                                         command=self.convert_pressed)
+        self.estimate_button = tk.Button(self.buttons_frame, text="Estimate",
+                                         command=self.estimate_pressed)
         self.cancel_button = tk.Button(self.buttons_frame, text="Cancel",
                                        command=self.cancel_pressed)
 
@@ -643,6 +1286,7 @@ def __init__(self, app_root, *args, **kwargs):
 
         self.scan_button.pack(side='left', expand=True, fill='both', padx=3)
         self.convert_button.pack(side='left', expand=True, fill='both', padx=3)
+        self.estimate_button.pack(side='left', expand=True, fill='both', padx=3)
         self.cancel_button.pack(side='left', expand=True, fill='both', padx=3)
 
         self.scan_dir_frame.pack(expand=True, fill='x')
@@ -668,6 +1312,10 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags_cbutton.grid(row=0, column=1, sticky='w')
         self.open_log_cbutton.grid(row=0, column=2, sticky='w')
         self.use_stubbs_p8_cbutton.grid(row=0, column=3, sticky='w')
+        self.convert_in_parallel_cbutton.grid(row=1, column=0, sticky='w')
+        self.use_scan_cache_cbutton.grid(row=1, column=1, sticky='w')
+        self.convert_sub_bitmaps_in_parallel_cbutton.grid(
+            row=1, column=2, columnspan=2, sticky='w')
 
         i = 0
         widgets = (self.platform_menu, self.format_menu, self.extract_to_menu,
@@ -750,9 +1398,13 @@ def __init__(self, app_root, *args, **kwargs):
             widgets = next_widgets
 
         self.buttons = (self.scan_dir_browse_button, self.scan_button,
-                        self.log_file_browse_button, self.convert_button)
+                        self.log_file_browse_button, self.convert_button,
+                        self.estimate_button)
         self.checkbuttons = (self.read_only_cbutton, self.backup_tags_cbutton,
-                             self.open_log_cbutton, self.use_stubbs_p8_cbutton)
+                             self.open_log_cbutton, self.use_stubbs_p8_cbutton,
+                             self.convert_in_parallel_cbutton,
+                             self.use_scan_cache_cbutton,
+                             self.convert_sub_bitmaps_in_parallel_cbutton)
         self.spinboxes = (self.downres_box, self.alpha_bias_box)
         self.menus = (self.platform_menu, self.format_menu,
                       self.extract_to_menu, self.prune_tiff_menu,
@@ -877,6 +1529,14 @@ def _scan(self):
 
             seen_files = set()  # keep track of all absolute filepaths seen
             scan_dir = self.loaded_tags_dir
+
+            scan_cache = None
+            unchanged_count = 0
+            if self.use_scan_cache.get():
+                scan_cache = ScanCache.for_directory(
+                    "bitmap_converter", Path(scan_dir).resolve())
+                scan_cache.load()
+
             for root, _, files in os.walk(scan_dir):
                 rel_root = Path(os.path.relpath(root, scan_dir))
                 root = Path(root)
@@ -906,20 +1566,66 @@ def _scan(self):
 
                     if self._cancel_processing:
                         print('Bitmap scanning cancelled.\n')
+                        if scan_cache is not None:
+                            scan_cache.save()
                         self.after(0, self.enable_settings)
                         return
 
+                    # the resolved filepath is the cache key so the same
+                    # bitmap is found no matter which way it was reached.
+                    cache_key = filepath.as_posix()
                     try:
-                        bitm_tag = self.bitm_def.build(filepath=filepath)
+                        stat = os.stat(str(filepath))
+                    except OSError:
+                        stat = None
+
+                    if scan_cache is not None and stat is not None:
+                        cache_data = scan_cache.get(cache_key, stat)
+                        if cache_data is not None:
+                            try:
+                                self.bitmap_tag_infos[rel_filepath] = \
+                                    BitmapTagInfo.from_cache_data(cache_data)
+                                unchanged_count += 1
+                                continue
+                            except Exception:
+                                # cached by an incompatible version
+                                scan_cache.discard(cache_key)
+
+                    try:
+                        tag_info = read_bitmap_tag_info(filepath)
                     except Exception:
-                        print(format_exc())
-                        bitm_tag = None
+                        # fall back to building the whole tag
+                        tag_info = None
+
+                    if tag_info is None:
+                        try:
+                            bitm_tag = self.bitm_def.build(filepath=filepath)
+                        except Exception:
+                            print(format_exc())
+                            bitm_tag = None
+
+                        if not bitm_tag:
+                            print("Could not load: %s" % filepath)
+                            continue
 
-                    if not bitm_tag:
-                        print("Could not load: %s" % filepath)
-                        continue
+                        tag_info = BitmapTagInfo(bitm_tag)
+                        del bitm_tag
+
+                    self.bitmap_tag_infos[rel_filepath] = tag_info
+                    if scan_cache is not None and stat is not None:
+                        scan_cache.set(cache_key, stat,
+                                       tag_info.get_cache_data())
+
+            if scan_cache is not None:
+                print("    %s bitmaps unchanged since the last scan." %
+                      unchanged_count)
+                # forget bitmaps that are no longer in the directory
+                seen_keys = set(fp.as_posix() for fp in seen_files)
+                for key in list(scan_cache.keys()):
+                    if key not in seen_keys:
+                        scan_cache.discard(key)
 
-                    self.bitmap_tag_infos[rel_filepath] = BitmapTagInfo(bitm_tag)
+                scan_cache.save()
 
             print("    Finished in %s seconds." % int(time() - s_time))
         except Exception:
@@ -958,50 +1664,116 @@ def _convert(self):
                 print(format_exc())
                 print("Could not create log")
 
+        elif self.convert_in_parallel.get():
+            print("Converting bitmaps in parallel...")
+            try:
+                self.convert_tags_in_parallel()
+            except Exception:
+                print(format_exc())
+
         else:
             print("Converting bitmaps...")
             tags_dir = self.loaded_tags_dir
 
+            executor = None
+            if self.convert_sub_bitmaps_in_parallel.get():
+                executor = ProcessPoolExecutor(self.worker_count)
+
             for fp in sorted(self.bitmap_tag_infos):
                 try:
                     if self._cancel_processing:
                         print("Conversion cancelled by user.")
                         break
 
-                    bitmap_info = self.bitmap_tag_infos[fp]
-                    conv_flags = self.conversion_flags[fp]
-                    pruning = conv_flags.prune_tiff
-                    extracting = conv_flags.extract_to != 0
-                    converting = get_will_be_converted(conv_flags, bitmap_info)
-                    if pruning or converting or extracting:
-                        tag = self.bitm_def.build(filepath=os.path.join(tags_dir, fp))
-                        if pruning:
-                            tag.data.tagdata.compressed_color_plate_data.data = bytearray()
-
-                        if converting or extracting:
-                            convert_bitmap_tag(tag, conv_flags, bitmap_info,
-                                               use_stubbs_p8=self.use_stubbs_p8.get())
-
-                        if converting or pruning:
-                            tag.serialize(temp=False, calc_pointers=False,
-                                          backup=self.backup_tags.get())
-
-                        self.bitmap_tag_infos.pop(fp, None)
-                        self.conversion_flags.pop(fp, None)
-                        self.bitmap_display_windows.pop(fp, None)
-
-                        del tag
-                        gc.collect()
+                    if process_bitmap_tag(
+                            os.path.join(tags_dir, fp),
+                            self.conversion_flags[fp],
+                            self.bitmap_tag_infos[fp],
+                            self.use_stubbs_p8.get(), self.backup_tags.get(),
+                            self.bitm_def, executor, self.memory_budget):
+                        self.after(0, self.forget_processed_tag, fp)
+                except BrokenProcessPool:
+                    print(format_exc())
+                    print("Could not convert: %s" % fp)
+                    # a worker died. replace the pool for the other tags
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(self.worker_count)
                 except Exception:
                     print(format_exc())
                     print("Could not convert: %s" % fp)
 
+            if executor is not None:
+                executor.shutdown(wait=False)
+
         print("    Finished in %s seconds." % int(time() - s_time))
 
         self._processing = self._cancel_processing = False
         self.after(0, self.enable_settings)
         self.after(0, self.tag_list_frame.display_sorted_tags)
 
+    def convert_tags_in_parallel(self):
+        '''
+        Converts the bitmaps using a pool of worker processes, printing
+        the results of each one in the order they finish converting.
+        '''
+        tags_dir = self.loaded_tags_dir
+        use_stubbs_p8 = self.use_stubbs_p8.get()
+        backup = self.backup_tags.get()
+
+        executor = ProcessPoolExecutor(self.worker_count)
+        futures = {}
+        try:
+            for fp in sorted(self.bitmap_tag_infos):
+                future = executor.submit(
+                    process_bitmap_tag_in_worker, os.path.join(tags_dir, fp),
+                    self.conversion_flags[fp], self.bitmap_tag_infos[fp],
+                    use_stubbs_p8, backup, self.memory_budget)
+                futures[future] = fp
+
+            not_done = set(futures)
+            while not_done:
+                if self._cancel_processing:
+                    print("Conversion cancelled by user.")
+                    break
+
+                # poll so cancelling doesnt wait on a slow bitmap
+                done, not_done = wait(not_done, timeout=0.25,
+                                      return_when=FIRST_COMPLETED)
+                for future in done:
+                    fp = futures[future]
+                    try:
+                        processed, output = future.result()
+                    except Exception:
+                        processed, output = None, format_exc()
+
+                    if output:
+                        print(output.rstrip("\n"))
+
+                    if processed is None:
+                        print("Could not convert: %s" % fp)
+                    elif processed:
+                        print("Converted: %s" % fp)
+                        self.after(0, self.forget_processed_tag, fp)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def forget_processed_tag(self, tag_path):
+        self.bitmap_tag_infos.pop(tag_path, None)
+        self.conversion_flags.pop(tag_path, None)
+        self.bitmap_display_windows.pop(tag_path, None)
+
+    def estimate_pressed(self):
+        if self._processing or not self.bitmap_tag_infos:
+            return
+
+        try:
+            print(self.make_estimate())
+        except Exception:
+            print(format_exc())
+            print("Could not estimate the conversion")
+
     def cancel_pressed(self):
         if self._processing:
             self._cancel_processing = True
@@ -1258,6 +2030,64 @@ def get_will_be_processed(self, tag_path):
         return get_will_be_converted(self.conversion_flags[tag_path],
                                      self.bitmap_tag_infos[tag_path])
 
+    def make_estimate(self):
+        '''
+        Returns a string describing how big the pixel data and texture
+        memory of the scanned tags will be after converting them with
+        their current conversion flags, and roughly how long it will take.
+        Only the scanned tag infos are used, so no tags are loaded.
+        '''
+        tag_count = 0
+        old_pixel_data_size = new_pixel_data_size = 0
+        cpu_time = 0.0
+        # maps (type, format) to the count and total size of those textures
+        texture_sizes = {}
+        for tag_path, info in self.bitmap_tag_infos.items():
+            flags = self.conversion_flags.get(tag_path)
+            if flags is None or not info.bitmap_infos:
+                continue
+
+            estimate = estimate_bitmap_conversion(flags, info)
+            tag_count += estimate.converted
+            cpu_time += estimate.cpu_time
+            old_pixel_data_size += info.pixel_data_size
+            new_pixel_data_size += estimate.pixel_data_size
+            for typ, fmt, size in estimate.texture_sizes:
+                counts = texture_sizes.setdefault((typ, fmt), [0, 0])
+                counts[0] += 1
+                counts[1] += size
+
+        worker_count = 1
+        if self.convert_in_parallel.get() or (
+                self.convert_sub_bitmaps_in_parallel.get()):
+            worker_count = self.worker_count or os.cpu_count() or 1
+
+        estimate_str = (
+            "Conversion estimate:\n"
+            "\t%s of %s bitmap tags will be converted\n"
+            "\tPixel data:\t%sKB now, %sKB after converting\n"
+            "\tCPU time:\tabout %.1f seconds" % (
+                tag_count, len(self.bitmap_tag_infos),
+                old_pixel_data_size // 1024, new_pixel_data_size // 1024,
+                cpu_time))
+        if worker_count > 1:
+            estimate_str += ", or %.1f seconds split between %s processes" % (
+                cpu_time / worker_count, worker_count)
+
+        estimate_str += "\n\tTexture memory after converting:"
+        for typ in range(HALO_1_TYPE_COUNT):
+            type_sizes = [(fmt, counts) for (t, fmt), counts in
+                          sorted(texture_sizes.items()) if t == typ]
+            if not type_sizes:
+                continue
+
+            estimate_str += "\n\t\t%s textures:" % BITMAP_TYPES[typ]
+            for fmt, (count, size) in type_sizes:
+                estimate_str += "\n\t\t\t%s\t--- Count: %s\t--- %sKB" % (
+                    BITMAP_FORMATS[fmt], count, size // 1024)
+
+        return estimate_str + "\n"
+
     def make_log(self):
         attempts = 0
         success = True
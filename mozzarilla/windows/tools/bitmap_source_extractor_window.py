@@ -8,16 +8,20 @@
 # See LICENSE for more information.
 #
 
+import io
 import os
 import threadsafe_tkinter as tk
 import zlib
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import redirect_stdout
 from time import time
 from threading import Thread
-from struct import unpack, pack_into
+from struct import pack, unpack, pack_into
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
+from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.windows.filedialog import askdirectory
 from mozzarilla import editor_constants as e_c
 
@@ -25,11 +29,292 @@
 if __name__ == "__main__":
     window_base_class = tk.Tk
 
+# number of tags in a TIFF image file directory
+TIFF_TAG_COUNT = 10
+TIFF_TAG_SIZE = 12
+TIFF_HEADER_SIZE = 8
+
+# most bytes of pixels decompressed at once while writing a source file
+SOURCE_CHUNK_SIZE = 1 << 20
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DEFAULT_PNG_COMPRESSION = 6
+
+
+def read_bitmap_source(tag_path):
+    '''
+    Returns the width, height, and zlib compressed pixels of the source
+    image in the Halo 1 or 2 bitmap tag at the tag_path, or None if the
+    file isnt a bitmap tag or it has no source image.
+    '''
+    try:
+        with open(tag_path, 'rb') as f:
+            data = f.read()
+
+        tag_id = data[36:40]
+        engine_id = data[60:64]
+
+        # make sure this is a bitmap tag
+        if tag_id == b'bitm' and engine_id == b'blam':
+            dims_off = 64+24
+            size_off = 64+28
+            data_off = 64+108
+            end = ">"
+        elif tag_id == b'mtib' and engine_id == b'!MLB':
+            dims_off = 64+16+24
+            size_off = 64+16+28
+            data_off = 64+16
+            # get the size of the bitmap body from the tbfd structure
+            data_off += unpack("<i", data[data_off-4: data_off])[0]
+            end = "<"
+        else:
+            #print("    This file doesnt appear to be a bitmap tag.")
+            return None
+
+        width, height = unpack(end+"HH", data[dims_off: dims_off+4])
+        comp_size = unpack(end+"i", data[size_off: size_off+4])[0]
+        data = data[data_off: data_off+comp_size]
+    except Exception:
+        #print("    Could not load bitmap tag.")
+        return None
+
+    if not len(data):
+        #print("    No source image to extract.")
+        return None
+
+    data_size = unpack(end+"I", data[:4])[0]
+    if not data_size:
+        #print('    Source data is blank.')
+        return None
+
+    return width, height, data[4:]
+
+
+def iter_decompressed(comp_data, chunk_size=SOURCE_CHUNK_SIZE):
+    '''
+    Decompresses the zlib data and yields it as bytearrays of chunk_size
+    bytes, except for the last one, so the whole image is never in memory.
+    '''
+    decompressor = zlib.decompressobj()
+    data = bytearray()
+    while comp_data:
+        data += decompressor.decompress(comp_data, chunk_size)
+        comp_data = decompressor.unconsumed_tail
+        while len(data) >= chunk_size:
+            yield data[: chunk_size]
+            del data[: chunk_size]
+
+    data += decompressor.flush()
+    for i in range(0, len(data), chunk_size):
+        yield data[i: i + chunk_size]
+
+
+def swap_red_and_blue(pixels, pixel_count):
+    '''
+    Swaps the red and blue channels of the first pixel_count
+    32 bit pixels in the bytearray in place.
+    '''
+    end = pixel_count * 4
+    pixels[0: end: 4], pixels[2: end: 4] = pixels[2: end: 4], pixels[0: end: 4]
+
+
+def make_tiff_header(width, height):
+    '''
+    Returns the header of an uncompressed 32 bit RGBA TIFF, and the image
+    file directory that follows its width * height * 4 bytes of pixels.
+    '''
+    head = bytearray(TIFF_HEADER_SIZE)
+    pack_into('<H', head, 0, 0x4949) # magic
+    pack_into('<H', head, 2, 42) # version
+    pixel_offset = TIFF_HEADER_SIZE
+    tag_offset = pixel_offset + width * height * 4
+    pack_into('<i', head, 4, tag_offset) # tag offset
+
+    # the tag count, the tags, the next directory offset, and
+    # the bits per sample(8 each, for 32 bits) they point to
+    ifd = bytearray(2 + TIFF_TAG_SIZE * TIFF_TAG_COUNT + 4 + 8)
+    pack_into('<H', ifd, 0, TIFF_TAG_COUNT)
+
+    tags = (
+        # Write the width and height
+        (0x100, width, 4 if width >= 0xFFFF else 3, 1),
+        (0x101, height, 4 if height >= 0xFFFF else 3, 1),
+        (0x102, tag_offset + len(ifd) - 8, 3, 4), # offset to bits per sample (8888 as set up earlier)
+        (0x103, 1, 3, 1), # compression (1 = uncompressed)
+        (0x106, 2, 3, 1), # photometric interpretation (2 = RGB)
+        (0x111, pixel_offset, 4, 1), # strips
+        (0x112, 1, 3, 1), # orientation (1 = top-left)
+        (0x115, 4, 3, 1), # samples per pixel (4, RGBA)
+        (0x117, width * height * 4, 4, 1), # strip byte count
+        (0x152, 2, 3, 1), # extra samples (2 = unassociated alpha)
+        )
+    for i, (type_val, data_offset, size, count) in enumerate(tags):
+        off = 2 + i * TIFF_TAG_SIZE
+        pack_into('<H', ifd, off, type_val)
+        pack_into('<H', ifd, off + 2, size)
+        pack_into('<i', ifd, off + 4, count)
+        pack_into('<i', ifd, off + 8, data_offset)
+
+    # Next directory is left as 0. Bits per sample
+    pack_into('<4H', ifd, len(ifd) - 8, 8, 8, 8, 8)
+    return head, ifd
+
+
+def write_tiff_source(f, width, height, comp_data, compression_level=None):
+    head, ifd = make_tiff_header(width, height)
+    f.write(head)
+    for chunk in iter_decompressed(comp_data):
+        # Swap red and blue channels
+        swap_red_and_blue(chunk, len(chunk) // 4)
+        f.write(chunk)
+    f.write(ifd)
+
+
+def write_png_chunk(f, chunk_type, data):
+    f.write(pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def write_png_source(f, width, height, comp_data,
+                     compression_level=DEFAULT_PNG_COMPRESSION):
+    '''
+    Writes the pixels as a 32 bit RGBA PNG. Rows are decompressed, given
+    their filter byte, and recompressed a chunk at a time, and each piece
+    of compressed data is written as its own IDAT chunk.
+    '''
+    if not width or not height:
+        raise ValueError("PNGs cannot be empty.")
+
+    stride = width * 4
+    f.write(PNG_SIGNATURE)
+    # 8 bits per channel, RGBA, deflate compression,
+    # adaptive filtering, and no interlacing
+    write_png_chunk(f, b'IHDR', pack('>2I5B', width, height, 8, 6, 0, 0, 0))
+
+    compressor = zlib.compressobj(compression_level)
+    rows_per_chunk = max(1, SOURCE_CHUNK_SIZE // stride)
+    rows_left = height
+    for chunk in iter_decompressed(comp_data, rows_per_chunk * stride):
+        row_count = min(len(chunk) // stride, rows_left)
+        swap_red_and_blue(chunk, row_count * width)
+
+        # each row starts with a filter type byte. 0 is no filtering
+        rows = bytearray(row_count * (stride + 1))
+        for i in range(row_count):
+            start = i * (stride + 1) + 1
+            rows[start: start + stride] = chunk[i * stride: (i + 1) * stride]
+
+        rows_left -= row_count
+        data = compressor.compress(rows)
+        if data:
+            write_png_chunk(f, b'IDAT', data)
+
+    if rows_left:
+        raise ValueError("Source data is smaller than its dimensions.")
+
+    write_png_chunk(f, b'IDAT', compressor.flush())
+    write_png_chunk(f, b'IEND', b'')
+
+
+def write_dds_source(f, width, height, comp_data, compression_level=None):
+    '''
+    Writes the pixels as an uncompressed A8R8G8B8 DDS. The source data is
+    already in the order DDS stores A8R8G8B8 in, so it's written as is.
+    '''
+    f.write(pack('<4s7I44x', b'DDS ', 124,
+                 0x100F,  # flags (caps, height, width, pitch, pixel format)
+                 height, width, width * 4, 0, 0))
+    # pixel format(rgb with alpha, 32 bits, and its channel masks) and caps
+    f.write(pack('<8I', 32, 0x41, 0, 32,
+                 0x00FF0000, 0x0000FF00, 0x000000FF, 0xFF000000))
+    f.write(pack('<4I4x', 0x1000, 0, 0, 0))
+    for chunk in iter_decompressed(comp_data):
+        f.write(chunk)
+
+
+def write_zlib_source(f, width, height, comp_data, compression_level=None):
+    '''
+    Writes the zlib compressed 32 bit BGRA pixels as they are in the tag.
+    '''
+    f.write(comp_data)
+
+
+# the name, extension, and writer function of each source file format
+SOURCE_FORMATS = (
+    ("TIFF", ".tif", write_tiff_source),
+    ("PNG", ".png", write_png_source),
+    ("DDS", ".dds", write_dds_source),
+    ("Compressed (zlib)", ".zlib", write_zlib_source),
+    )
+
+
+def extract_bitmap_source(tag_path, source_path, source_format=0,
+                          compression_level=DEFAULT_PNG_COMPRESSION):
+    '''
+    Extracts the source image in the bitmap tag at the tag_path to the
+    source_path with the extension of the source format. Compressed
+    sources have their width and height added to their filename, since
+    the file doesnt record them. compression_level is the zlib level PNGs
+    are compressed with. The pixels are decompressed and written a chunk
+    at a time.
+    Returns whether or not there was a source image to extract.
+    '''
+    source = read_bitmap_source(tag_path)
+    if source is None:
+        return False
+
+    width, height, comp_data = source
+    name, ext, writer = SOURCE_FORMATS[source_format]
+    if writer is write_zlib_source:
+        source_path += "_%sx%s" % (width, height)
+
+    source_path += ext
+    try:
+        source_dir = os.path.dirname(source_path)
+        if not os.path.isdir(source_dir):
+            os.makedirs(source_dir)
+
+        with open(source_path, 'wb') as f:
+            writer(f, width, height, comp_data, compression_level)
+    except Exception:
+        #print(format_exc())
+        print("    Couldn't make %s file." % name)
+        # dont leave a partially written file
+        try:
+            os.remove(source_path)
+        except Exception:
+            pass
+
+    return True
+
+
+def extract_bitmap_source_in_worker(tag_path, source_path, source_format=0,
+                                    compression_level=DEFAULT_PNG_COMPRESSION):
+    '''
+    Calls extract_bitmap_source in a worker process. Returns what
+    it returns, and anything printed while extracting.
+    '''
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            extracted = extract_bitmap_source(
+                tag_path, source_path, source_format, compression_level)
+        except Exception:
+            print(format_exc())
+            extracted = False
+
+    return extracted, output.getvalue()
+
 
 class BitmapSourceExtractorWindow(BinillaWidget, window_base_class):
     _running_thread = None
     stop_extraction = False
 
+    # number of worker processes to extract with. None uses all cpus
+    worker_count = None
+
     def __init__(self, app_root, *args, **kwargs):
         self.app_root = app_root
 
@@ -49,12 +334,15 @@ def __init__(self, app_root, *args, **kwargs):
 
         self.tags_dir = tk.StringVar(self)
         self.data_dir = tk.StringVar(self)
+        self.source_format = tk.IntVar(self, 0)
+        self.png_compression = tk.IntVar(self, DEFAULT_PNG_COMPRESSION)
         self.tags_dir.set(e_c.WORKING_DIR.joinpath('tags'))
         self.data_dir.set(e_c.WORKING_DIR.joinpath('data'))
 
         # make the frames
         self.tags_dir_frame = tk.LabelFrame(self, text="Tags directory")
         self.data_dir_frame = tk.LabelFrame(self, text="Data directory")
+        self.settings_frame = tk.LabelFrame(self, text="Source files")
 
         # add the filepath boxes
         self.tags_dir_entry = tk.Entry(
@@ -64,6 +352,18 @@ def __init__(self, app_root, *args, **kwargs):
             self.data_dir_frame, textvariable=self.data_dir)
         self.data_dir_entry.config(width=55, state=tk.DISABLED)
 
+        self.source_format_label = tk.Label(
+            self.settings_frame, text="Format")
+        self.source_format_menu = ScrollMenu(
+            self.settings_frame, menu_width=18,
+            options=tuple(name for name, _, _ in SOURCE_FORMATS),
+            variable=self.source_format)
+        self.png_compression_label = tk.Label(
+            self.settings_frame, text="PNG compression level")
+        self.png_compression_spinbox = tk.Spinbox(
+            self.settings_frame, from_=0, to=9, width=3, state="readonly",
+            textvariable=self.png_compression)
+
         # add the buttons
         self.extract_btn = tk.Button(
             self, text="Extract source files", width=22,
@@ -80,9 +380,14 @@ def __init__(self, app_root, *args, **kwargs):
         self.data_dir_entry.pack(expand=True, fill='x', side='left')
         self.tags_dir_browse_btn.pack(fill='x', side='left')
         self.data_dir_browse_btn.pack(fill='x', side='left')
+        self.source_format_label.pack(side='left', padx=(5, 0))
+        self.source_format_menu.pack(side='left', padx=5)
+        self.png_compression_label.pack(side='left', padx=(5, 0))
+        self.png_compression_spinbox.pack(side='left', padx=5)
 
         self.tags_dir_frame.pack(expand=True, fill='both')
         self.data_dir_frame.pack(expand=True, fill='both')
+        self.settings_frame.pack(expand=True, fill='both')
         self.extract_btn.pack(fill='both', padx=5, pady=5)
 
         if self.app_root is not self and self.app_root:
@@ -117,13 +422,16 @@ def data_dir_browse(self):
 
     def lock_ui(self):
         for w in (self.tags_dir_browse_btn, self.extract_btn,
-                  self.data_dir_browse_btn):
+                  self.data_dir_browse_btn, self.png_compression_spinbox):
             w.config(state=tk.DISABLED)
+        self.source_format_menu.disable()
 
     def unlock_ui(self):
         for w in (self.tags_dir_browse_btn, self.extract_btn,
                   self.data_dir_browse_btn):
             w.config(state=tk.NORMAL)
+        self.png_compression_spinbox.config(state="readonly")
+        self.source_format_menu.enable()
 
     def thread_wrapper(self, func, *args, **kwargs):
         if self._running_thread is not None:
@@ -151,138 +459,53 @@ def do_extract(self):
         start = time()
         tags_dir = self.tags_dir.get()
         data_dir = self.data_dir.get()
+        source_format = self.source_format.get()
+        compression_level = self.png_compression.get()
 
-        for root, dirs, files in os.walk(tags_dir):
-            for tag_name in files:
+        executor = ProcessPoolExecutor(self.worker_count)
+        futures = {}
+        try:
+            for root, dirs, files in os.walk(tags_dir):
                 if self.stop_extraction:
-                    print("    Conversion cancelled by user.")
-                    return
-                elif os.path.splitext(tag_name)[-1].lower() != '.bitmap':
-                    continue
-                tag_path = os.path.join(root, tag_name)
-
-                source_path = data_dir + tag_path.split(tags_dir)[-1]
-                source_path = os.path.splitext(source_path)[0] + ".tif"
-                source_dir = os.path.dirname(source_path)
-
-                try:
-                    with open(tag_path, 'rb') as f:
-                        data = f.read()
-
-                    tag_id = data[36:40]
-                    engine_id = data[60:64]
-
-                    # make sure this is a bitmap tag
-                    if tag_id == b'bitm' and engine_id == b'blam':
-                        dims_off = 64+24
-                        size_off = 64+28
-                        data_off = 64+108
-                        end = ">"
-                    elif tag_id == b'mtib' and engine_id == b'!MLB':
-                        dims_off = 64+16+24
-                        size_off = 64+16+28
-                        data_off = 64+16
-                        # get the size of the bitmap body from the tbfd structure
-                        data_off += unpack("<i", data[data_off-4: data_off])[0]
-                        end = "<"
-                    else:
-                        #print("    This file doesnt appear to be a bitmap tag.")
-                        continue
+                    break
 
-                    width, height = unpack(end+"HH", data[dims_off: dims_off+4])
-                    comp_size = unpack(end+"i", data[size_off: size_off+4])[0]
-                    data = data[data_off: data_off+comp_size]
-                except Exception:
-                    #print("    Could not load bitmap tag.")
-                    continue
-
-                if not len(data):
-                    #print("    No source image to extract.")
-                    continue
-
-                try:
-                    data_size = unpack(end+"I", data[:4])[0]
-                    if not data_size:
-                        #print('    Source data is blank.')
+                for tag_name in files:
+                    if self.stop_extraction:
+                        break
+                    elif os.path.splitext(tag_name)[-1].lower() != '.bitmap':
                         continue
 
-                    data = bytearray(zlib.decompress(data[4:]))
-                except Exception:
-                    #print('    Could not decompress data.')
-                    continue
-
-                print('Extracting %s' % tag_path.split(tags_dir)[-1].lstrip("/\\"))
-                try:
-                    if not os.path.isdir(source_dir):
-                        os.makedirs(source_dir)
-                    with open(source_path, 'wb') as f:
-                        # Swap red and blue channels
-                        for i in range(0, height * width * 4, 4):
-                            c1 = data[i + 2]
-                            data[i + 2] = data[i + 0]
-                            data[i + 0] = c1
-                        
-                        # TIFF Header
-                        head = bytearray(8)
-                        pack_into('<H', head, 0, 0x4949) # magic
-                        pack_into('<H', head, 2, 42) # version
-                        pixel_offset = 8
-                        tag_offset = pixel_offset + width * height * 4
-                        pack_into('<i', head, 4, tag_offset) # tag offset
-                        f.write(head)
-                        
-                        # Write the pixels
-                        f.write(data)
-                        
-                        # Write the tag count
-                        tag_count_struct = bytearray(2)
-                        tag_count = 10
-                        pack_into('<H', tag_count_struct, 0, tag_count)
-                        f.write(tag_count_struct)
-                        
-                        # Bits per sample value (8 each, for 32 bits)
-                        bits_per_sample = bytearray(8)
-                        pack_into('<H', bits_per_sample, 0, 8)
-                        pack_into('<H', bits_per_sample, 2, 8)
-                        pack_into('<H', bits_per_sample, 4, 8)
-                        pack_into('<H', bits_per_sample, 6, 8)
-                        
-                        tag_struct_size = 12
-                        
-                        # Write TIFF tags
-                        def write_tag(type_val, data_offset, size, count):
-                            tag_struct = bytearray(tag_struct_size)
-                            pack_into('<H', tag_struct, 0, type_val)
-                            pack_into('<H', tag_struct, 2, size)
-                            pack_into('<i', tag_struct, 4, count)
-                            pack_into('<i', tag_struct, 8, data_offset)
-                            f.write(tag_struct)
-                        
-                        # Write the width and height
-                        write_tag(0x100, width, 4 if width >= 0xFFFF else 3, 1)
-                        write_tag(0x101, height, 4 if height >= 0xFFFF else 3, 1)
-                        
-                        # Write remaining tags
-                        write_tag(0x102, tag_offset + 2 + tag_struct_size * tag_count + 4, 3, 4) # offset to bits per sample (8888 as set up earlier)
-                        write_tag(0x103, 1, 3, 1) # compression (1 = uncompressed)
-                        write_tag(0x106, 2, 3, 1) # photometric interpretation (2 = RGB)
-                        write_tag(0x111, pixel_offset, 4, 1) # strips
-                        write_tag(0x112, 1, 3, 1) # orientation (1 = top-left)
-                        write_tag(0x115, 4, 3, 1) # samples per pixel (4, RGBA)
-                        write_tag(0x117, width * height * 4, 4, 1) # strip byte count
-                        write_tag(0x152, 2, 3, 1) # extra samples (2 = unassociated alpha)
-                        
-                        # Next directory
-                        next_directory = bytearray(4)
-                        pack_into('<i', next_directory, 0, 0)
-                        f.write(next_directory)
-                        
-                        # Bits per sample
-                        f.write(bits_per_sample)
-                        
-                except Exception:
-                    #print(format_exc())
-                    print("    Couldn't make Tif file.")
+                    tag_path = os.path.join(root, tag_name)
+                    source_path = data_dir + tag_path.split(tags_dir)[-1]
+                    source_path = os.path.splitext(source_path)[0]
+                    future = executor.submit(
+                        extract_bitmap_source_in_worker, tag_path, source_path,
+                        source_format, compression_level)
+                    futures[future] = tag_path.split(tags_dir)[-1].lstrip("/\\")
+
+            not_done = set(futures)
+            while not_done and not self.stop_extraction:
+                # poll so cancelling doesnt wait on a large color plate
+                done, not_done = wait(not_done, timeout=0.25,
+                                      return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        extracted, output = future.result()
+                    except Exception:
+                        extracted, output = False, format_exc()
+
+                    if extracted:
+                        print('Extracting %s' % futures[future])
+                    if output:
+                        print(output.rstrip("\n"))
+
+            if self.stop_extraction:
+                print("    Conversion cancelled by user.")
+                return
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
         print('\nFinished. Took %s seconds' % (time() - start))
 
@@ -32,6 +32,7 @@ class DataExtractionWindow(tk.Toplevel, BinillaWidget):
 
     _extracting = False
     stop_extracting = False
+    tag_index = None
     tag_data_extractors = ()
 
     listbox_index_to_def_id = ()
@@ -212,11 +213,13 @@ def destroy(self):
             self.app_root.tool_windows.pop(self.window_name, None)
         except AttributeError:
             pass
-        self.stop_extracting = True
+        self.cancel_extraction()
         tk.Toplevel.destroy(self)
 
     def cancel_extraction(self):
         self.stop_extracting = True
+        if self.tag_index is not None:
+            self.tag_index.stop_indexing = True
 
     def get_tag(self, tag_path):
         def_id = self.handler.get_def_id(tag_path)
@@ -282,14 +285,54 @@ def do_dir_extract(self):
         print("Beginning tag data extracton in:\t%s" % self.handler.tagsdir)
 
         s_time = time()
-        c_time = s_time
-        p_int = self.print_interval
 
         all_tag_paths = {self.listbox_index_to_def_id[int(i)]: [] for i in
                          self.def_ids_listbox.curselection()}
 
         print("Locating tags...")
 
+        tag_index = self.tag_index = None
+        if hasattr(self.app_root, "get_tag_index"):
+            tag_index = self.tag_index = self.app_root.get_tag_index(
+                self.handler)
+
+        if tag_index is not None:
+            if self.stop_extracting or tag_index.refresh() is None:
+                print('Tag data extraction cancelled.\n')
+                return
+
+            for def_id, tag_paths in all_tag_paths.items():
+                tag_paths.extend(tag_index.get_tag_paths((def_id, ), tags_path))
+        elif not self.walk_for_tags(tags_path, all_tag_paths):
+            print('Tag data extraction cancelled.\n')
+            return
+
+        for def_id in sorted(all_tag_paths):
+            extractor = self.tag_data_extractors[def_id]
+            if self.stop_extracting:
+                print('Tag data extraction cancelled.\n')
+                return
+
+            print("Extracting %s" % def_id)
+            for filepath in all_tag_paths[def_id]:
+                if self.stop_extracting:
+                    print('Tag data extraction cancelled.\n')
+                    return
+
+                print(' '*4, filepath, sep="")
+                self.extract(filepath, extractor, **settings)
+
+        print("Extraction completed.\n")
+
+    def walk_for_tags(self, tags_path, all_tag_paths):
+        '''
+        Walks the directory and adds the path of each tag to the list in
+        all_tag_paths under the tag's def_id, if there is one.
+        Returns False if the extraction was cancelled.
+        '''
+        c_time = time()
+        p_int = self.print_interval
+
         for root, directories, files in os.walk(tags_path):
             root = Path(root)
             try:
@@ -306,8 +349,7 @@ def do_dir_extract(self):
                     self.app_root.update_idletasks()
 
                 if self.stop_extracting:
-                    print('Tag data extraction cancelled.\n')
-                    return
+                    return False
 
                 tag_paths = all_tag_paths.get(
                     self.tag_class_ext_to_fcc.get(
@@ -316,22 +358,7 @@ def do_dir_extract(self):
                 if tag_paths is not None:
                     tag_paths.append(filepath)
 
-        for def_id in sorted(all_tag_paths):
-            extractor = self.tag_data_extractors[def_id]
-            if self.stop_extracting:
-                print('Tag data extraction cancelled.\n')
-                return
-
-            print("Extracting %s" % def_id)
-            for filepath in all_tag_paths[def_id]:
-                if self.stop_extracting:
-                    print('Tag data extraction cancelled.\n')
-                    return
-
-                print(' '*4, filepath, sep="")
-                self.extract(filepath, extractor, **settings)
-
-        print("Extraction completed.\n")
+        return True
 
     def do_tag_extract(self):
         tag_path = self.tag_path.get()
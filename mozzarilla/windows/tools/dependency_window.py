@@ -12,6 +12,8 @@
 import tkinter as tk
 import zipfile
 
+from concurrent.futures import ProcessPoolExecutor, wait
+from queue import Queue
 from threading import Thread
 from traceback import format_exc
 
@@ -20,8 +22,16 @@
 
 from supyr_struct.util import path_normalize, is_in_dir, tagpath_to_fullpath
 from mozzarilla.widgets.directory_frame import DirectoryFrame,\
-     HierarchyFrame, DependencyFrame
+     HierarchyFrame, DependencyFrame, ReverseDependencyFrame
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tag_index import init_index_worker,\
+     read_references_in_worker, read_tag_references
+
+# number of tags each worker process is handed at a time
+ZIP_CHUNK_SIZE = 32
+
+# number of tags that can be waiting to be written to the zipfile
+ZIP_WRITE_QUEUE_SIZE = 64
 
 
 class DependencyWindow(tk.Toplevel, BinillaWidget):
@@ -30,6 +40,14 @@ class DependencyWindow(tk.Toplevel, BinillaWidget):
 
     _zipping = False
     stop_zipping = False
+    zip_executor = None
+
+    # maps each handler to a dict mapping tag filepaths
+    # to the mtime and dependencies they had when read
+    dependency_caches = None
+
+    _indexing = False
+    tag_index = None
 
     def __init__(self, app_root, *args, **kwargs):
         self.handler = app_root.handler
@@ -49,6 +67,8 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.tag_filepath = tk.StringVar(self)
+        self.zip_per_root = tk.BooleanVar(self)
+        self.dependency_caches = {}
 
         # make the frames
         self.filepath_frame = tk.LabelFrame(self, text="Select a tag")
@@ -58,11 +78,21 @@ def __init__(self, app_root, *args, **kwargs):
             self.button_frame, width=25, text='Show dependencies',
             command=self.populate_dependency_tree)
 
+        self.reverse_display_button = tk.Button(
+            self.button_frame, width=25, text='Show referenced by',
+            command=self.populate_reverse_dependency_tree)
+
         self.zip_button = tk.Button(
             self.button_frame, width=25, text='Zip tag recursively',
             command=self.recursive_zip)
 
+        self.zip_per_root_cbutton = tk.Checkbutton(
+            self.button_frame, variable=self.zip_per_root,
+            text='One zipfile per root tag')
+
         self.dependency_frame = DependencyFrame(self, app_root=self.app_root)
+        self.reverse_dependency_frame = ReverseDependencyFrame(
+            self, app_root=self.app_root)
 
         self.filepath_entry = tk.Entry(
             self.filepath_frame, textvariable=self.tag_filepath)
@@ -70,7 +100,9 @@ def __init__(self, app_root, *args, **kwargs):
             self.filepath_frame, text="Browse", command=self.browse)
 
         self.display_button.pack(padx=4, pady=2, side='left')
+        self.reverse_display_button.pack(padx=4, pady=2, side='left')
         self.zip_button.pack(padx=4, pady=2, side='right')
+        self.zip_per_root_cbutton.pack(padx=4, pady=2, side='right')
 
         self.filepath_entry.pack(padx=(4, 0), pady=2, side='left',
                                  expand=True, fill='x')
@@ -78,7 +110,7 @@ def __init__(self, app_root, *args, **kwargs):
 
         self.filepath_frame.pack(fill='x', padx=1)
         self.button_frame.pack(fill='x', padx=1)
-        self.dependency_frame.pack(fill='both', padx=1, expand=True)
+        self.show_frame(self.dependency_frame)
 
         self.transient(app_root)
         self.apply_style()
@@ -91,7 +123,7 @@ def browse(self):
         if self._zipping:
             return
 
-        filetypes = [('All', '*')]
+        filetypes = [('All', '*'), ('Root tag list', '*.txt')]
 
         defs = self.app_root.handler.defs
         for def_id in sorted(defs.keys()):
@@ -112,6 +144,8 @@ def destroy(self):
         except AttributeError:
             pass
         self.stop_zipping = True
+        if self.tag_index is not None:
+            self.tag_index.stop_indexing = True
         tk.Toplevel.destroy(self)
 
     def get_tag(self, tag_path):
@@ -121,31 +155,20 @@ def get_tag(self, tag_path):
             print(format_exc())
             return None
 
-    def get_dependencies(self, tag):
-        def_id = tag.def_id
-        dependency_cache = self.handler.tag_ref_cache.get(def_id)
-
-        if not dependency_cache:
-            return ()
-
-        nodes = self.handler.get_nodes_by_paths(
-            self.handler.tag_ref_cache[def_id], tag.data)
-
+    def get_dependency_paths(self, references):
+        '''
+        Returns the tag paths of the given references,
+        as returned by get_tag_references.
+        '''
         dependencies = []
 
-        for node in nodes:
-            # if the node's filepath is empty, just skip it
-            if not node.filepath:
-                continue
-
-            ext = '.' + node.tag_class.enum_name
-
+        for _, filepath, ext in references:
             if tagpath_to_fullpath(
-                self.handler.tagsdir, PureWindowsPath(node.filepath), extension=ext
+                self.handler.tagsdir, PureWindowsPath(filepath), extension=ext
             ) is not None and (self.handler.treat_mode_as_mod2 and ext == '.model'):
                 ext = '.gbxmodel'
 
-            dependencies.append(node.filepath + ext)
+            dependencies.append(filepath + ext)
         return dependencies
 
     def populate_dependency_tree(self):
@@ -167,18 +190,96 @@ def populate_dependency_tree(self):
                   (filepath, self.handler.tagsdir))
             return
 
-        rel_filepath = Path(filepath).relative_to(self.handler.tagsdir)
-        tag = self.get_tag(rel_filepath)
-        if tag is None:
-            print("Could not load tag:\n    %s" % filepath)
+        # the root tag isnt loaded here, as the frame only reads the
+        # references of each tag when its item is expanded.
+        filepath = Path(filepath)
+        rel_filepath = filepath.relative_to(self.handler.tagsdir)
+        if not filepath.is_file():
+            print("Could not find tag:\n    %s" % filepath)
             return
 
         self.dependency_frame.handler = handler
         self.dependency_frame.tags_dir = self.handler.tagsdir
-        self.dependency_frame.root_tag_path = tag.filepath
+        self.dependency_frame.root_tag_path = filepath
         self.dependency_frame.root_tag_text = rel_filepath
 
         self.dependency_frame.reload()
+        self.show_frame(self.dependency_frame)
+
+    def show_frame(self, frame):
+        for other_frame in (self.dependency_frame,
+                            self.reverse_dependency_frame):
+            if other_frame is not frame:
+                other_frame.pack_forget()
+
+        frame.pack(fill='both', padx=1, expand=True)
+
+    def populate_reverse_dependency_tree(self):
+        if self._indexing:
+            return
+
+        filepath = self.tag_filepath.get()
+        if not filepath:
+            return
+
+        app = self.app_root
+        handler = self.handler = app.handler
+        handler_name = app.handler_names[app._curr_handler_index]
+        if handler_name not in app.tags_dir_relative:
+            print("Change the current tag set.")
+            return
+
+        filepath = path_normalize(filepath)
+
+        if not is_in_dir(filepath, self.handler.tagsdir):
+            print("%s\nis not in tagsdir\n%s" %
+                  (filepath, self.handler.tagsdir))
+            return
+
+        tag_index = self.tag_index = app.get_tag_index(handler)
+        if tag_index is None:
+            print("Could not get the tag index for this tag set.")
+            return
+
+        print("Updating tag index...")
+        try: self.index_thread.join()
+        except Exception: pass
+        self._indexing = True
+        self.index_thread = Thread(
+            target=self._populate_reverse_dependency_tree,
+            args=(handler, tag_index, filepath))
+        self.index_thread.daemon = True
+        self.index_thread.start()
+
+    def _populate_reverse_dependency_tree(self, *args):
+        try:
+            self.do_populate_reverse_dependency_tree(*args)
+        except Exception:
+            print(format_exc())
+        self._indexing = False
+
+    def do_populate_reverse_dependency_tree(self, handler, tag_index,
+                                            filepath):
+        # only the indexing happens on this thread. the
+        # frame is updated on the main thread once indexing finishes.
+        if (tag_index.refresh() is None or
+                not tag_index.index_references(parallel=True)):
+            print("Tag indexing cancelled.\n")
+            return
+
+        self.after(0, self.show_reverse_dependencies,
+                   handler, tag_index, filepath)
+
+    def show_reverse_dependencies(self, handler, tag_index, filepath):
+        frame = self.reverse_dependency_frame
+        frame.handler = handler
+        frame.tag_index = tag_index
+        frame.tags_dir = handler.tagsdir
+        frame.root_tag_path = filepath
+        frame.root_tag_text = Path(filepath).relative_to(handler.tagsdir)
+
+        frame.reload()
+        self.show_frame(frame)
 
     def recursive_zip(self):
         if self._zipping:
@@ -210,9 +311,16 @@ def do_recursive_zip(self):
             return
 
         tag_path = Path(tag_path)
-        if not is_in_dir(tag_path, self.handler.tagsdir):
+        if tag_path.suffix.lower() == ".txt":
+            root_paths = self.read_root_list(tag_path)
+            if not root_paths:
+                print("No tags listed in:\n    %s" % tag_path)
+                return
+        elif not is_in_dir(tag_path, self.handler.tagsdir):
             print("Specified tag is not located within the tags directory")
             return
+        else:
+            root_paths = [tag_path]
 
         tagzip_path = asksaveasfilename(
             initialdir=self.app_root.last_load_dir, parent=self,
@@ -221,54 +329,275 @@ def do_recursive_zip(self):
         if not tagzip_path:
             return
 
-        try:
-            rel_filepath = tag_path.relative_to(self.handler.tagsdir)
-            tag = self.get_tag(rel_filepath)
-        except ValueError:
-            tag = None
+        rel_filepaths = []
+        for tag_path in root_paths:
+            try:
+                rel_filepath = tag_path.relative_to(self.handler.tagsdir)
+            except ValueError:
+                rel_filepath = None
+
+            if rel_filepath is None or not tag_path.is_file():
+                print("Could not load tag:\n    %s" % tag_path)
+            elif rel_filepath not in rel_filepaths:
+                rel_filepaths.append(rel_filepath)
 
-        if tag is None:
-            print("Could not load tag:\n    %s" % tag_path)
+        if not rel_filepaths:
             return
 
         # make the zipfile to put everything in
-        tagzip_path = os.path.splitext(tagzip_path)[0] + ".zip"
+        tagzip_path = os.path.splitext(tagzip_path)[0]
 
-        tags_to_zip = [rel_filepath]
-        new_tags_to_zip = []
-        seen_tags = set()
+        try:
+            if self.zip_per_root.get() and len(rel_filepaths) > 1:
+                self.zip_roots_separately(rel_filepaths, tagzip_path)
+            else:
+                self.write_zipfile(tagzip_path + ".zip",
+                                   self.iter_dependencies(rel_filepaths))
+        finally:
+            if self.zip_executor is not None:
+                self.zip_executor.shutdown(wait=False)
+                self.zip_executor = None
+
+        if self.stop_zipping:
+            print('Recursive zip operation cancelled.\n')
+            return
 
-        with zipfile.ZipFile(str(tagzip_path), mode='w') as tagzip:
-            # loop over all the tags and add them to the zipfile
-            while tags_to_zip:
-                for rel_filepath in tags_to_zip:
-                    tag_path = tagpath_to_fullpath(
-                        self.handler.tagsdir, PureWindowsPath(rel_filepath))
-                    if self.stop_zipping:
-                        print('Recursive zip operation cancelled.\n')
-                        return
+        print("\nRecursive zip completed.\n")
 
-                    if rel_filepath in seen_tags:
+    def read_root_list(self, filepath):
+        '''
+        Reads a text file listing one root tag per line. Tag paths may be
+        absolute or relative to the tags directory. Blank lines and lines
+        starting with # are ignored.
+        '''
+        root_paths = []
+        try:
+            with open(str(filepath), 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
                         continue
-                    seen_tags.add(rel_filepath)
 
-                    try:
-                        print("Adding '%s' to zipfile" % rel_filepath)
-                        app.update_idletasks()
-                        tag = self.get_tag(rel_filepath)
-                        new_tags_to_zip.extend(self.get_dependencies(tag))
+                    root_path = Path(path_normalize(line))
+                    if not root_path.is_absolute():
+                        rel_path = PureWindowsPath(line)
+                        root_path = Path(tagpath_to_fullpath(
+                            self.handler.tagsdir, rel_path) or
+                            self.handler.tagsdir.joinpath(rel_path))
+                    root_paths.append(root_path)
+        except Exception:
+            print(format_exc())
+            print("Could not read tag list:\n    %s" % filepath)
+
+        return root_paths
+
+    def zip_roots_separately(self, rel_filepaths, tagzip_base):
+        '''
+        Zips each root tag and its dependencies into its own zipfile.
+        Tags needed by more than one root are put into a shared zipfile
+        instead of being duplicated into each root's zipfile.
+        '''
+        closures = []
+        root_counts = {}
+        for rel_filepath in rel_filepaths:
+            # each root gets its own seen set, but the dependency cache is
+            # shared, so tags in more than one closure are only read once.
+            closure = list(self.iter_dependencies([rel_filepath]))
+            if self.stop_zipping:
+                return
+
+            closures.append((rel_filepath, closure))
+            for tag_path, _ in closure:
+                root_counts[tag_path] = root_counts.get(tag_path, 0) + 1
+
+        shared = []
+        shared_paths = set()
+        for _, closure in closures:
+            for entry in closure:
+                if root_counts[entry[0]] > 1 and entry[0] not in shared_paths:
+                    shared_paths.add(entry[0])
+                    shared.append(entry)
+
+        if shared:
+            print("\nWriting %s tags shared by multiple roots..." % len(shared))
+            self.write_zipfile(tagzip_base + "_shared.zip", shared)
+
+        zip_names = set()
+        for rel_filepath, closure in closures:
+            if self.stop_zipping:
+                return
+
+            name = zip_name = rel_filepath.stem
+            i = 1
+            while zip_name.lower() in zip_names:
+                i += 1
+                zip_name = "%s_%s" % (name, i)
+            zip_names.add(zip_name.lower())
+
+            entries = [entry for entry in closure
+                       if entry[0] not in shared_paths]
+            if not entries:
+                print("\nAll tags for '%s' are shared." % rel_filepath)
+                continue
+
+            print("\nWriting tags for '%s'..." % rel_filepath)
+            self.write_zipfile("%s_%s.zip" % (tagzip_base, zip_name), entries)
 
-                        # try to conserve memory a bit
-                        del tag
+    def write_zipfile(self, tagzip_path, entries):
+        '''
+        Writes the (filepath, zipfile path) pairs to the zipfile.
+        '''
+        # tags are written to the zipfile on a separate thread so reading
+        # and writing the zipfile overlaps finding the tags to put in it.
+        write_queue = Queue(ZIP_WRITE_QUEUE_SIZE)
+        with zipfile.ZipFile(str(tagzip_path), mode='w') as tagzip:
+            writer_thread = Thread(target=self.write_zip_entries,
+                                   args=(tagzip, write_queue))
+            writer_thread.daemon = True
+            writer_thread.start()
+            try:
+                for entry in entries:
+                    if self.stop_zipping:
+                        break
+                    write_queue.put(entry)
+            finally:
+                write_queue.put(None)
+                writer_thread.join()
+
+    def get_zip_executor(self):
+        if self.zip_executor is None:
+            print("Starting worker processes...")
+            self.app_root.update_idletasks()
+            handler = self.handler
+            self.zip_executor = ProcessPoolExecutor(
+                initializer=init_index_worker, initargs=(
+                    type(handler), str(handler.tagsdir),
+                    handler.case_sensitive))
+
+        return self.zip_executor
+
+    def iter_dependencies(self, rel_filepaths, seen_tags=None):
+        '''
+        Yields the filepath and zipfile path of the given tags and every
+        tag they depend on, breadth first. Each breadth of tags is read in
+        parallel by worker processes, skipping tags whose dependencies are
+        already cached. Stops early if the zip operation is cancelled.
+        '''
+        app = self.app_root
+        handler = self.handler
+        dependency_cache = self.dependency_caches.setdefault(handler, {})
+        tags_to_zip = list(rel_filepaths)
+        if seen_tags is None:
+            seen_tags = set()
+
+        while tags_to_zip:
+            frontier = []
+            tag_paths = []
+            for rel_filepath in tags_to_zip:
+                tag_path = tagpath_to_fullpath(
+                    handler.tagsdir, PureWindowsPath(rel_filepath))
+                key = rel_filepath if tag_path is None else tag_path
+                if key in seen_tags:
+                    continue
+                seen_tags.add(key)
+
+                # only read tags that changed since they were last read
+                mtime = None
+                if tag_path is not None:
+                    tag_path = Path(tag_path)
+                    try:
+                        mtime = tag_path.stat().st_mtime_ns
+                    except OSError:
+                        tag_path = None
+
+                cached = dependency_cache.get(tag_path)
+                if tag_path is not None and (
+                        cached is None or cached[0] != mtime):
+                    tag_paths.append(tag_path)
+                frontier.append((rel_filepath, tag_path, mtime))
+
+            executor = None
+            if len(tag_paths) > ZIP_CHUNK_SIZE:
+                executor = self.get_zip_executor()
+
+            all_references = self.iter_references(tag_paths, executor)
+
+            # replace the tags to zip with the newly collected ones
+            tags_to_zip = []
+            try:
+                for rel_filepath, tag_path, mtime in frontier:
+                    print("Adding '%s' to zipfile" % rel_filepath)
+                    app.update_idletasks()
+
+                    dependencies = None
+                    cached = dependency_cache.get(tag_path)
+                    if tag_path is None:
+                        pass
+                    elif cached is not None and cached[0] == mtime:
+                        dependencies = cached[1]
+                    else:
+                        references = next(all_references, None)
+                        if references is not None:
+                            dependencies = self.get_dependency_paths(
+                                references)
+                            dependency_cache[tag_path] = (
+                                mtime, dependencies)
 
-                        tagzip.write(str(tag_path), arcname=str(rel_filepath))
-                    except Exception:
-                        print(format_exc())
+                    if self.stop_zipping:
+                        return
+                    elif dependencies is None:
                         print("    Could not add '%s' to zipfile." %
                               rel_filepath)
+                        continue
 
-                # replace the tags to zip with the newly collected ones
-                tags_to_zip[:] = new_tags_to_zip
-                del new_tags_to_zip[:]
+                    tags_to_zip.extend(dependencies)
+                    yield tag_path, rel_filepath
+            finally:
+                all_references.close()
+
+    def iter_references(self, tag_paths, executor=None):
+        '''
+        Yields the references in each of the given tags, in order, or None
+        for tags that couldnt be loaded. If an executor is given, the tags
+        are split into chunks and read by its worker processes.
+        '''
+        if executor is None:
+            for tag_path in tag_paths:
+                try:
+                    yield read_tag_references(self.handler, tag_path)
+                except Exception:
+                    print(format_exc())
+                    yield None
+            return
 
-        print("\nRecursive zip completed.\n")
+        futures = [executor.submit(read_references_in_worker,
+                                   tag_paths[i: i + ZIP_CHUNK_SIZE])
+                   for i in range(0, len(tag_paths), ZIP_CHUNK_SIZE)]
+        try:
+            for future in futures:
+                # poll so cancelling doesnt wait on a slow chunk
+                while not wait((future, ), timeout=0.25).done:
+                    if self.stop_zipping:
+                        return
+
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def write_zip_entries(self, tagzip, write_queue):
+        '''
+        Writes (filepath, zipfile path) pairs from the queue
+        into the zipfile until None is pulled from the queue.
+        '''
+        while True:
+            entry = write_queue.get()
+            if entry is None:
+                return
+
+            tag_path, rel_filepath = entry
+            try:
+                tagzip.write(str(tag_path), arcname=str(rel_filepath))
+            except Exception:
+                print(format_exc())
+                print("    Could not add '%s' to zipfile." % rel_filepath)
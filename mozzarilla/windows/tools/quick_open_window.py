@@ -0,0 +1,136 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+from pathlib import Path
+import tkinter as tk
+
+from traceback import format_exc
+
+from binilla.widgets.binilla_widget import BinillaWidget
+
+from mozzarilla import editor_constants as e_c
+
+# max number of matching tags shown
+QUICK_OPEN_RESULT_COUNT = 50
+
+
+class QuickOpenWindow(BinillaWidget, tk.Toplevel):
+    '''
+    Lists the tags in all the tags directories whose paths match what is
+    typed, and opens the selected one. Matches are found using the path
+    index the app keeps of every tags directory.
+    '''
+    app_root = None
+    results = ()
+
+    def __init__(self, app_root, *args, **kwargs):
+        self.app_root = app_root
+        kwargs.update(bd=0, highlightthickness=0)
+        tk.Toplevel.__init__(self, app_root, *args, **kwargs)
+        BinillaWidget.__init__(self, app_root, *args, **kwargs)
+
+        self.title("Quick open")
+        self.minsize(width=500, height=300)
+        self.update()
+        try:
+            self.iconbitmap(e_c.MOZZ_ICON_PATH)
+        except Exception:
+            print("Could not load window icon.")
+
+        # make the tkinter variables
+        self.query = tk.StringVar(self)
+        self.query.trace("w", lambda *a, s=self: s.search())
+
+        # make the frames
+        self.query_frame = tk.LabelFrame(self, text="Type part of a tag path")
+        self.results_frame = tk.Frame(self)
+
+        self.query_entry = tk.Entry(self.query_frame, textvariable=self.query)
+        self.results_listbox = tk.Listbox(
+            self.results_frame, height=15, selectmode='single',
+            exportselection=False)
+        self.results_scrollbar = tk.Scrollbar(
+            self.results_frame, orient='vertical',
+            command=self.results_listbox.yview)
+        self.results_listbox.config(
+            yscrollcommand=self.results_scrollbar.set)
+
+        for widget in (self.query_entry, self.results_listbox):
+            widget.bind('<Return>', self.open_selected)
+            widget.bind('<Escape>', lambda e, s=self: s.destroy())
+        self.query_entry.bind('<Up>', lambda e, s=self: s.move_selection(-1))
+        self.query_entry.bind('<Down>', lambda e, s=self: s.move_selection(1))
+        self.results_listbox.bind('<Double-Button-1>', self.open_selected)
+
+        self.query_entry.pack(fill="x", expand=True, padx=4, pady=2)
+        self.results_scrollbar.pack(side='right', fill='y')
+        self.results_listbox.pack(side='right', fill='both', expand=True)
+
+        self.query_frame.pack(fill='x', padx=1)
+        self.results_frame.pack(fill='both', expand=True, padx=1)
+
+        self.transient(self.app_root)
+        self.apply_style()
+        self.query_entry.focus_set()
+
+    def destroy(self):
+        try:
+            self.app_root.tool_windows.pop(self.window_name, None)
+        except AttributeError:
+            pass
+        tk.Toplevel.destroy(self)
+
+    def search(self):
+        listbox = self.results_listbox
+        listbox.delete(0, 'end')
+        self.results = self.app_root.path_index.search(
+            self.query.get(), QUICK_OPEN_RESULT_COUNT)
+
+        # only show which tags directory the tag is in if there are several
+        show_dir = len(self.app_root.tags_dirs) > 1
+        for root_dir, rel_path in self.results:
+            if show_dir:
+                listbox.insert('end', "%s    [%s]" % (rel_path, root_dir))
+            else:
+                listbox.insert('end', rel_path)
+
+        if self.results:
+            listbox.selection_set(0)
+
+    def move_selection(self, offset):
+        listbox = self.results_listbox
+        if not self.results:
+            return "break"
+
+        selection = listbox.curselection()
+        index = selection[0] + offset if selection else 0
+        index = max(0, min(len(self.results) - 1, index))
+
+        listbox.selection_clear(0, 'end')
+        listbox.selection_set(index)
+        listbox.see(index)
+        return "break"
+
+    def open_selected(self, e=None):
+        selection = self.results_listbox.curselection()
+        if not selection:
+            return
+
+        app = self.app_root
+        root_dir, rel_path = self.results[selection[0]]
+        try:
+            tags_dir_index = app.get_tags_dir_index(root_dir)
+            if tags_dir_index is not None:
+                app.switch_tags_dir(index=tags_dir_index)
+
+            app.load_tags(filepaths=Path(root_dir, rel_path))
+        except Exception:
+            print(format_exc())
+
+        self.destroy()
@@ -8,11 +8,13 @@
 #
 
 import ctypes
+import json
 import os
 import sys
 import tkinter as tk
 
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait
+from pathlib import Path, PureWindowsPath
 from time import time
 from threading import Thread
 from traceback import format_exc
@@ -21,9 +23,12 @@
 from binilla.widgets.binilla_widget import BinillaWidget
 from binilla.windows.filedialog import askdirectory, asksaveasfilename
 
-from supyr_struct.util import path_normalize, is_in_dir
+from supyr_struct.util import path_normalize, is_in_dir, tagpath_to_fullpath
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla.scan_cache import ScanCache
+from mozzarilla.tag_index import get_block_name, get_loaded_tag,\
+     get_tag_references, read_tag_references
 
 
 platform = sys.platform.lower()
@@ -35,6 +40,162 @@
 if platform == "win32":
     SetFileAttributesW = ctypes.windll.kernel32.SetFileAttributesW
 
+# number of tags each worker process is handed at a time
+SCAN_CHUNK_SIZE = 32
+
+# size of the write buffer used when streaming the scan log to disk
+LOG_BUFFER_SIZE = 1024**2
+
+# the handler each worker process uses to load tags
+_worker_handler = None
+
+# types of tags that get_tag_specific_errors checks.
+# these are the only tags the scanner needs to fully build.
+TAG_SPECIFIC_DEF_IDS = frozenset(("snd!", "coll", "effe"))
+
+
+def get_tag_specific_errors(tag):
+    '''
+    Returns a string describing any errors specific to the type of the
+    given tag, or an empty string if none were found.
+    '''
+    cls = tag.def_id
+    err = ""
+
+    if cls == "snd!":
+        bad_ogg = []
+        for pr in tag.data.tagdata.pitch_ranges.STEPTREE:
+            for perm in pr.permutations.STEPTREE:
+                if perm.compression.enum_name != "ogg":
+                    continue
+                elif perm.buffer_size == 0 and perm.samples.data:
+                    bad_ogg.append((pr.name, perm.name))
+
+        if bad_ogg:
+            err += ("    Bad PCM buffer size. " +
+                    "Fix by recompiling this sound.")
+    elif cls == "coll":
+        bad_nodes = {}
+        tagdata = tag.data.tagdata
+        nodes = tagdata.nodes.STEPTREE
+        mat_ct = len(tagdata.materials.STEPTREE)
+        highest_mat_num = lowest_mat_num = 0
+
+        for i in range(len(nodes)):
+            node = nodes[i]
+            bad_bsps = {}
+            for j in range(len(node.bsps.STEPTREE)):
+                bsp = node.bsps.STEPTREE[j]
+                bad_surfaces = []
+                for k in range(len(bsp.surfaces.STEPTREE)):
+                    mat = bsp.surfaces.STEPTREE[k].material
+                    if mat > -1 and mat < mat_ct:
+                        continue
+
+                    highest_mat_num = max(highest_mat_num, mat)
+                    lowest_mat_num  = min(lowest_mat_num, mat)
+                    bad_surfaces.append(k)
+
+                if bad_surfaces:
+                    bad_bsps[j] = bad_surfaces
+
+            if bad_bsps:
+                bad_nodes[i] = bad_bsps
+
+        if bad_nodes:
+            err += "    Bad collision material numbers.\n"
+            if lowest_mat_num > -1:
+                # none of the material numbers are below zero, so
+                # it's possible to fix this by adding more materials.
+                err += (("    Change the material numbers of these " +
+                         "surfaces to be <= %s or add %s materials.\n")
+                        % (mat_ct - 1, (highest_mat_num + 1) - mat_ct))
+            else:
+                err += (("    Change the material numbers of these " +
+                         "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
+
+            for i in sorted(bad_nodes.keys()):
+                bad_bsps = bad_nodes[i]
+                err += "    %s(node #%s)\n" % (nodes[i].name, i)
+                for j in sorted(bad_bsps.keys()):
+                    bad_surfaces = bad_bsps[j]
+                    err += "        bsp #%s\n" % j
+                    err += "            surfaces = %s\n" % bad_surfaces
+                err += "\n"
+            err = err[:-1]
+
+    elif cls == "effe":
+        i = 0
+        events = tag.data.tagdata.events.STEPTREE
+        for i in range(len(events)):
+            # tool exceptions if any parts reference a damage effect
+            # tag type, but have an empty filepath for the reference
+            parts = events[i].parts.STEPTREE
+            for j in range(len(parts)):
+                part = parts[j]
+                if (part.type.tag_class.enum_name == "damage_effect" and
+                    not part.type.filepath):
+                    err += ("     Missing filepath in damage_effect "
+                            "reference in part %s of event %s\n." % (j, i))
+
+    return err
+
+
+def init_scan_worker(handler_class, tagsdir, case_sensitive):
+    '''
+    Initializer for the tag scanner's worker processes. Each worker
+    owns its own handler instance for the tag set being scanned.
+    '''
+    global _worker_handler
+    _worker_handler = handler_class(debug=0, case_sensitive=case_sensitive)
+    _worker_handler.tagsdir = Path(tagsdir)
+
+
+def scan_tag(handler, filepath, def_id, tag=None):
+    '''
+    Scans the tag at the tags directory relative filepath and returns a
+    (loaded, references, tag_errors, scan_error) tuple, where references
+    is the list returned by get_tag_references. If the tag isnt given it
+    is only built if it has tag specific errors to check for. Otherwise
+    only the parts of it needed to find its references are read.
+    '''
+    fullpath = handler.tagsdir.joinpath(filepath)
+    if tag is None and def_id not in TAG_SPECIFIC_DEF_IDS:
+        try:
+            return True, read_tag_references(handler, fullpath), "", ""
+        except Exception:
+            return False, (), "", ""
+
+    if tag is None:
+        try:
+            tag = handler.build_tag(filepath=fullpath)
+        except Exception:
+            pass
+
+    if tag is None:
+        return False, (), "", ""
+
+    references, tag_errors, scan_error = (), "", ""
+    try:
+        # find tag specific errors
+        tag_errors = get_tag_specific_errors(tag)
+        references = get_tag_references(handler, tag)
+    except Exception:
+        scan_error = format_exc()
+
+    return True, references, tag_errors, scan_error
+
+
+def scan_tags_in_worker(def_id, filepaths):
+    '''
+    Scans each of the given tags directory relative filepaths using the
+    worker processes handler and returns a list of compact results.
+    Each result is a (filepath, loaded, references, tag_errors, scan_error)
+    tuple, where references is the list returned by get_tag_references.
+    '''
+    return [(filepath, ) + scan_tag(_worker_handler, filepath, def_id)
+            for filepath in filepaths]
+
 
 class TagScannerWindow(tk.Toplevel, BinillaWidget):
     app_root = None
@@ -42,8 +203,13 @@ class TagScannerWindow(tk.Toplevel, BinillaWidget):
 
     _scanning = False
     stop_scanning = False
+    tag_index = None
     print_interval = 5
 
+    # maps (filepath, extension) to whether or not that dependency exists.
+    # reset at the start of each scan since tags may have been added since.
+    _dependency_exists_cache = None
+
     listbox_index_to_def_id = ()
 
     def __init__(self, app_root, *args, **kwargs):
@@ -68,12 +234,17 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.open_logfile = tk.BooleanVar(self, True)
+        self.scan_in_parallel = tk.BooleanVar(self, False)
+        self.use_scan_cache = tk.BooleanVar(self, True)
+        self.only_changed_tags = tk.BooleanVar(self, False)
+        self.write_findings = tk.BooleanVar(self, False)
         self.directory_path = tk.StringVar(self)
         self.logfile_path = tk.StringVar(self)
 
         # make the frames
         self.directory_frame = tk.LabelFrame(self, text="Directory to scan")
         self.logfile_frame   = tk.LabelFrame(self, text="Output log filepath")
+        self.options_frame = tk.LabelFrame(self, text="Scan options")
         self.def_ids_frame = tk.LabelFrame(
             self, text="Select which tag types to scan")
         self.logfile_dir_frame = tk.Frame(self.logfile_frame)
@@ -104,6 +275,18 @@ def __init__(self, app_root, *args, **kwargs):
         self.open_logfile_cbtn = tk.Checkbutton(
             self.logfile_frame, text="Open log when done scanning",
             variable=self.open_logfile)
+        self.scan_in_parallel_cbtn = tk.Checkbutton(
+            self.options_frame, variable=self.scan_in_parallel,
+            text="Scan using multiple processes (faster on large directories)")
+        self.use_scan_cache_cbtn = tk.Checkbutton(
+            self.options_frame, variable=self.use_scan_cache,
+            text="Only rescan tags changed since the last scan")
+        self.only_changed_tags_cbtn = tk.Checkbutton(
+            self.options_frame, variable=self.only_changed_tags,
+            text="Only report tags changed since the last scan")
+        self.write_findings_cbtn = tk.Checkbutton(
+            self.options_frame, variable=self.write_findings,
+            text="Also write findings as json lines next to the log (.jsonl)")
 
         self.def_ids_scrollbar = tk.Scrollbar(
             self.def_ids_frame, orient="vertical")
@@ -142,6 +325,10 @@ def __init__(self, app_root, *args, **kwargs):
         self.logfile_frame.pack(fill='x', padx=1)
         self.logfile_dir_frame.pack(fill='x')
         self.open_logfile_cbtn.pack(fill='x', side=tk.LEFT)
+        self.options_frame.pack(fill='x', padx=1)
+        for w in (self.scan_in_parallel_cbtn, self.use_scan_cache_cbtn,
+                  self.only_changed_tags_cbtn, self.write_findings_cbtn):
+            w.pack(anchor='w')
         self.def_ids_frame.pack(fill='both', padx=1, expand=True)
 
         self.transient(app_root)
@@ -165,23 +352,6 @@ def select_all(self):
         for i in range(len(self.listbox_index_to_def_id)):
             self.def_ids_listbox.select_set(i)
 
-    def get_tag(self, filepath):
-        handler = self.handler
-        def_id = handler.get_def_id(filepath)
-
-        try:
-            tag = handler.get_tag(filepath, def_id)
-        except (KeyError, LookupError):
-            tag = None
-        try:
-            if tag is None:
-                return handler.build_tag(
-                    filepath=self.handler.tagsdir.joinpath(filepath)
-                    )
-        except Exception:
-            pass
-        return tag
-
     def dir_browse(self):
         if self._scanning:
             return
@@ -219,11 +389,13 @@ def destroy(self):
             self.app_root.tool_windows.pop(self.window_name, None)
         except AttributeError:
             pass
-        self.stop_scanning = True
+        self.cancel_scan()
         tk.Toplevel.destroy(self)
 
     def cancel_scan(self):
         self.stop_scanning = True
+        if self.tag_index is not None:
+            self.tag_index.stop_indexing = True
 
     def scan_directory(self):
         if self._scanning:
@@ -252,66 +424,110 @@ def scan(self):
             print("Specified directory is not located within the tags directory")
             return
 
-        #this is the string to store the entire debug log
-        log_name = "HEK Tag Scanner log"
-        debuglog = "\n%s%s%s\n\n" % (
-            "-"*30, log_name, "-" * (50-len(log_name)))
-        debuglog += "tags directory = %s\nscan directory = %s\n\n" % (
-            self.handler.tagsdir, dirpath)
-        debuglog += "Broken dependencies are listed below.\n"
+        # tag specific errors are logged after all the broken dependencies,
+        # so these are the only part of the log that is kept in memory.
         tag_specific_errors = {}
 
-        get_nodes = handler.get_nodes_by_paths
-        get_tagref_invalid = handler.get_tagref_invalid
-
         s_time = time()
         c_time = s_time
         p_int = self.print_interval
 
         all_tag_paths = {self.listbox_index_to_def_id[int(i)]: [] for i in
                          self.def_ids_listbox.curselection()}
-        ext_id_map = handler.ext_id_map
-        id_ext_map = handler.id_ext_map
 
         print("Locating tags...")
 
-        for root, directories, files in os.walk(dirpath):
-            root = path_normalize(os.path.join(root, ""))
-
-            rel_root = Path(root).relative_to(self.handler.tagsdir)
+        tag_index = self.tag_index = None
+        if hasattr(self.app_root, "get_tag_index"):
+            tag_index = self.tag_index = self.app_root.get_tag_index(handler)
 
-            for filename in files:
-                filepath = rel_root.joinpath(filename)
+        if tag_index is not None:
+            if self.stop_scanning or tag_index.refresh() is None:
+                print('Tag scanning operation cancelled.\n')
+                return
 
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
+            for def_id, tag_paths in all_tag_paths.items():
+                tag_paths.extend(tag_index.get_tag_paths((def_id, ), dirpath))
+        elif not self.walk_for_tags(dirpath, all_tag_paths):
+            print('Tag scanning operation cancelled.\n')
+            return
 
+        scan_cache = None
+        if self.use_scan_cache.get() or self.only_changed_tags.get():
+            scan_cache = ScanCache.for_directory(
+                "tag_scanner", handler.tagsdir,
+                self.app_root.handler_names[self.app_root._curr_handler_index])
+            scan_cache.load()
+
+        # stat each tag to see which ones need to be rescanned
+        use_cached = self.use_scan_cache.get()
+        cached_results = {}
+        unchanged_tags = set()
+        tag_stats = {}
+        tags_to_scan = {}
+        for def_id in all_tag_paths:
+            tags_to_scan[def_id] = []
+            for filepath in all_tag_paths[def_id]:
                 if self.stop_scanning:
                     print('Tag scanning operation cancelled.\n')
                     return
 
-                tag_paths = all_tag_paths.get(
-                    ext_id_map.get(os.path.splitext(filename)[-1].lower()))
+                try:
+                    tag_stats[filepath] = stat = os.stat(
+                        str(self.handler.tagsdir.joinpath(filepath)))
+                except OSError:
+                    tag_stats[filepath] = stat = None
 
-                if tag_paths is not None:
-                    tag_paths.append(filepath)
+                result = None
+                if scan_cache is not None and stat is not None:
+                    result = scan_cache.get(filepath.as_posix(), stat)
 
-        # make the debug string by scanning the tags directory
-        for def_id in sorted(all_tag_paths.keys()):
-            tag_ref_paths = handler.tag_ref_cache.get(def_id)
+                if result is not None:
+                    unchanged_tags.add(filepath)
 
-            self.app_root.update_idletasks()
-            print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
-            tags_coll = all_tag_paths[def_id]
+                if result is None or not use_cached:
+                    tags_to_scan[def_id].append(filepath)
+                else:
+                    cached_results[filepath] = result
+
+        if scan_cache is not None:
+            print("%s tags unchanged since the last scan." %
+                  len(unchanged_tags))
+            self.discard_missing_cache_entries(
+                scan_cache, dirpath, all_tag_paths)
 
-            # always display the first tag's filepath
-            c_time = time() - (p_int + 100)
+        if self.scan_in_parallel.get():
+            scan_results = self.iter_scan_results_parallel(tags_to_scan)
+        else:
+            scan_results = self.iter_scan_results(tags_to_scan)
+
+        print("Writing logfile to %s..." % logpath)
+        logfile = self.open_log_file(logpath)
+        write = logfile.write if logfile else self.print_log
+
+        log_name = "HEK Tag Scanner log"
+        write("\n%s%s%s\n\n" % ("-"*30, log_name, "-" * (50-len(log_name))))
+        write("tags directory = %s\nscan directory = %s\n\n" % (
+            self.handler.tagsdir, dirpath))
+        write("Broken dependencies are listed below.\n")
+
+        findings_file = None
+        if self.write_findings.get():
+            findings_path = Path(logpath).with_suffix(".jsonl")
+            print("Writing findings to %s..." % findings_path)
+            try:
+                findings_file = findings_path.open(
+                    'w', encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+            except Exception:
+                print("Could not create findings file.")
 
-            for filepath in sorted(tags_coll):
+        self._dependency_exists_cache = {}
+        try:
+            # write the broken dependencies to the log as the tags are scanned
+            for (def_id, filepath, loaded, references, tag_errors,
+                 scan_error, from_loaded_tag) in self.merge_cached_results(
+                        all_tag_paths, cached_results, scan_results):
                 if self.stop_scanning:
-                    print('Tag scanning operation cancelled.\n')
                     break
 
                 if time() - c_time > p_int:
@@ -319,158 +535,307 @@ def scan(self):
                     print(' '*4, filepath, sep="")
                     self.app_root.update_idletasks()
 
-                tag = self.get_tag(self.handler.tagsdir.joinpath(filepath))
-                if tag is None:
+                if not loaded:
                     print("    Could not load '%s'" % filepath)
+                    if findings_file:
+                        self.write_finding(
+                            findings_file, "load_error", def_id, filepath)
                     continue
 
-                # find tag specific errors
-                self.tag_specific_scan(tag, tag_specific_errors)
-
-                try:
-                    if tag_ref_paths is None:
-                        # no dependencies for this tag. continue on
-                        continue
-
-                    missed = get_nodes(tag_ref_paths, tag.data,
-                                       get_tagref_invalid)
-
-                    if not missed:
-                        continue
+                # dont cache results of loaded tags, as they may have
+                # unsaved edits that dont match the file they're cached by.
+                changed = filepath not in unchanged_tags
+                if (filepath not in cached_results and not scan_error and
+                        not from_loaded_tag and scan_cache is not None and
+                        tag_stats.get(filepath) is not None):
+                    scan_cache.set(filepath.as_posix(), tag_stats[filepath],
+                                   [references, tag_errors])
 
-                    debuglog += "\n\n%s\n" % filepath
-                    block_name = None
-
-                    for block in missed:
-                        if block.NAME != block_name:
-                            debuglog += '%s%s\n' % (' '*4, block.NAME)
-                            block_name = block.NAME
-                        try:
-                            ext = '.' + block.tag_class.enum_name
-                        except Exception:
-                            ext = ''
-                        debuglog += '%s%s\n' % (' '*8, block.STEPTREE + ext)
-
-                except Exception:
-                    print(format_exc())
-                    print("    Could not scan '%s'" % tag.filepath)
+                if self.only_changed_tags.get() and not changed:
                     continue
 
-            if self.stop_scanning:
-                break
+                if tag_errors:
+                    tag_specific_errors.setdefault(def_id, []).append(
+                        "\n%s\n%s\n" % (filepath, tag_errors))
+                    if findings_file:
+                        self.write_finding(
+                            findings_file, "tag_specific_error", def_id,
+                            filepath, message=tag_errors.strip())
+
+                if scan_error:
+                    print(scan_error)
+                    print("    Could not scan '%s'" % filepath)
+                    if findings_file:
+                        self.write_finding(
+                            findings_file, "scan_error", def_id,
+                            filepath, message=scan_error.strip())
+                    continue
 
-        if tag_specific_errors:
-            debuglog += "\nTag specific errors are listed below.\n"
+                broken = self.get_broken_dependencies(references)
+                if not broken:
+                    continue
 
-        for def_id in sorted(tag_specific_errors.keys()):
-            debuglog += "\n\n%s specific errors:\n%s" % (
-                def_id, tag_specific_errors[def_id])
+                section = ["\n\n%s\n" % filepath]
+                block_name = None
+
+                for name, block_path, dependency_path, ext in broken:
+                    if name != block_name:
+                        section.append('%s%s\n' % (' '*4, name))
+                        block_name = name
+                    section.append('%s%s\n' % (' '*8, dependency_path + ext))
+
+                    if findings_file:
+                        self.write_finding(
+                            findings_file, "broken_dependency", def_id,
+                            filepath, block_path=block_path,
+                            dependency_class=ext.lstrip('.'),
+                            dependency_path=dependency_path)
+
+                write("".join(section))
+
+            if tag_specific_errors:
+                write("\nTag specific errors are listed below.\n")
+
+            for def_id in sorted(tag_specific_errors.keys()):
+                write("\n\n%s specific errors:\n" % def_id)
+                write("".join(tag_specific_errors[def_id]))
+        finally:
+            scan_results.close()
+            self._dependency_exists_cache = None
+            if scan_cache is not None:
+                scan_cache.save()
+            if logfile:
+                logfile.close()
+            if findings_file:
+                findings_file.close()
+
+        if self.stop_scanning:
+            print('Tag scanning operation cancelled.\n')
+            return
 
         print("\nScanning took %s seconds." % int(time() - s_time))
-        print("Writing logfile to %s..." % logpath)
-        self.app_root.update_idletasks()
+        print("Scan completed.\n")
+        if not logfile:
+            return
 
-        # make and write to the logfile
         try:
-            handler.make_log_file(debuglog, logpath)
-            try:
-                print("Scan completed.\n")
-                if self.open_logfile.get():
-                    open_in_default_program(logpath)
+            if self.open_logfile.get():
+                open_in_default_program(logpath)
+        except Exception:
+            print("Could not open written log.")
 
-            except Exception:
-                print("Could not open written log.")
-            return
+    def open_log_file(self, logpath):
+        '''
+        Opens the log file to be appended to through a large write buffer.
+        Returns None if it cannot be opened.
+        '''
+        try:
+            return Path(logpath).open('a', buffering=LOG_BUFFER_SIZE)
         except Exception:
             print("Could not create log. Printing log to console instead.\n\n")
-            for line in debuglog.split('\n'):
+            return None
+
+    def write_finding(self, findings_file, kind, def_id, filepath, **fields):
+        '''
+        Writes a single finding to the findings file as one line of json.
+        '''
+        fields.update(kind=kind, tags_dir=str(self.handler.tagsdir),
+                      tag_path=str(filepath), def_id=def_id)
+        findings_file.write(json.dumps(fields, sort_keys=True) + "\n")
+
+    def print_log(self, logstr):
+        for line in logstr.split('\n'):
+            try:
+                print(line)
+            except Exception:
+                print("<COULD NOT PRINT THIS LINE>")
+
+    def walk_for_tags(self, dirpath, all_tag_paths):
+        '''
+        Walks the directory and adds the path of each tag to the list in
+        all_tag_paths under the tag's def_id, if there is one.
+        Returns False if the scan was cancelled.
+        '''
+        c_time = time()
+        p_int = self.print_interval
+        ext_id_map = self.handler.ext_id_map
+
+        for root, directories, files in os.walk(dirpath):
+            root = path_normalize(os.path.join(root, ""))
+
+            rel_root = Path(root).relative_to(self.handler.tagsdir)
+
+            for filename in files:
+                filepath = rel_root.joinpath(filename)
+
+                if time() - c_time > p_int:
+                    c_time = time()
+                    print(' '*4, filepath, sep="")
+                    self.app_root.update_idletasks()
+
+                if self.stop_scanning:
+                    return False
+
+                tag_paths = all_tag_paths.get(
+                    ext_id_map.get(os.path.splitext(filename)[-1].lower()))
+
+                if tag_paths is not None:
+                    tag_paths.append(filepath)
+
+        return True
+
+    def get_dependency_exists(self, filepath, ext):
+        key = (filepath, ext)
+        exists_cache = self._dependency_exists_cache
+        if exists_cache is not None and key in exists_cache:
+            return exists_cache[key]
+
+        tagsdir = self.handler.tagsdir
+        exists = tagpath_to_fullpath(
+            tagsdir, PureWindowsPath(filepath), extension=ext) is not None
+        if not exists and self.handler.treat_mode_as_mod2 and ext == '.model':
+            exists = tagpath_to_fullpath(
+                tagsdir, PureWindowsPath(filepath),
+                extension='.gbxmodel') is not None
+
+        if exists_cache is not None:
+            exists_cache[key] = exists
+        return exists
+
+    def get_broken_dependencies(self, references):
+        '''
+        Returns a list of (block_name, block_path, filepath, extension)
+        tuples for the given tag references that point to a tag that
+        doesnt exist. block_name is the NAME of the reference's block.
+        '''
+        return [(get_block_name(block_path), block_path, filepath, ext)
+                for block_path, filepath, ext in references
+                if not self.get_dependency_exists(filepath, ext)]
+
+    def discard_missing_cache_entries(self, scan_cache, dirpath, all_tag_paths):
+        '''
+        Removes cached results for tags of the scanned types that were
+        inside the scanned directory, but no longer exist.
+        '''
+        id_ext_map = self.handler.id_ext_map
+        exts = set(id_ext_map[def_id] for def_id in all_tag_paths)
+        seen = set(filepath.as_posix()
+                   for tags_coll in all_tag_paths.values()
+                   for filepath in tags_coll)
+
+        rel_dir = Path(dirpath).relative_to(self.handler.tagsdir).as_posix()
+        prefix = "" if rel_dir == "." else rel_dir + "/"
+        for key in list(scan_cache.keys()):
+            if (key not in seen and key.startswith(prefix) and
+                    os.path.splitext(key)[-1].lower() in exts):
+                scan_cache.discard(key)
+
+    def merge_cached_results(self, all_tag_paths, cached_results, scan_results):
+        '''
+        Yields the results for every tag in the order they will be logged,
+        replaying cached results and pulling the rest from scan_results.
+        '''
+        for def_id in sorted(all_tag_paths.keys()):
+            for filepath in sorted(all_tag_paths[def_id]):
+                result = cached_results.get(filepath)
+                if result is not None:
+                    references, tag_errors = result
+                    yield (def_id, filepath, True, references, tag_errors,
+                           "", False)
+                    continue
+
                 try:
-                    print(line)
-                except Exception:
-                    print("<COULD NOT PRINT THIS LINE>")
+                    yield next(scan_results)
+                except StopIteration:
+                    # scanning was cancelled
+                    return
+
+    def iter_scan_results(self, all_tag_paths):
+        '''
+        Loads and scans each tag on this thread, yielding a (def_id,
+        filepath, loaded, references, tag_errors, scan_error,
+        from_loaded_tag) tuple for each tag in the order they will be
+        logged. from_loaded_tag is whether the tag was already loaded,
+        in which case the results may include unsaved edits.
+        '''
+        handler = self.handler
+        id_ext_map = handler.id_ext_map
+
+        for def_id in sorted(all_tag_paths.keys()):
+            if self.stop_scanning:
+                return
+
+            self.app_root.update_idletasks()
+            print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
+
+            for filepath in sorted(all_tag_paths[def_id]):
+                if self.stop_scanning:
+                    return
 
-            print("Scan completed.\n")
+                # use the tag if it's already loaded so unsaved edits are
+                # scanned, but otherwise avoid building it if possible.
+                tag = get_loaded_tag(handler, filepath)
+                yield (def_id, filepath) + scan_tag(
+                    handler, filepath, def_id, tag) + (tag is not None, )
+
+    def iter_scan_results_parallel(self, all_tag_paths):
+        '''
+        Shards the tags across a pool of worker processes, each with its
+        own handler, and yields the same tuples as iter_scan_results in
+        the same order so the log is identical to a serial scan.
+        '''
+        handler = self.handler
+        id_ext_map = handler.id_ext_map
+
+        chunks = []
+        for def_id in sorted(all_tag_paths.keys()):
+            tags_coll = sorted(all_tag_paths[def_id])
+            for i in range(0, len(tags_coll), SCAN_CHUNK_SIZE):
+                chunks.append((def_id, tags_coll[i: i + SCAN_CHUNK_SIZE]))
+
+        if not chunks:
+            return
+
+        print("Starting worker processes...")
+        self.app_root.update_idletasks()
+        executor = ProcessPoolExecutor(
+            initializer=init_scan_worker, initargs=(
+                type(handler), str(handler.tagsdir), handler.case_sensitive))
+        futures = []
+        try:
+            futures.extend(
+                executor.submit(scan_tags_in_worker, def_id, filepaths)
+                for def_id, filepaths in chunks)
+
+            curr_def_id = None
+            for i in range(len(chunks)):
+                def_id = chunks[i][0]
+                if def_id != curr_def_id:
+                    curr_def_id = def_id
+                    self.app_root.update_idletasks()
+                    print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
+
+                # poll so cancelling doesnt wait on a slow chunk
+                while not wait(futures[i: i + 1], timeout=0.25).done:
+                    if self.stop_scanning:
+                        return
+
+                # workers never use tags loaded in this process
+                for result in futures[i].result():
+                    yield (def_id, ) + tuple(result) + (False, )
+
+                # dont hold onto results that have been logged already
+                futures[i] = None
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            executor.shutdown(wait=False)
 
     def tag_specific_scan(self, tag, errors):
         assert isinstance(errors, dict)
         cls = tag.def_id
-        err = ""
-
-        if cls == "snd!":
-            bad_ogg = []
-            for pr in tag.data.tagdata.pitch_ranges.STEPTREE:
-                for perm in pr.permutations.STEPTREE:
-                    if perm.compression.enum_name != "ogg":
-                        continue
-                    elif perm.buffer_size == 0 and perm.samples.data:
-                        bad_ogg.append((pr.name, perm.name))
-
-            if bad_ogg:
-                err += ("    Bad PCM buffer size. " +
-                        "Fix by recompiling this sound.")
-        elif cls == "coll":
-            bad_nodes = {}
-            tagdata = tag.data.tagdata
-            nodes = tagdata.nodes.STEPTREE
-            mat_ct = len(tagdata.materials.STEPTREE)
-            highest_mat_num = lowest_mat_num = 0
-
-            for i in range(len(nodes)):
-                node = nodes[i]
-                bad_bsps = {}
-                for j in range(len(node.bsps.STEPTREE)):
-                    bsp = node.bsps.STEPTREE[j]
-                    bad_surfaces = []
-                    for k in range(len(bsp.surfaces.STEPTREE)):
-                        mat = bsp.surfaces.STEPTREE[k].material
-                        if mat > -1 and mat < mat_ct:
-                            continue
-
-                        highest_mat_num = max(highest_mat_num, mat)
-                        lowest_mat_num  = min(lowest_mat_num, mat)
-                        bad_surfaces.append(k)
-
-                    if bad_surfaces:
-                        bad_bsps[j] = bad_surfaces
-
-                if bad_bsps:
-                    bad_nodes[i] = bad_bsps
-
-            if bad_nodes:
-                err += "    Bad collision material numbers.\n"
-                if lowest_mat_num > -1:
-                    # none of the material numbers are below zero, so
-                    # it's possible to fix this by adding more materials.
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be <= %s or add %s materials.\n")
-                            % (mat_ct - 1, (highest_mat_num + 1) - mat_ct))
-                else:
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
-
-                for i in sorted(bad_nodes.keys()):
-                    bad_bsps = bad_nodes[i]
-                    err += "    %s(node #%s)\n" % (nodes[i].name, i)
-                    for j in sorted(bad_bsps.keys()):
-                        bad_surfaces = bad_bsps[j]
-                        err += "        bsp #%s\n" % j
-                        err += "            surfaces = %s\n" % bad_surfaces
-                    err += "\n"
-                err = err[:-1]
-
-        elif cls == "effe":
-            i = 0
-            events = tag.data.tagdata.events.STEPTREE
-            for i in range(len(events)):
-                # tool exceptions if any parts reference a damage effect
-                # tag type, but have an empty filepath for the reference
-                parts = events[i].parts.STEPTREE
-                for j in range(len(parts)):
-                    part = parts[j]
-                    if (part.type.tag_class.enum_name == "damage_effect" and
-                        not part.type.filepath):
-                        err += ("     Missing filepath in damage_effect "
-                                "reference in part %s of event %s\n." % (j, i))
+        err = get_tag_specific_errors(tag)
 
         if err:
             rel_tag_path = str(tag.filepath.relative_to(self.handler.tagsdir))
@@ -0,0 +1,71 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import tempfile
+import unittest
+
+from pathlib import Path
+
+try:
+    from reclaimer.hek.handler import HaloHandler
+except ImportError:
+    HaloHandler = None
+
+from mozzarilla.tag_index import get_tag_references, read_tag_references
+
+
+@unittest.skipIf(HaloHandler is None, "reclaimer is not installed")
+class ReadTagReferencesTest(unittest.TestCase):
+    '''
+    Compares the references read_tag_references reads out of tag files
+    with the references in the same tags once they're fully built.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.handler = HaloHandler(debug=0)
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.handler.tagsdir = Path(cls.temp_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def check_references(self, tag):
+        handler = self.handler
+        tag.serialize(temp=False, backup=False)
+        built_tag = handler.build_tag(filepath=tag.filepath)
+        expected = get_tag_references(handler, built_tag)
+        self.assertTrue(expected)
+        self.assertEqual(read_tag_references(handler, tag.filepath), expected)
+
+    def test_extra_layers(self):
+        # extra_layers are reflexives whose structs are tag references
+        for def_id in ("scex", "schi", "sotr"):
+            with self.subTest(def_id=def_id):
+                handler = self.handler
+                tag = handler.build_tag(def_id=def_id, filepath='')
+                tag.filepath = Path(handler.tagsdir,
+                                    "shader" + handler.id_ext_map[def_id])
+                attrs = tag.data.tagdata[1]
+                attrs.lens_flare.tag_class.set_to("lens_flare")
+                attrs.lens_flare.filepath = "effects\\flare"
+
+                extra_layers = attrs.extra_layers.STEPTREE
+                for i in range(3):
+                    extra_layers.append()
+                    extra_layers[-1].tag_class.set_to("shader_environment")
+                    # empty references are skipped without desyncing
+                    extra_layers[-1].filepath = (
+                        "" if i == 1 else "shaders\\layer%s" % i)
+
+                self.check_references(tag)
+
+
+if __name__ == '__main__':
+    unittest.main()